@@ -0,0 +1,257 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import risk
+from columnar import FLOAT_DECIMALS, DateColumn, IntegerColumn, RecordTable
+
+# Running screening tallies kept next to the records. Each (dimension,
+# value) pair, e.g. ("Department", "Public Health"), ("Date", "2024-03-05")
+# or ("Day", "2024-03-05|Public Health"), holds one count per MEASURES
+# entry; the day dimensions count each measure on its own date. A change to some
+# records subtracts their old contribution and adds the new one, so the
+# summary cards read a few dict entries however many records there are.
+# The CSV backend persists the tallies of the snapshot beside it, keyed
+# like the binary snapshot, so a restart only has to replay the journal.
+AGGREGATES_VERSION = 1
+SUFFIX = ".aggregates.json"
+MEASURES = [
+    'Records', 'BP Screened', 'BMI Screened', 'Glucose Screened', 'Vision Screened', 'Referred',
+    'Hypertension', 'Overweight', 'Obesity', 'Prediabetes', 'Diabetes',
+]
+DIMENSIONS = ['Department', 'Sex', 'Age Band']
+# The date a measure counts towards in the "Day" dimension
+MEASURE_DATES = {
+    'Records': 'Registration Date',
+    'BP Screened': 'BP Date',
+    'BMI Screened': 'BMI Date',
+    'Glucose Screened': 'Glucose Date',
+    'Vision Screened': 'Vision Test Date',
+    'Referred': 'Referral Date',
+    'Hypertension': 'BP Date',
+    'Overweight': 'BMI Date',
+    'Obesity': 'BMI Date',
+    'Prediabetes': 'Glucose Date',
+    'Diabetes': 'Glucose Date',
+}
+DATE_COLUMNS = sorted(set(MEASURE_DATES.values()))
+
+
+def aggregates_path(data_file):
+    return data_file + SUFFIX
+
+
+def day_key(day, department):
+    return f"{day}|{department}"
+
+
+def _labels(column, rows):
+    # Category codes -> their values, None where unset
+    return np.array(column.values + [None], dtype=object)[column.data[rows]]
+
+
+def _measurement(table, name, rows):
+    # As table.frame reads it back, so thresholds match risk.assess
+    return table.columns[name].data[rows].astype(np.float64).round(FLOAT_DECIMALS)
+
+
+def condition_flags(table, rows):
+    # The risk.assess screening and condition masks, straight from the
+    # table's arrays for some rows without building a frame
+    bp = table.columns['Blood Pressure']
+    systolic = bp.systolic[rows].astype(np.float64)
+    diastolic = bp.diastolic[rows].astype(np.float64)
+    unset = systolic == bp.MISSING
+    systolic[unset] = np.nan
+    diastolic[unset] = np.nan
+    bmi = _measurement(table, 'BMI', rows)
+    glucose = _measurement(table, 'Blood Glucose', rows)
+    fasting = table.columns['Fasting Status']
+    code = fasting.data[rows]
+    is_fasting = code == fasting.lookup.get("Fasting", -2)
+    is_random = code == fasting.lookup.get("Random", -2)
+    flags = risk.flags(systolic, diastolic, bmi, glucose, is_fasting, is_random)
+    flags['BP Screened'] = ~unset
+    flags['BMI Screened'] = ~np.isnan(bmi)
+    flags['Glucose Screened'] = ~np.isnan(glucose) & (is_fasting | is_random)
+    return flags
+
+
+def _state(table, rows):
+    # What each row contributes: its measure flags, group codes and dates
+    flags = condition_flags(table, rows)
+    flags['Records'] = np.ones(len(rows), dtype=bool)
+    flags['Vision Screened'] = table.columns['Vision Test Date'].data[rows] != DateColumn.MISSING
+    flags['Referred'] = table.columns['Referred'].data[rows] == 1
+    age = table.columns['Age'].data[rows]
+    band = np.searchsorted(risk.AGE_BINS, age, side='right') - 1
+    band[(age == IntegerColumn.MISSING) | (band >= len(risk.AGE_BANDS))] = -1
+    return {
+        'values': np.column_stack([flags[m] for m in MEASURES]).astype(np.int64),
+        'department': table.columns['Department'].data[rows].astype(np.int32),
+        'sex': table.columns['Sex'].data[rows].astype(np.int32),
+        'band': band.astype(np.int8),
+        'days': np.column_stack([table.columns[c].data[rows] for c in DATE_COLUMNS]).astype(np.int32),
+    }
+
+
+def _count(state, table):
+    # {(dimension, value): counts per MEASURES} for the rows in a state
+    values = state['values']
+    counts = {}
+
+    def add(dimension, keys, matrix):
+        known = pd.notna(keys)
+        if not known.any():
+            return
+        uniques, inverse = np.unique(keys[known].astype(str), return_inverse=True)
+        sums = np.zeros((len(uniques), len(MEASURES)), dtype=np.int64)
+        np.add.at(sums, inverse, matrix[known])
+        for value, row in zip(uniques, sums):
+            counts[(dimension, value)] = counts.get((dimension, value), 0) + row
+
+    department = np.array(table.columns['Department'].values + [None], dtype=object)[state['department']]
+    add("All", np.full(len(values), "All", dtype=object), values)
+    add('Department', department, values)
+    add('Sex', np.array(table.columns['Sex'].values + [None], dtype=object)[state['sex']], values)
+    add('Age Band', np.array(risk.AGE_BANDS + [None], dtype=object)[state['band']], values)
+    for i, measure in enumerate(MEASURES):
+        days = state['days'][:, DATE_COLUMNS.index(MEASURE_DATES[measure])]
+        hit = (days != DateColumn.MISSING) & (values[:, i] > 0)
+        if not hit.any():
+            continue
+        matrix = np.zeros_like(values)
+        matrix[:, i] = values[:, i]
+        keys = np.full(len(values), None, dtype=object)
+        keys[hit] = np.datetime_as_string(days[hit].astype('datetime64[D]'))
+        add("Date", keys, matrix)
+        keys[hit] = [day_key(day, dept or "") for day, dept in zip(keys[hit], department[hit])]
+        add("Day", keys, matrix)
+    return counts
+
+
+def tally(table, rows=None):
+    rows = np.arange(len(table)) if rows is None else np.asarray(rows, dtype=np.int64)
+    return _count(_state(table, rows), table)
+
+
+class ScreeningAggregates:
+    # Keeps what it last counted for every row: saves reach the table only
+    # through RecordStore.refresh, which applies the new values and then
+    # calls apply() with the rows they touched, so the old values are gone
+    # from the table by the time their counts have to be taken back out
+    def __init__(self, counts=None, state=None):
+        self._lock = threading.Lock()
+        self.counts = counts or {}
+        self._state = state or _state(RecordTable(), np.arange(0))
+
+    @classmethod
+    def from_table(cls, table, counts=None):
+        # counts: persisted tallies of exactly these rows, if there are any
+        state = _state(table, np.arange(len(table)))
+        return cls(_count(state, table) if counts is None else counts, state)
+
+    def apply(self, table, rows):
+        # Moves rows out of the tallies as last counted and back in as they
+        # are in the table now
+        rows = np.asarray(rows, dtype=np.int64)
+        with self._lock:
+            state = self._state
+            size = len(state['values'])
+            old = rows[rows < size]
+            before = _count({k: v[old] for k, v in state.items()}, table) if len(old) else {}
+            new = _state(table, rows)
+            if rows.max(initial=-1) >= size:
+                grow = max(rows.max() + 1, size * 5 // 4) - size
+                state = {k: np.concatenate([v, np.zeros((grow,) + v.shape[1:], dtype=v.dtype)])
+                         for k, v in state.items()}
+            for k, v in new.items():
+                state[k][rows] = v
+            self._state = state
+            counts = dict(self.counts)
+            for key, row in before.items():
+                counts[key] = counts.get(key, 0) - row
+            for key, row in _count(new, table).items():
+                counts[key] = counts.get(key, 0) + row
+            self.counts = {k: v for k, v in counts.items() if np.any(v)}
+
+    def get(self, dimension, value):
+        # {measure: count} for one group; zeros if it has no records
+        row = self.counts.get((dimension, value))
+        return dict(zip(MEASURES, (0,) * len(MEASURES) if row is None else map(int, row)))
+
+    def total(self):
+        return self.get("All", "All")
+
+    def day(self, day, department=None):
+        # What happened on one day, in one department or all of them
+        if department is None:
+            return self.get("Date", day)
+        return self.get("Day", day_key(day, department))
+
+    def values(self, dimension):
+        return sorted(value for d, value in self.counts if d == dimension)
+
+    def prevalence(self, dimension=None):
+        # The table risk.prevalence gives for the whole cohort or per group
+        values = self.values(dimension) if dimension else ["All"]
+        if dimension == 'Age Band':
+            values = risk.AGE_BANDS
+        rows = [self.get(dimension or "All", v) for v in values]
+        table = pd.DataFrame({'Records': [r['Records'] for r in rows]},
+                             index=pd.Index(values, name=dimension))
+        for condition, screened in risk.SCREENED_BY.items():
+            n = pd.Series([r[screened] for r in rows], index=table.index)
+            table[screened] = n
+            table[f'{condition} %'] = (pd.Series([r[condition] for r in rows], index=table.index)
+                                       / n.where(n > 0) * 100).round(1)
+        return table
+
+    def differences(self, other):
+        # Groups whose counts disagree with another tally, for verification
+        keys = set(self.counts) | set(other.counts)
+        return {key: (self.get(*key), other.get(*key)) for key in sorted(keys)
+                if self.get(*key) != other.get(*key)}
+
+    def to_json(self):
+        return [[dimension, value, [int(n) for n in row]] for (dimension, value), row in self.counts.items()]
+
+
+def counts_from_json(rows):
+    return {(dimension, value): np.array(row, dtype=np.int64) for dimension, value, row in rows}
+
+
+def read(data_file, signature):
+    # Persisted counts of the snapshot with this signature, or None
+    try:
+        with open(aggregates_path(data_file), encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved.get('version') != AGGREGATES_VERSION or saved.get('measures') != MEASURES:
+            return None
+        if signature is None or saved.get('source') != [signature[1], signature[2]]:
+            return None
+        return counts_from_json(saved['counts'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write(aggregates, data_file, signature):
+    if signature is None:
+        return False
+    path = aggregates_path(data_file)
+    tmp = f"{path}.tmp.{os.getpid()}"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                'version': AGGREGATES_VERSION,
+                'measures': MEASURES,
+                'source': [signature[1], signature[2]],
+                'counts': aggregates.to_json(),
+            }, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        return True
+    except (OSError, ValueError, TypeError):
+        return False
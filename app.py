@@ -4,22 +4,29 @@ from datetime import datetime
 import os
 import hashlib
 import time
-
-# Department mapping
-departments = {
-    "Public Health": "PH",
-    "Port Health and Aviation": "PO",
-    "Reference Lab": "RL",
-    "Office of RDHS": "RD",
-    "Clinical Care Department": "CC",
-    "HASS & Finance": "HF",
-    "Human Resource": "HR",
-    "Regional Medical Stores": "RM"
-}
+import tempfile
+from store import open_record_store
+import risk
+import export
+from ids import SequenceAllocator, format_code
+from settings import (departments, DATA_FILE, DB_FILE, SEQUENCE_FILE,
+                      STORAGE_BACKEND, JOURNAL_COMPACT_THRESHOLD, OUTBOX_FILE,
+                      SMS_TRANSPORT, SMS_WORKERS, SMS_PER_SECOND, METRICS_FILE,
+                      HISTORY_FILE, STATION, MERGE_FILE, CHANGES_FILE)
+import roster
+import batch
+from measurements import calculate_bmi, GLUCOSE_UNIT
+import notify
+import metrics
+import history
+from history import MeasurementHistory
+from changes import ChangeLog
+import dedup
+import merge
+import browse
+import reports
 
 # Initialize session state
-if 'records' not in st.session_state:
-    st.session_state['records'] = []
 if 'reset_form' not in st.session_state:
     st.session_state['reset_form'] = False
 if 'show_unique_code' not in st.session_state:
@@ -27,22 +34,36 @@ if 'show_unique_code' not in st.session_state:
 if 'unique_code_time' not in st.session_state:
     st.session_state.unique_code_time = None
 
-# Data file path
-DATA_FILE = "medical_records.csv"
+# Section chosen on the previous interaction, used to label timing spans
+current_section = st.session_state.get('section', "General Information")
+# Reruns ended early by st.stop() are not timed
+rerun_span = metrics.start("rerun", current_section)
+
+# Shared by every session of this server process
+@st.cache_resource
+def get_record_store():
+    return open_record_store(STORAGE_BACKEND, DATA_FILE, DB_FILE, STATION)
+
+records_store = get_record_store()
 
 def load_data():
-    if os.path.exists(DATA_FILE):
-        try:
-            df = pd.read_csv(DATA_FILE, parse_dates=['DOB'])
-            st.session_state['records'] = df.to_dict('records')
-        except Exception as e:
-            st.error(f"Error loading data: {str(e)}")
-            st.session_state['records'] = []
-
-def save_data():
+    # Only touches the disk when the data file or its journal changed
     try:
-        df = pd.DataFrame(st.session_state['records'])
-        df.to_csv(DATA_FILE, index=False)
+        with metrics.span("load_data", current_section) as span:
+            records_store.refresh()
+            if records_store.pending >= JOURNAL_COMPACT_THRESHOLD:
+                records_store.compact()
+            span.count(len(records_store))
+    except Exception as e:
+        st.error(f"Error loading data: {str(e)}")
+
+def save_data(unique_code, change):
+    # Append only the fields this save changed for one record; the shared
+    # records show them once they are on disk
+    try:
+        with metrics.span("save_data", current_section) as span:
+            span.wrote(records_store.update(unique_code, change))
+            span.count(1)
         return True
     except Exception as e:
         st.error(f"Failed to save data: {str(e)}")
@@ -50,29 +71,95 @@ def save_data():
 
 load_data()
 
-def calculate_bmi(weight, height):
-    if height > 0:
-        bmi = weight / (height ** 2)
-        if bmi < 18.5:
-            classification = "Underweight"
-        elif 18.5 <= bmi < 24.9:
-            classification = "Normal weight"
-        elif 25 <= bmi < 29.9:
-            classification = "Overweight"
-        else:
-            classification = "Obesity"
-        return round(bmi, 2), classification
-    return None, None
-
 def calculate_age(dob):
     today = datetime.today()
     age = today.year - dob.year - ((today.month, today.day) < (dob.month, dob.day))
     return age
 
+# Per-department Unique Code sequences, shared by all sessions and processes
+@st.cache_resource
+def get_id_allocator():
+    return SequenceAllocator.for_records(SEQUENCE_FILE, records_store)
+
+id_allocator = get_id_allocator()
+
+# Every saved reading is also appended to the measurement history
+@st.cache_resource
+def get_measurement_history():
+    return MeasurementHistory.for_records(HISTORY_FILE, records_store, STATION)
+
+records_store.history = get_measurement_history()
+
+# Every write gets a change sequence number, for the delta export
+@st.cache_resource
+def get_change_log():
+    return ChangeLog.for_records(CHANGES_FILE, records_store, STATION)
+
+records_store.change_log = get_change_log()
+
 def generate_unique_id(first_name, last_name, department_code):
     department_code = departments.get(department_code, "NA")
-    unique_id = f"{first_name[0].upper()}{last_name[0].upper()}{department_code}{str(len(st.session_state['records'])+1).zfill(4)}"
-    return unique_id
+    sequence = id_allocator.allocate(department_code)
+    return format_code(first_name, last_name, department_code, sequence)
+
+# Paged browsing for Data Export, sharing its sort orders across sessions
+@st.cache_resource
+def get_record_browser():
+    return browse.RecordBrowser(records_store)
+
+record_browser_index = get_record_browser()
+
+# Background SMS workers, started once per server process
+@st.cache_resource
+def get_notifier():
+    return notify.open_notifier(OUTBOX_FILE, SMS_TRANSPORT, SMS_WORKERS, SMS_PER_SECOND).start()
+
+notifier = get_notifier()
+
+def send_sms(record, body, dedup_key):
+    # Only queues the message; delivery happens on the worker threads
+    try:
+        notifier.notify(record.get('Phone Number'), body, dedup_key)
+    except Exception as e:
+        st.warning(f"⚠️ Could not queue SMS: {str(e)}")
+
+SEARCH_PAGE_SIZE = 20
+
+def search_patients(search_term):
+    # One page of ranked matches from the shared search index
+    with metrics.span("search", current_section) as span:
+        matches, total = records_store.search.search(search_term, page=0, page_size=SEARCH_PAGE_SIZE)
+        span.count(total)
+    if total > SEARCH_PAGE_SIZE:
+        pages = -(-total // SEARCH_PAGE_SIZE)
+        page = st.number_input(f"Page (of {pages}, {total} matches)",
+                               min_value=1, max_value=pages, value=1, step=1)
+        if page > 1:
+            matches, _ = records_store.search.search(search_term, page=page - 1,
+                                                     page_size=SEARCH_PAGE_SIZE)
+    return matches
+
+def select_patient(matches):
+    if len(matches) == 1:
+        return matches[0]
+    selected = st.selectbox("Select patient", range(len(matches)),
+                            format_func=lambda i: f"{matches[i]['First Name']} {matches[i]['Last Name']} ({matches[i]['Unique Code']})")
+    return matches[selected]
+
+def screening_cards(tallies, today):
+    # Running totals kept by the store, so these read a few counters
+    total, day = tallies.total(), tallies.day(today)
+    st.caption(f"Screened today ({today}) and since registration began")
+    cols = st.columns(6)
+    cols[0].metric("Registered", f"{total['Records']:,}", f"{day['Records']:,} today")
+    for col, measure in zip(cols[1:], ['BP Screened', 'BMI Screened', 'Glucose Screened', 'Vision Screened']):
+        share = f" ({total[measure] / total['Records']:.0%})" if total['Records'] else ""
+        col.metric(measure, f"{total[measure]:,}{share}", f"{day[measure]:,} today")
+    cols[5].metric("Referred", f"{total['Referred']:,}", f"{day['Referred']:,} today")
+    cols = st.columns(len(risk.CONDITIONS))
+    for col, condition in zip(cols, risk.CONDITIONS):
+        col.metric(condition, f"{total[condition]:,}", f"{day[condition]:,} today",
+                   delta_color="inverse", help=f"Among {total[risk.SCREENED_BY[condition]]:,} screened")
 
 # Sidebar navigation
 st.sidebar.title("WRHD Medical Screening Tool")
@@ -83,8 +170,10 @@ section = st.sidebar.radio("Select Section", [
     "BMI", 
     "Visual Examination", 
     "General Assessment",
+    "Batch Entry",
+    "Screening Dashboard",
     "Data Export"
-])
+], key='section')
 
 # ========================
 # GENERAL INFORMATION SECTION
@@ -180,15 +269,33 @@ if section == "General Information":
         age = calculate_age(dob) if dob else None
         if age:
             st.write(f"**Age:** {age}")
+        register_anyway = st.checkbox("Register even if this person may already be registered")
         # Save button
         if st.form_submit_button("💾 Save Record", type="primary"):
-            if all([first_name, last_name, dob, sex, department]):
+            # Checked before a code is allocated, so a duplicate never uses one up
+            possible_duplicates = records_store.duplicates.find({
+                'Last Name': last_name, 'DOB': dob, 'Email': email, 'Phone Number': phone_number,
+            }) if all([first_name, last_name, dob, sex, department]) else {}
+            if possible_duplicates and not register_anyway:
+                st.warning("⚠️ This person may already be registered. Check the records below, or tick "
+                           "\"Register even if this person may already be registered\" and save again.")
+                matches = []
+                for code, reasons in possible_duplicates.items():
+                    match = records_store.get(code)
+                    matches.append({
+                        'Unique Code': code,
+                        'Name': f"{match.get('First Name')} {match.get('Last Name')}",
+                        'DOB': str(match.get('DOB'))[:10],
+                        'Department': match.get('Department'),
+                        'Matched On': ", ".join(reasons),
+                    })
+                st.dataframe(pd.DataFrame(matches), hide_index=True)
+            elif all([first_name, last_name, dob, sex, department]):
                 unique_code = generate_unique_id(first_name, last_name, department)
                 st.session_state.last_unique_code = unique_code
                 st.session_state.show_unique_code = True
                 st.session_state.unique_code_time = datetime.now()
                 try:
-                    unique_code = generate_unique_id(first_name, last_name, department)
                     new_record = {
                         'First Name': first_name.strip(),
                         'Middle Name': middle_name.strip(),
@@ -205,8 +312,8 @@ if section == "General Information":
                         'Unique Code': unique_code,
                         'Registration Date': datetime.today().strftime('%Y-%m-%d')
                     }
-                    st.session_state['records'].append(new_record)
-                    if save_data():
+                    if save_data(unique_code, new_record):
+                        send_sms(new_record, notify.code_message(unique_code), f"code:{unique_code}")
                         st.success(f"✅ Patient registered successfully! Unique Code: {unique_code}")
                         st.session_state['reset_form'] = True
                         st.rerun()
@@ -214,337 +321,425 @@ if section == "General Information":
                     st.error(f"❌ Error: {str(e)}")
                 else:
                     st.error("⚠️ Please fill all required fields (*)")
+
+    # Bulk pre-registration from a staff roster
+    with st.expander("📂 Bulk Roster Import"):
+        st.caption("CSV or .xlsx with columns: " + ", ".join(roster.REQUIRED_COLUMNS)
+                   + " (optional: " + ", ".join(roster.OPTIONAL_COLUMNS) + ")")
+        roster_file = st.file_uploader("Staff roster", type=["csv", "xlsx"])
+        if roster_file is not None and st.button("📥 Import Roster"):
+            try:
+                with metrics.span("roster_import", section) as span:
+                    imported, errors = roster.import_roster(roster.read_roster(roster_file),
+                                                            records_store, id_allocator)
+                    span.count(len(imported))
+                st.success(f"✅ Registered {len(imported)} staff from {roster_file.name}")
+                if imported:
+                    st.dataframe(pd.DataFrame(imported)[['Unique Code', 'First Name', 'Last Name', 'Department']])
+                if len(errors):
+                    st.warning(f"⚠️ {len(errors)} rows were not imported")
+                    st.dataframe(errors)
+                    st.download_button("📥 Download Error Report",
+                                       data=errors.to_csv(index=False).encode('utf-8'),
+                                       file_name="roster_errors.csv", mime="text/csv")
+            except Exception as e:
+                st.error(f"❌ Error importing roster: {str(e)}")
         
 # ========================
 # BLOOD PRESSURE SECTION
 # ========================
 elif section == "Blood Pressure":
     st.title("Blood Pressure")
-    search_term = st.text_input("🔍 Search by Name or Unique Code")
+
+    # Searching and saving rerun only this fragment, not the whole script
+    @st.fragment
+    def blood_pressure_entry():
+        load_data()  # fragment reruns skip the module-level refresh
+        search_term = st.text_input("🔍 Search by Name or Unique Code")
     
-    if search_term:
-        matches = [
-            r for r in st.session_state['records']
-            if (search_term.lower() in f"{r.get('First Name', '')} {r.get('Last Name', '')}".lower() 
-                or search_term.lower() in str(r.get('Unique Code', '')).lower())
-        ]
+        if search_term:
+            matches = search_patients(search_term)
         
-        if matches:
-            record = matches[0]
-            st.write(f"Unique Code: {record['Unique Code']}")
+            if matches:
+                record = select_patient(matches)
+                st.write(f"Unique Code: {record['Unique Code']}")
             
-            st.subheader(f"Patient: {record['First Name']} {record['Last Name']}")
-            st.write(f"**Unique Code:** {record['Unique Code']} | **Age:** {record.get('Age', 'N/A')}")
+                st.subheader(f"Patient: {record['First Name']} {record['Last Name']}")
+                st.write(f"**Unique Code:** {record['Unique Code']} | **Age:** {record.get('Age', 'N/A')}")
             
-            with st.form("bp_form"):
-                col1, col2 = st.columns(2)
-                with col1:
-                    systolic = st.number_input("Systolic (mmHg)",  
-                                             value=0,
-                                             step=1)
-                with col2:
-                    diastolic = st.number_input("Diastolic (mmHg)", 
-                                              value=0,
-                                              step=1)
+                with st.form("bp_form"):
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        systolic = st.number_input("Systolic (mmHg)",  
+                                                 value=0,
+                                                 step=1)
+                    with col2:
+                        diastolic = st.number_input("Diastolic (mmHg)", 
+                                                  value=0,
+                                                  step=1)
                 
-                bp_notes = st.text_area("Clinical Notes")
+                    bp_notes = st.text_area("Clinical Notes")
                 
-                if st.form_submit_button("💾 Save Blood Pressure"):
-                    record['Blood Pressure'] = f"{systolic}/{diastolic}"
-                    record['BP Date'] = datetime.today().strftime('%Y-%m-%d')
-                    record['BP Notes'] = bp_notes
-                    if save_data():
-                        st.success(f"✅ Blood pressure saved: {systolic}/{diastolic} mmHg")
-                    else:
-                        st.error("❌ Failed to save blood pressure data")
-    else:
-        st.info("ℹ️ Please enter a patient name or unique code to search")
+                    if st.form_submit_button("💾 Save Blood Pressure"):
+                        if save_data(record['Unique Code'], {
+                                'Blood Pressure': f"{systolic}/{diastolic}",
+                                'BP Date': datetime.today().strftime('%Y-%m-%d'),
+                                'BP Notes': bp_notes}):
+                            st.success(f"✅ Blood pressure saved: {systolic}/{diastolic} mmHg")
+                        else:
+                            st.error("❌ Failed to save blood pressure data")
+        else:
+            st.info("ℹ️ Please enter a patient name or unique code to search")
+
+    blood_pressure_entry()
 
 # ========================
 # GENERAL ASSESSMENT SECTION
 # ========================
 elif section == "General Assessment":
     st.title("Comprehensive Patient Assessment")
-    search_term = st.text_input("🔍 Search by Name or Unique Code")
+    screening_cards(records_store.aggregates, datetime.today().strftime('%Y-%m-%d'))
+
+    # Searching and saving rerun only this fragment, not the whole script
+    @st.fragment
+    def assessment_entry():
+        load_data()  # fragment reruns skip the module-level refresh
+        search_term = st.text_input("🔍 Search by Name or Unique Code")
     
-    if search_term:
-        search_term = str(search_term).lower()
-        matches = [
-            r for r in st.session_state['records']
-            if (search_term in f"{r.get('First Name', '')} {r.get('Last Name', '')}".lower() 
-                or search_term in str(r.get('Unique Code', '')).lower())
-        ]
+        if search_term:
+            matches = search_patients(search_term)
         
-        if matches:
-            if len(matches) > 1:
-                selected = st.selectbox("Select patient", 
-                                      [f"{m['First Name']} {m['Last Name']} ({m['Unique Code']})" 
-                                       for m in matches])
-                record = matches[[f"{m['First Name']} {m['Last Name']} ({m['Unique Code']})" 
-                                for m in matches].index(selected)]
-            else:
-                record = matches[0]
+            if matches:
+                record = select_patient(matches)
+            
+                st.subheader(f"Patient: {record['First Name']} {record['Last Name']}")
+                st.write(f"**Unique Code:** {record['Unique Code']} | **Age:** {record.get('Age', 'N/A')}")
+            
+                # Display all data in expandable table
+                with st.expander("📋 View Complete Patient Record", expanded=True):
+                    # Filter out empty values
+                    display_data = {k: v for k, v in record.items() if v not in [None, ""]}
+                    st.table(pd.DataFrame.from_dict(display_data, orient='index', columns=['Value']))
             
-            st.subheader(f"Patient: {record['First Name']} {record['Last Name']}")
-            st.write(f"**Unique Code:** {record['Unique Code']} | **Age:** {record.get('Age', 'N/A')}")
+                # Latest reading of each type and the trend, from this patient's history rows
+                latest = records_store.history.latest(record['Unique Code'])
+                if latest:
+                    with st.expander("📈 Measurement History", expanded=True):
+                        st.dataframe(pd.DataFrame([
+                            {'Measurement': kind, 'Reading': history.describe(kind, values),
+                             'Measured At': values['Measured At'], 'Station': values['Station']}
+                            for kind, values in latest.items()]), hide_index=True)
+                        trend = records_store.history.trend(record['Unique Code'])
+                        if len(trend) > 1:
+                            st.line_chart(trend)
+                current = dict(record)
+                for values in latest.values():
+                    current.update({k: v for k, v in values.items() if k in risk.ASSESSMENT_COLUMNS and v is not None})
             
-            # Display all data in expandable table
-            with st.expander("📋 View Complete Patient Record", expanded=True):
-                # Filter out empty values
-                display_data = {k: v for k, v in record.items() if v not in [None, ""]}
-                st.table(pd.DataFrame.from_dict(display_data, orient='index', columns=['Value']))
+                # Risk assessment
+                with metrics.span("risk_factors", section):
+                    risk_factors, bp_invalid = risk.risk_factors(current)
+                if bp_invalid:
+                    st.error("Invalid Blood Pressure format. Expected 'systolic/diastolic'.")
+                if risk_factors:
+                    st.warning(f"🚨 Risk Factors Detected: {', '.join(risk_factors)}")
             
-            # Risk assessment
-risk_factors = []
-
-# Blood Pressure Risk
-if 'record' in locals() and record:
-    if 'Blood Pressure' in record:
-        try:
-            systolic, diastolic = map(int, record['Blood Pressure'].split('/'))
-            if systolic > 140 or diastolic > 90:
-                risk_factors.append("Hypertension")
-        except ValueError:
-            st.error("Invalid Blood Pressure format. Expected 'systolic/diastolic'.")
-# BMI Risk
-if 'record' in locals() and record is not None:
-    if 'BMI' in record:
-        bmi = record['BMI']
-        if bmi > 30:
-            risk_factors.append("Obesity")
-        elif 25 <= bmi < 30:
-            risk_factors.append("Overweight")
-# Blood Glucose Risk
-if 'record' in locals() and record is not None:
-    if 'Blood Glucose' in record and 'Fasting Status' in record:
-        glucose = record['Blood Glucose']
-        fasting_status = record['Fasting Status']
-
-        if fasting_status == "Fasting":
-            if 5.7 <= glucose <= 6.9:
-                risk_factors.append("Prediabetes (Fasting)")
-            elif glucose >= 7.0:
-                risk_factors.append("Diabetes (Fasting)")
-        elif fasting_status == "Random":
-            if 7.8 <= glucose <= 11.0:
-                risk_factors.append("Prediabetes (Random)")
-            elif glucose >= 11.1:
-                risk_factors.append("Diabetes (Random)")
-# Display Risk Factors
-if risk_factors:
-    st.warning(f"🚨 Risk Factors Detected: {', '.join(risk_factors)}")
+                # Assessment form
+                with st.form("assessment_form"):
+                    clinical_notes = st.text_area("Clinical Assessment Notes",
+                                                  value=record.get('Clinical Notes', ''))
+                    referred = st.checkbox("Refer to specialist",
+                                            value=record.get('Referred', False))
+                
+                    if referred:
+                        referral_details = st.text_input("Referral details",
+                                                         value=record.get('Referral Details', ''))
+                
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        if st.form_submit_button("💾 Save Assessment"):
+                            if save_data(record['Unique Code'], {'Clinical Notes': clinical_notes}):
+                                st.success("✅ Assessment saved successfully!")
+                    with col2:
+                        if st.form_submit_button("🚑 Refer Patient"):
+                            # The SMS is built from values read before the save;
+                            # the view may point at a replaced table after it
+                            patient = dict(record)
+                            change = {
+                                'Referred': True,
+                                'Referral Date': datetime.today().strftime('%Y-%m-%d'),
+                                'Referral Details': referral_details if referred else '',
+                            }
+                            if save_data(patient['Unique Code'], change):
+                                send_sms(patient, notify.referral_message(patient['First Name'], change['Referral Details']),
+                                         f"referral:{patient['Unique Code']}:{change['Referral Date']}")
+                                st.success("✅ Patient referred successfully!")
+                                st.balloons()
+            else:
+                st.warning("⚠️ No matching patients found")
+        else:
+            st.info("ℹ️ Please enter a patient name or unique code to search")
+
+    assessment_entry()
+
+# ========================
+# BATCH ENTRY SECTION
+# ========================
+elif section == "Batch Entry":
+    st.title("Batch Measurement Entry")
+    col1, col2 = st.columns(2)
+    with col1:
+        queue_department = st.selectbox("Department", ["All"] + list(departments.keys()))
+    with col2:
+        queue_date = st.date_input("Registration Date", value=datetime.today())
     
-    # Assessment form
-    with st.form("assessment_form"):
-        clinical_notes = st.text_area("Clinical Assessment Notes",
-                                      value=record.get('Clinical Notes', ''))
-        referred = st.checkbox("Refer to specialist",
-                                value=record.get('Referred', False))
-        
-        if referred:
-            referral_details = st.text_input("Referral details",
-                                             value=record.get('Referral Details', ''))
-        
-        col1, col2 = st.columns(2)
-        with col1:
-            if st.form_submit_button("💾 Save Assessment"):
-                record['Clinical Notes'] = clinical_notes
-                if save_data():
-                    st.success("✅ Assessment saved successfully!")
-        with col2:
-            if st.form_submit_button("🚑 Refer Patient"):
-                record['Referred'] = True
-                record['Referral Date'] = datetime.today().strftime('%Y-%m-%d')
-                record['Referral Details'] = referral_details if referred else ''
-                if save_data():
-                    st.success("✅ Patient referred successfully!")
-                    st.balloons()
-    if not matches:
-        st.warning("⚠️ No matching patients found")
+    queue = batch.queue(records_store.table,
+                        None if queue_department == "All" else queue_department,
+                        queue_date)
+    if queue.empty:
+        st.info("ℹ️ No patients in this queue")
     else:
-        st.info("ℹ️ Please enter a patient name or unique code to search")
+        if len(queue) == batch.QUEUE_LIMIT:
+            st.caption(f"Showing the first {batch.QUEUE_LIMIT} patients; narrow the filters to see more")
+        edited = st.data_editor(
+            queue,
+            key=f"batch_grid_{queue_department}_{queue_date}",
+            hide_index=True,
+            disabled=['Unique Code', 'Name', 'Department'],
+            column_config={
+                'Systolic': st.column_config.NumberColumn("Systolic (mmHg)", step=1),
+                'Diastolic': st.column_config.NumberColumn("Diastolic (mmHg)", step=1),
+                'Weight': st.column_config.NumberColumn("Weight (kg)", step=0.1),
+                'Height': st.column_config.NumberColumn("Height (m)", step=0.01),
+                'Blood Glucose': st.column_config.NumberColumn("Blood Glucose", step=0.1),
+                'Fasting Status': st.column_config.SelectboxColumn("Fasting Status", options=["Fasting", "Random"]),
+                'Visual Acuity Right': st.column_config.TextColumn("Right Eye (e.g., 6/6)"),
+                'Visual Acuity Left': st.column_config.TextColumn("Left Eye (e.g., 6/6)"),
+            },
+        )
+        
+        if st.button("💾 Save Batch", type="primary"):
+            changes, errors = batch.collect_changes(queue, edited, datetime.today().strftime('%Y-%m-%d'))
+            if len(errors):
+                st.error(f"❌ {len(errors)} rows need correcting; nothing was saved for them")
+                st.dataframe(errors, hide_index=True)
+            if changes:
+                try:
+                    with metrics.span("batch_save", section) as span:
+                        span.wrote(records_store.write_many(changes))
+                        span.count(len(changes))
+                    st.success(f"✅ Saved measurements for {len(changes)} patients")
+                except Exception as e:
+                    st.error(f"Failed to save data: {str(e)}")
+            elif not len(errors):
+                st.info("ℹ️ No changes to save")
+
+# ========================
+# SCREENING DASHBOARD SECTION
+# ========================
+elif section == "Screening Dashboard":
+    st.title("Screening Dashboard")
+    if not len(records_store):
+        st.warning("⚠️ No patient records found")
+        st.stop()
+    with metrics.span("risk_cohort", section):
+        tallies = records_store.aggregates
+        cohort = {
+            'overall': tallies.prevalence(),
+            'by_department': tallies.prevalence('Department'),
+            'by_age_band': tallies.prevalence('Age Band'),
+        }
+    overall = cohort['overall'].iloc[0]
+    
+    cols = st.columns(len(risk.CONDITIONS) + 1)
+    cols[0].metric("Registered", f"{int(overall['Records']):,}")
+    for col, condition in zip(cols[1:], risk.CONDITIONS):
+        rate = overall[f'{condition} %']
+        col.metric(condition, "–" if pd.isna(rate) else f"{rate}%",
+                   help=f"Among {int(overall[risk.SCREENED_BY[condition]]):,} screened")
+    
+    st.subheader("Prevalence by Department")
+    st.dataframe(cohort['by_department'])
+    st.bar_chart(cohort['by_department'][[f'{c} %' for c in risk.CONDITIONS]])
+    
+    st.subheader("Prevalence by Age Band")
+    st.dataframe(cohort['by_age_band'])
+    st.bar_chart(cohort['by_age_band'][[f'{c} %' for c in risk.CONDITIONS]])
 
 # ========================
 # BMI SECTION
 # ========================
 elif section == "BMI":
     st.title("BMI Calculation")
-    search_term = st.text_input("🔍 Search by Name or Unique Code")
+
+    # Searching and saving rerun only this fragment, not the whole script
+    @st.fragment
+    def bmi_entry():
+        load_data()  # fragment reruns skip the module-level refresh
+        search_term = st.text_input("🔍 Search by Name or Unique Code")
     
-    if search_term:
-        search_term = str(search_term).lower()
-        matches = [
-            r for r in st.session_state['records']
-            if (search_term in f"{r.get('First Name', '')} {r.get('Last Name', '')}".lower() 
-                or search_term in str(r.get('Unique Code', '')).lower())
-        ]
+        if search_term:
+            matches = search_patients(search_term)
         
-        if matches:
-            if len(matches) > 1:
-                selected = st.selectbox("Select patient", 
-                                      [f"{m['First Name']} {m['Last Name']} ({m['Unique Code']})" 
-                                       for m in matches])
-                record = matches[[f"{m['First Name']} {m['Last Name']} ({m['Unique Code']})" 
-                                for m in matches].index(selected)]
-            else:
-                record = matches[0]
+            if matches:
+                record = select_patient(matches)
             
-            st.subheader(f"Patient: {record['First Name']} {record['Last Name']}")
-            st.write(f"**Unique Code:** {record['Unique Code']} | **Age:** {record.get('Age', 'N/A')}")
+                st.subheader(f"Patient: {record['First Name']} {record['Last Name']}")
+                st.write(f"**Unique Code:** {record['Unique Code']} | **Age:** {record.get('Age', 'N/A')}")
             
-            with st.form("bmi_form"):
-                col1, col2 = st.columns(2)
-                with col1:
-                    weight = st.number_input("Weight (kg)", 
-                                           min_value=0.0, 
-                                           max_value=300.0, 
-                                           value=0.0,
-                                           step=0.1)
-                with col2:
-                    height = st.number_input("Height (m)", 
-                                            min_value=0.0, 
-                                            max_value=3.5, 
-                                            value=0.0,
-                                            step=0.01)
+                with st.form("bmi_form"):
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        weight = st.number_input("Weight (kg)", 
+                                               min_value=0.0, 
+                                               max_value=300.0, 
+                                               value=0.0,
+                                               step=0.1)
+                    with col2:
+                        height = st.number_input("Height (m)", 
+                                                min_value=0.0, 
+                                                max_value=3.5, 
+                                                value=0.0,
+                                                step=0.01)
                 
-                if weight > 0 and height > 0:
-                    bmi, classification = calculate_bmi(weight, height)
-                    st.metric("BMI", f"{bmi} ({classification})")
+                    if weight > 0 and height > 0:
+                        bmi, classification = calculate_bmi(weight, height)
+                        st.metric("BMI", f"{bmi} ({classification})")
                 
-                if st.form_submit_button("💾 Save BMI"):
-                    record['Weight'] = weight
-                    record['Height'] = height
-                    record['BMI'] = bmi
-                    record['BMI Classification'] = classification
-                    record['BMI Date'] = datetime.today().strftime('%Y-%m-%d')
-                    if save_data():
-                        st.success(f"✅ BMI {bmi} ({classification}) saved successfully!")
-                    else:
-                        st.error("❌ Failed to save BMI data")
+                    if st.form_submit_button("💾 Save BMI"):
+                        if save_data(record['Unique Code'], {
+                                'Weight': weight,
+                                'Height': height,
+                                'BMI': bmi,
+                                'BMI Classification': classification,
+                                'BMI Date': datetime.today().strftime('%Y-%m-%d')}):
+                            st.success(f"✅ BMI {bmi} ({classification}) saved successfully!")
+                        else:
+                            st.error("❌ Failed to save BMI data")
+            else:
+                st.warning("⚠️ No matching patients found")
         else:
-            st.warning("⚠️ No matching patients found")
-    else:
-        st.info("ℹ️ Please enter a patient name or unique code to search")
+            st.info("ℹ️ Please enter a patient name or unique code to search")
+
+    bmi_entry()
 
 # ========================
 # VISUAL EXAMINATION SECTION
 # ========================
 elif section == "Visual Examination":
     st.title("Visual Examination")
-    search_term = st.text_input("🔍 Search by Name or Unique Code")
+
+    # Searching and saving rerun only this fragment, not the whole script
+    @st.fragment
+    def visual_examination_entry():
+        load_data()  # fragment reruns skip the module-level refresh
+        search_term = st.text_input("🔍 Search by Name or Unique Code")
     
-    if search_term:
-        search_term = str(search_term).lower()
-        matches = [
-            r for r in st.session_state['records']
-            if (search_term in f"{r.get('First Name', '')} {r.get('Last Name', '')}".lower() 
-                or search_term in str(r.get('Unique Code', '')).lower())
-        ]
+        if search_term:
+            matches = search_patients(search_term)
         
-        if matches:
-            if len(matches) > 1:
-                selected = st.selectbox("Select patient", 
-                                      [f"{m['First Name']} {m['Last Name']} ({m['Unique Code']})" 
-                                       for m in matches])
-                record = matches[[f"{m['First Name']} {m['Last Name']} ({m['Unique Code']})" 
-                                for m in matches].index(selected)]
-            else:
-                record = matches[0]
+            if matches:
+                record = select_patient(matches)
             
-            st.subheader(f"Patient: {record['First Name']} {record['Last Name']}")
-            st.write(f"**Unique Code:** {record['Unique Code']} | **Age:** {record.get('Age', 'N/A')}")
+                st.subheader(f"Patient: {record['First Name']} {record['Last Name']}")
+                st.write(f"**Unique Code:** {record['Unique Code']} | **Age:** {record.get('Age', 'N/A')}")
             
-            with st.form("visual_exam_form"):
-                col1, col2 = st.columns(2)
-                with col1:
-                    right_eye = st.text_input("Right Eye (e.g., 6/6)",
-                                             value=record.get('Visual Acuity Right', ''))
-                with col2:
-                    left_eye = st.text_input("Left Eye (e.g., 6/6)",
-                                            value=record.get('Visual Acuity Left', ''))
+                with st.form("visual_exam_form"):
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        right_eye = st.text_input("Right Eye (e.g., 6/6)",
+                                                 value=record.get('Visual Acuity Right', ''))
+                    with col2:
+                        left_eye = st.text_input("Left Eye (e.g., 6/6)",
+                                                value=record.get('Visual Acuity Left', ''))
                 
-                st.subheader("Visual Acuity with Glasses")
-                col3, col4 = st.columns(2)
-                with col3:
-                    right_eye_glasses = st.text_input("Right Eye with Glasses (e.g., 6/6)",
-                                                      value=record.get('Right Eye with Glasses', ''))
-                with col4:
-                    left_eye_glasses = st.text_input("Left Eye with Glasses (e.g., 6/6)",
-                                                     value=record.get('Left Eye with Glasses', ''))
+                    st.subheader("Visual Acuity with Glasses")
+                    col3, col4 = st.columns(2)
+                    with col3:
+                        right_eye_glasses = st.text_input("Right Eye with Glasses (e.g., 6/6)",
+                                                          value=record.get('Right Eye with Glasses', ''))
+                    with col4:
+                        left_eye_glasses = st.text_input("Left Eye with Glasses (e.g., 6/6)",
+                                                         value=record.get('Left Eye with Glasses', ''))
                 
-                visualexamination_notes = st.text_area("Visual Examination Notes", 
-                                              value=record.get('Clinical Notes', ''))
+                    visualexamination_notes = st.text_area("Visual Examination Notes", 
+                                                  value=record.get('Clinical Notes', ''))
                 
-                refer_specialist = st.checkbox("Refer to Specialist", 
-                                              value=record.get('Referred', False))
+                    refer_specialist = st.checkbox("Refer to Specialist", 
+                                                  value=record.get('Referred', False))
                 
-                if st.form_submit_button("💾 Save Visual Examination"):
-                    record['Visual Acuity Right'] = right_eye
-                    record['Visual Acuity Left'] = left_eye
-                    record['Right Eye with Glasses'] = right_eye_glasses
-                    record['Left Eye with Glasses'] = left_eye_glasses
-                    record['Vision Test Date'] = datetime.today().strftime('%Y-%m-%d')
-                    record['Visual Examination Notes'] = visualexamination_notes
-                    record['Referred'] = refer_specialist
-                    if refer_specialist:
-                        record['Referral Date'] = datetime.today().strftime('%Y-%m-%d')
-                    if save_data():
-                        st.success("✅ Visual examination saved successfully!")
-                    else:
-                        st.error("❌ Failed to save visual examination data")
+                    if st.form_submit_button("💾 Save Visual Examination"):
+                        patient = dict(record)
+                        change = {
+                            'Visual Acuity Right': right_eye,
+                            'Visual Acuity Left': left_eye,
+                            'Right Eye with Glasses': right_eye_glasses,
+                            'Left Eye with Glasses': left_eye_glasses,
+                            'Vision Test Date': datetime.today().strftime('%Y-%m-%d'),
+                            'Visual Examination Notes': visualexamination_notes,
+                            'Referred': refer_specialist,
+                        }
+                        if refer_specialist:
+                            change['Referral Date'] = datetime.today().strftime('%Y-%m-%d')
+                        if save_data(patient['Unique Code'], change):
+                            if refer_specialist:
+                                send_sms(patient, notify.referral_message(patient['First Name']),
+                                         f"referral:{patient['Unique Code']}:{change['Referral Date']}")
+                            st.success("✅ Visual examination saved successfully!")
+                        else:
+                            st.error("❌ Failed to save visual examination data")
+            else:
+                st.warning("⚠️ No matching patients found")
         else:
-            st.warning("⚠️ No matching patients found")
-    else:
-        st.info("ℹ️ Please enter a patient name or unique code to search")
+            st.info("ℹ️ Please enter a patient name or unique code to search")
+
+    visual_examination_entry()
+
 # ========================
 # BLOOD GLUCOSE SECTION
 # ========================
 elif section == "Blood Glucose":
     st.title("Blood Glucose")
-    search_term = st.text_input("🔍 Search by Name or Unique Code")
+
+    # Searching and saving rerun only this fragment, not the whole script
+    @st.fragment
+    def glucose_entry():
+        load_data()  # fragment reruns skip the module-level refresh
+        search_term = st.text_input("🔍 Search by Name or Unique Code")
     
-    if search_term:
-        search_term = str(search_term).lower()
-        matches = [
-            r for r in st.session_state['records']
-            if (search_term in f"{r.get('First Name', '')} {r.get('Last Name', '')}".lower() 
-                or search_term in str(r.get('Unique Code', '')).lower())
-        ]
-        if matches:
-            if len(matches) > 1:
-                selected = st.selectbox("Select patient", 
-                                      [f"{m['First Name']} {m['Last Name']} ({m['Unique Code']})" 
-                                       for m in matches])
-                record = matches[[f"{m['First Name']} {m['Last Name']} ({m['Unique Code']})" 
-                                for m in matches].index(selected)]
-            else:
-                record = matches[0]
+        if search_term:
+            matches = search_patients(search_term)
+            if matches:
+                record = select_patient(matches)
             
-            st.subheader(f"Patient: {record['First Name']} {record['Last Name']}")
-            st.write(f"**Unique Code:** {record['Unique Code']} | **Age:** {record.get('Age', 'N/A')}")
+                st.subheader(f"Patient: {record['First Name']} {record['Last Name']}")
+                st.write(f"**Unique Code:** {record['Unique Code']} | **Age:** {record.get('Age', 'N/A')}")
             
-            with st.form("glucose_form"):
-                glucose = st.number_input("Blood Glucose (mg/dL)", 
-                                        value=0.0,
-                                        step=0.1,
-                                        format="%.1f")
+                with st.form("glucose_form"):
+                    glucose = st.number_input(f"Blood Glucose ({GLUCOSE_UNIT})", 
+                                            value=0.0,
+                                            step=0.1,
+                                            format="%.1f")
                 
-                fasting = st.radio("Fasting Status",
-                                  ["Fasting", "Random"],
-                                  index=0 if record.get('Fasting Status') == "Fasting" else 1)
+                    fasting = st.radio("Fasting Status",
+                                      ["Fasting", "Random"],
+                                      index=0 if record.get('Fasting Status') == "Fasting" else 1)
                 
-                if st.form_submit_button("💾 Save Glucose Reading"):
-                    record['Blood Glucose'] = glucose
-                    record['Glucose Date'] = datetime.today().strftime('%Y-%m-%d')
-                    record['Fasting Status'] = fasting
-                    if save_data():
-                        st.success(f"✅ Glucose level {glucose} mg/dL ({fasting}) saved!")
-                    else:
-                        st.error("❌ Failed to save glucose data")
+                    if st.form_submit_button("💾 Save Glucose Reading"):
+                        if save_data(record['Unique Code'], {
+                                'Blood Glucose': glucose,
+                                'Glucose Date': datetime.today().strftime('%Y-%m-%d'),
+                                'Fasting Status': fasting}):
+                            st.success(f"✅ Glucose level {glucose} {GLUCOSE_UNIT} ({fasting}) saved!")
+                        else:
+                            st.error("❌ Failed to save glucose data")
+            else:
+                st.warning("⚠️ No matching patients found")
         else:
-            st.warning("⚠️ No matching patients found")
-    else:
-        st.info("ℹ️ Please enter a patient name or unique code to search")
+            st.info("ℹ️ Please enter a patient name or unique code to search")
+
+    glucose_entry()
+
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
@@ -606,27 +801,221 @@ elif section == "Data Export":
             st.info("Logged out successfully!")
             st.stop()
 
-        if st.session_state['records']:
-            st.success(f"ℹ️ Found {len(st.session_state['records'])} patient records")
+        if len(records_store):
+            st.success(f"ℹ️ Found {len(records_store)} patient records")
 
-            # Show sample data
-            st.subheader("Sample Data")
-            st.dataframe(pd.DataFrame(st.session_state['records']).head())
+            st.subheader("Screening Summary")
+            today = datetime.today().strftime('%Y-%m-%d')
+            screening_cards(records_store.aggregates, today)
+            st.dataframe(pd.DataFrame([dict(records_store.aggregates.day(today, department), Department=department)
+                                       for department in departments]).set_index('Department'))
 
-            # Export options
+            # Filtering, sorting and paging rerun only this fragment and
+            # only the rows on the page are read out of the table
+            @st.fragment
+            def record_browser():
+                load_data()
+                st.subheader("Browse Records")
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    browse_departments = st.multiselect("Department", list(departments.keys()), key="browse_departments")
+                    browse_sexes = st.multiselect("Sex", ["Male", "Female", "Other"], key="browse_sexes")
+                with col2:
+                    browse_ages = st.multiselect("Age Band", risk.AGE_BANDS, key="browse_ages")
+                    browse_risks = st.multiselect("Risk Category", risk.CONDITIONS, key="browse_risks")
+                with col3:
+                    browse_from = st.date_input("Registered From", value=None, key="browse_from")
+                    browse_to = st.date_input("Registered To", value=None, key="browse_to")
+                browse_filters = {
+                    'departments': browse_departments,
+                    'sexes': browse_sexes,
+                    'age_bands': browse_ages,
+                    'start': browse_from,
+                    'end': browse_to,
+                    'referred': st.radio("Referred", browse.REFERRED, horizontal=True, key="browse_referred"),
+                    'risk_categories': browse_risks,
+                }
+                col_sort, col_order, col_page = st.columns(3)
+                sort_by = col_sort.selectbox("Sort By", ["Registration order"] + browse.BROWSE_COLUMNS, key="browse_sort")
+                descending = col_order.checkbox("Descending", key="browse_descending")
+                with metrics.span("browse", section) as span:
+                    total = record_browser_index.count(**browse_filters)
+                    pages = max(1, -(-total // browse.PAGE_SIZE))
+                    if st.session_state.get("browse_page", 1) > pages:
+                        st.session_state["browse_page"] = pages
+                    page = col_page.number_input(f"Page (of {pages})", min_value=1, max_value=pages,
+                                                 value=1, step=1, key="browse_page")
+                    rows, total = record_browser_index.page(
+                        page - 1, sort_by=None if sort_by == "Registration order" else sort_by,
+                        descending=descending, **browse_filters)
+                    span.count(len(rows))
+                st.caption(f"{total} matching records")
+                st.dataframe(rows, hide_index=True)
+
+                # One result slip per matching participant, rendered by a
+                # pool of worker processes into a zip in an unnamed temporary
+                # file; the session holds it open, so the disk space is freed
+                # when it is replaced or the session ends
+                slip_formats = st.multiselect("Result Slip Formats", list(reports.FORMATS),
+                                              default=list(reports.FORMATS), key="slip_formats")
+                if st.button(f"🧾 Generate result slips for {total} records", disabled=not total or not slip_formats):
+                    matching = record_browser_index.mask(**browse_filters).nonzero()[0]
+                    bar = st.progress(0.0, text="Generating result slips...")
+                    out = tempfile.TemporaryFile()
+                    try:
+                        with metrics.span("result_slips", section) as span:
+                            reports.generate(records_store.table, matching, out, slip_formats,
+                                             progress=lambda done, n: bar.progress(done / n, text=f"{done}/{n} result slips"))
+                            span.wrote(out.tell())
+                    except BaseException:
+                        out.close()
+                        raise
+                    old_slips = st.session_state.get("result_slips")
+                    if old_slips is not None:
+                        old_slips.close()
+                    st.session_state["result_slips"] = out
+                slips_file = st.session_state.get("result_slips")
+                if slips_file is not None:
+                    def slips_data():
+                        # Read only when the button is clicked
+                        slips_file.seek(0)
+                        return slips_file.read()
+
+                    st.download_button("📥 Download result slips", slips_data, file_name="result_slips.zip",
+                                       mime="application/zip")
+
+            record_browser()
+
+            # Export filters, applied chunk by chunk before serialization
             st.subheader("Export Data")
-            csv = pd.DataFrame(st.session_state['records']).to_csv(index=False).encode('utf-8')
+            col1, col2 = st.columns(2)
+            with col1:
+                export_departments = st.multiselect("Department", list(departments.keys()))
+                export_risks = st.multiselect("Risk Category", risk.CONDITIONS)
+                export_format = st.radio("Format", list(export.FORMATS.keys()), horizontal=True)
+            with col2:
+                registered_from = st.date_input("Registered From", value=None)
+                registered_to = st.date_input("Registered To", value=None)
+            export_filters = {
+                'departments': export_departments,
+                'start': registered_from,
+                'end': registered_to,
+                'risk_categories': export_risks,
+            }
+
+            extension, mime = export.FORMATS[export_format]
+            table = records_store.table
+
+            def export_file():
+                # Runs on a separate thread when the button is clicked
+                out = tempfile.TemporaryFile()
+                with metrics.span("export", "Data Export") as span:
+                    export.write_export(table, export_format, out, **export_filters)
+                    span.wrote(out.tell())
+                out.seek(0)
+                return out
 
             st.download_button(
-                label="📥 Download CSV",
-                data=csv,
-                file_name="medical_records.csv",
-                mime="text/csv"
+                label=f"📥 Download {export_format}",
+                data=export_file,
+                file_name=f"medical_records.{extension}",
+                mime=mime
             )
 
+            # Only what changed after the watermark of the previous pull
+            with st.expander("🔄 Changes Since Last Sync"):
+                latest_change = records_store.change_log.watermark()
+                col1, col2 = st.columns(2)
+                with col1:
+                    since = st.number_input("Changes after sequence", min_value=0, max_value=latest_change,
+                                            value=0, step=1)
+                    fields_only = st.checkbox("Changed fields only")
+                with col2:
+                    delta_format = st.radio("Format", list(export.DELTA_FORMATS.keys()), horizontal=True,
+                                            key="delta_format")
+                st.caption(f"Latest change sequence: {latest_change}. The highest {export.SEQ_COLUMN} "
+                           "in a download is the sequence to start the next pull after.")
+                delta_extension, delta_mime = export.DELTA_FORMATS[delta_format]
+
+                def delta_file():
+                    # Runs on a separate thread when the button is clicked
+                    out = tempfile.TemporaryFile()
+                    with metrics.span("delta_export", "Data Export") as span:
+                        records_store.refresh()  # holds every change up to latest_change
+                        written, _ = export.write_delta(records_store.table, records_store.change_log, since,
+                                                        delta_format, out, fields_only, latest_change)
+                        span.count(written)
+                        span.wrote(out.tell())
+                    out.seek(0)
+                    return out
+
+                st.download_button(
+                    label=f"📥 Download changes {since + 1}-{latest_change}",
+                    data=delta_file,
+                    file_name=f"medical_records_changes_{since + 1}-{latest_change}.{delta_extension}",
+                    mime=delta_mime,
+                    disabled=since >= latest_change,
+                )
+
+            sms = notifier.outbox.counts()
+            st.caption(f"📨 SMS: {sms.get('pending', 0) + sms.get('sending', 0)} queued, "
+                       f"{sms.get('sent', 0)} sent, {sms.get('failed', 0)} failed")
+
+            # Latency percentiles of this server process since it started
+            with st.expander("⏱️ Performance"):
+                if metrics.registry.enabled:
+                    st.dataframe(metrics.registry.summary(), hide_index=True)
+                    st.caption(f"Prometheus metrics are written to {METRICS_FILE}")
+                else:
+                    st.info("ℹ️ Instrumentation is off (WRHD_METRICS=0)")
+
+            # Likely duplicate registrations across all records
+            with st.expander("🔍 Duplicate Registrations"):
+                if st.button("Find Duplicates"):
+                    with metrics.span("duplicate_report", section) as span:
+                        duplicates = dedup.duplicate_report(records_store.table)
+                        span.count(len(records_store))
+                    if len(duplicates):
+                        st.warning(f"⚠️ {len(duplicates)} possible duplicate pairs")
+                        st.dataframe(duplicates, hide_index=True)
+                        st.download_button("📥 Download Duplicate Report",
+                                           duplicates.to_csv(index=False),
+                                           file_name="duplicate_registrations.csv", mime="text/csv")
+                    else:
+                        st.success("✅ No likely duplicates found")
+
+            # Journals from offline stations, merged field by field by timestamp
+            with st.expander("🔀 Merge Station Journals"):
+                st.caption("Upload each station's medical_records.csv.journal (and .journal.archive, "
+                           "if it has one); a station's medical_records.csv is accepted too")
+                station_files = st.file_uploader("Station journals", accept_multiple_files=True)
+                if station_files and st.button("🔀 Merge"):
+                    try:
+                        with metrics.span("merge", section) as span:
+                            summary, renumbered = merge.merge(records_store, [(f.name, f) for f in station_files],
+                                                              id_allocator, merge.CodeMap(MERGE_FILE))
+                            span.count(summary['entries'])
+                        st.success(f"✅ Merged {summary['entries']} changes from {summary['files']} files: "
+                                   f"{summary['records added']} new records, {summary['records changed']} changed")
+                        st.json(summary)
+                        if len(renumbered):
+                            st.warning(f"⚠️ {len(renumbered)} codes were already in use and were renumbered; "
+                                       "tell these patients their new code")
+                            st.dataframe(renumbered, hide_index=True)
+                            st.download_button("📥 Download Renumbered Codes", renumbered.to_csv(index=False),
+                                               file_name="renumbered_codes.csv", mime="text/csv")
+                    except Exception as e:
+                        st.error(f"❌ Merge failed: {str(e)}")
+
             if st.button("🔄 Refresh Data"):
                 load_data()
                 st.rerun()
+
+            if st.button("🗜️ Compact Data File"):
+                folded = records_store.compact()
+                st.success(f"✅ Data file compacted ({folded} journal entries folded)")
         else:
             st.warning("⚠️ No patient records found")
  
+
+rerun_span.finish()
@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+
+import risk
+from measurements import calculate_bmis
+
+# Screening-day batch entry: the day's queue as one editable grid, and the
+# edits turned into per-record field changes with column-wise validation.
+QUEUE_LIMIT = 500
+GRID_COLUMNS = [
+    'Unique Code', 'Name', 'Department',
+    'Systolic', 'Diastolic', 'Weight', 'Height',
+    'Blood Glucose', 'Fasting Status',
+    'Visual Acuity Right', 'Visual Acuity Left',
+]
+EDITABLE_COLUMNS = GRID_COLUMNS[3:]
+ACUITY_PATTERN = r"^\s*\d+\s*/\s*\d+\s*$"
+
+
+def queue(table, department=None, registered_on=None, limit=QUEUE_LIMIT):
+    # Filter on the two typed columns first, then build only the queue rows
+    keys = table.frame(['Department', 'Registration Date'])
+    mask = pd.Series(True, index=keys.index)
+    if department:
+        mask &= (keys['Department'] == department).astype(bool)
+    if registered_on:
+        mask &= (keys['Registration Date'] == pd.Timestamp(registered_on)).to_numpy()
+    rows = np.flatnonzero(mask.to_numpy())[:limit]
+    df = table.frame(list(dict.fromkeys(
+        ['Unique Code', 'First Name', 'Last Name', 'Department', 'Blood Pressure']
+        + EDITABLE_COLUMNS[2:])), rows)
+    bp = risk.parse_bp(df['Blood Pressure'])
+    for c in ('First Name', 'Last Name', 'Department'):
+        df[c] = df[c].astype(object)
+    df['Name'] = df['First Name'].fillna('') + " " + df['Last Name'].fillna('')
+    df['Systolic'] = bp['Systolic']
+    df['Diastolic'] = bp['Diastolic']
+    for c in ('Weight', 'Height', 'Blood Glucose'):
+        df[c] = pd.to_numeric(df[c], errors='coerce')
+    for c in ('Fasting Status', 'Visual Acuity Right', 'Visual Acuity Left'):
+        df[c] = df[c].astype(object).where(df[c].notna(), None)
+    return df[GRID_COLUMNS].reset_index(drop=True)
+
+
+def _changed(original, edited, columns):
+    before, after = original[columns], edited[columns]
+    same = (before == after) | (before.isna() & after.isna())
+    return ~same.all(axis=1)
+
+
+def collect_changes(original, edited, today):
+    # Returns ([(unique_code, fields)], error report) for the rows that changed;
+    # today is one date for every row or a column of per-row dates
+    edited = edited.reset_index(drop=True).copy()
+    dates = today.reset_index(drop=True) if isinstance(today, pd.Series) else pd.Series(today, index=edited.index)
+    original = original.reset_index(drop=True)
+    for c in ('Systolic', 'Diastolic', 'Weight', 'Height', 'Blood Glucose'):
+        edited[c] = pd.to_numeric(edited[c], errors='coerce')
+    problems = []
+    fields = [dict() for _ in range(len(edited))]
+
+    bp = _changed(original, edited, ['Systolic', 'Diastolic'])
+    systolic, diastolic = edited['Systolic'], edited['Diastolic']
+    problems.append((bp & (systolic.isna() != diastolic.isna()), "Enter both systolic and diastolic"))
+    problems.append((bp & systolic.notna() & ~systolic.between(50, 300), "Systolic must be 50-300 mmHg"))
+    problems.append((bp & diastolic.notna() & ~diastolic.between(30, 200), "Diastolic must be 30-200 mmHg"))
+    problems.append((bp & (systolic <= diastolic), "Systolic must be above diastolic"))
+
+    bmi_change = _changed(original, edited, ['Weight', 'Height'])
+    weight, height = edited['Weight'], edited['Height']
+    problems.append((bmi_change & (weight.isna() != height.isna()), "Enter both weight and height"))
+    problems.append((bmi_change & weight.notna() & ~weight.between(0, 300, inclusive='right'), "Weight must be 0-300 kg"))
+    problems.append((bmi_change & height.notna() & ~height.between(0, 3.5, inclusive='right'), "Height must be 0-3.5 m"))
+    bmi, classification = calculate_bmis(weight, height)
+
+    glucose_change = _changed(original, edited, ['Blood Glucose', 'Fasting Status'])
+    glucose, fasting = edited['Blood Glucose'], edited['Fasting Status']
+    problems.append((glucose_change & glucose.notna() & ~glucose.between(0, 600, inclusive='right'), "Blood glucose must be above 0"))
+    problems.append((glucose_change & glucose.notna() & ~fasting.isin(["Fasting", "Random"]), "Choose a fasting status"))
+
+    vision_change = _changed(original, edited, ['Visual Acuity Right', 'Visual Acuity Left'])
+    for c in ('Visual Acuity Right', 'Visual Acuity Left'):
+        given = edited[c].fillna('').astype(str).str.strip() != ''
+        bad = given & ~edited[c].astype(str).str.match(ACUITY_PATTERN)
+        problems.append((vision_change & bad, f"{c} must look like 6/6"))
+
+    messages = pd.Series("", index=edited.index)
+    for mask, message in problems:
+        messages = messages.where(~mask.fillna(False).astype(bool), messages + "; " + message)
+    messages = messages.str.lstrip("; ")
+    failed = (messages != "").to_numpy()
+
+    bp, bmi_change, glucose_change, vision_change = (
+        m.to_numpy() & ~failed for m in (bp, bmi_change, glucose_change, vision_change))
+    for i in np.flatnonzero(bp):
+        fields[i].update({
+            'Blood Pressure': f"{int(systolic.iat[i])}/{int(diastolic.iat[i])}" if pd.notna(systolic.iat[i]) else None,
+            'BP Date': dates.iat[i],
+        })
+    for i in np.flatnonzero(bmi_change):
+        fields[i].update({
+            'Weight': float(weight.iat[i]), 'Height': float(height.iat[i]),
+            'BMI': None if np.isnan(bmi[i]) else float(bmi[i]),
+            'BMI Classification': classification[i], 'BMI Date': dates.iat[i],
+        })
+    for i in np.flatnonzero(glucose_change):
+        fields[i].update({
+            'Blood Glucose': None if pd.isna(glucose.iat[i]) else float(glucose.iat[i]), 'Fasting Status': fasting.iat[i], 'Glucose Date': dates.iat[i],
+        })
+    for i in np.flatnonzero(vision_change):
+        fields[i].update({
+            'Visual Acuity Right': edited['Visual Acuity Right'].iat[i],
+            'Visual Acuity Left': edited['Visual Acuity Left'].iat[i],
+            'Vision Test Date': dates.iat[i],
+        })
+
+    changes = [(code, f) for code, f in zip(edited['Unique Code'], fields) if f]
+    errors = pd.DataFrame({
+        'Unique Code': edited.loc[failed, 'Unique Code'],
+        'Name': edited.loc[failed, 'Name'],
+        'Errors': messages[failed],
+    }).reset_index(drop=True)
+    return changes, errors
@@ -0,0 +1,230 @@
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import export
+import risk
+from aggregates import ScreeningAggregates
+from ids import SequenceAllocator, format_code
+from measurements import calculate_bmis
+from search import SearchIndex
+from settings import departments, DATA_FILE, DB_FILE, SEQUENCE_FILE
+from storage import ShardedStorage, SqliteStorage
+from store import open_record_store
+
+# Headless benchmarks of the app's hot paths on synthetic records. Results
+# are JSON so a run can be compared with a stored baseline, e.g.
+#   python cli.py bench --sizes 1000 100000 --out bench.json
+#   python cli.py bench --sizes 1000 100000 --baseline bench.json
+DEFAULT_SIZES = [1000, 10000, 100000]
+TOLERANCE = 0.25
+# Differences below this are timer noise, never a regression
+MIN_SECONDS = 0.002
+FIRST_NAMES = ["Kofi", "Ama", "Kwame", "Akosua", "Yaw", "Abena", "Kojo", "Efua", "Kwesi", "Adwoa",
+               "John", "Mary", "Peter", "Grace", "Samuel", "Esther", "Daniel", "Ruth", "Joseph", "Hannah"]
+LAST_NAMES = ["Mensah", "Owusu", "Boateng", "Asante", "Osei", "Addo", "Appiah", "Agyeman", "Badu", "Quaye",
+              "Tetteh", "Ansah", "Darko", "Frimpong", "Amoah", "Nkrumah", "Sarpong", "Danso", "Ofori", "Bonsu"]
+JOB_TITLES = ["Officer", "Clerk", "Nurse", "Technician", "Manager", "Driver", "Inspector", "Analyst"]
+
+
+def synthetic_records(n, seed=0, today=None):
+    # Registrations plus screening results with roughly realistic spreads
+    rng = np.random.default_rng(seed)
+    today = pd.Timestamp(today or datetime.today()).normalize()
+    names = list(departments)
+    department = rng.choice(names, n)
+    first = rng.choice(FIRST_NAMES, n)
+    last = rng.choice(LAST_NAMES, n)
+    dob = today - pd.to_timedelta(rng.integers(20 * 365, 62 * 365, n), unit="D")
+    registered = today - pd.to_timedelta(rng.integers(0, 30, n), unit="D")
+    day = registered.strftime('%Y-%m-%d')
+
+    systolic = rng.normal(126, 17, n).clip(85, 220).round()
+    diastolic = np.minimum(rng.normal(80, 11, n).clip(50, 130).round(), systolic - 20)
+    has_bp = rng.random(n) < 0.85
+    height = rng.normal(1.66, 0.09, n).clip(1.4, 2.0).round(2)
+    bmi_target = rng.lognormal(np.log(26), 0.17, n)
+    weight = (bmi_target * height ** 2).round(1)
+    has_bmi = rng.random(n) < 0.8
+    bmi, classification = calculate_bmis(pd.Series(weight), pd.Series(height))
+    fasting = np.where(rng.random(n) < 0.6, "Fasting", "Random")
+    glucose = np.where(fasting == "Fasting", rng.lognormal(np.log(5.3), 0.18, n),
+                       rng.lognormal(np.log(6.6), 0.25, n)).round(1)
+    has_glucose = rng.random(n) < 0.7
+
+    codes = [format_code(f, l, departments[d], i + 1) for i, (f, l, d) in enumerate(zip(first, last, department))]
+    df = pd.DataFrame({
+        'Unique Code': codes,
+        'First Name': first,
+        'Middle Name': "",
+        'Last Name': last,
+        'DOB': dob,
+        'Age': ((today - dob).days // 365.25).astype(int),
+        'Sex': rng.choice(["Male", "Female", "Other"], n, p=[0.49, 0.49, 0.02]),
+        'Department': department,
+        'Job Title': rng.choice(JOB_TITLES, n),
+        'Email': [f"staff{i}@example.org" for i in range(n)],
+        'Phone Number': [f"+23320{i:07d}" for i in range(n)],
+        'Family History of Diabetes': rng.choice(["Yes", "No", "Don't Know"], n),
+        'Family History of Hypertension': rng.choice(["Yes", "No", "Don't Know"], n),
+        'Registration Date': day,
+    })
+    df['Blood Pressure'] = np.where(has_bp, pd.Series(systolic.astype(int)).astype(str) + "/"
+                                    + pd.Series(diastolic.astype(int)).astype(str), None)
+    df['BP Date'] = np.where(has_bp, day, None)
+    df['Weight'] = np.where(has_bmi, weight, np.nan)
+    df['Height'] = np.where(has_bmi, height, np.nan)
+    df['BMI'] = np.where(has_bmi, bmi, np.nan)
+    df['BMI Classification'] = np.where(has_bmi, classification, None)
+    df['BMI Date'] = np.where(has_bmi, day, None)
+    df['Blood Glucose'] = np.where(has_glucose, glucose, np.nan)
+    df['Glucose Date'] = np.where(has_glucose, day, None)
+    df['Fasting Status'] = np.where(has_glucose, fasting, None)
+    return df
+
+
+def write_dataset(df, directory, backend="csv"):
+    # Lays the records out the way the app finds them in its working directory
+    if backend == "sqlite":
+        SqliteStorage(os.path.join(directory, DB_FILE)).import_records(df.to_dict('records'))
+    elif backend == "sharded":
+        ShardedStorage(os.path.join(directory, DATA_FILE)).import_records(df.to_dict('records'))
+    else:
+        df.to_csv(os.path.join(directory, DATA_FILE), index=False)
+
+
+def _time(operation, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operation()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def _open_store(directory, backend):
+    store = open_record_store(backend, os.path.join(directory, DATA_FILE), os.path.join(directory, DB_FILE))
+    store.refresh()
+    return store
+
+
+def run_size(n, backend="csv", repeat=3, app=False, seed=0):
+    # Returns {operation: seconds per call} for one data size
+    df = synthetic_records(n, seed)
+    directory = tempfile.mkdtemp(prefix=f"wrhd-bench-{n}-")
+    write_dataset(df, directory, backend)
+    results = {}
+
+    results['load_data'] = _time(lambda: _open_store(directory, backend), repeat)
+    store = _open_store(directory, backend)
+
+    codes = df['Unique Code'].sample(50, random_state=seed, replace=n < 50).tolist()
+
+    def save():
+        for i, code in enumerate(codes):
+            record = store.get(code)
+            store.update(record['Unique Code'], {'BP Notes': f"bench {i}"})
+    results['save_data'] = _time(save, repeat) / len(codes)
+
+    # The store builds its index on first use; that is timed on its own so
+    # 'search' measures the lookups against a ready index
+    results['search_index_build'] = _time(lambda: SearchIndex(store.table.views()), repeat)
+    index = store.search
+    queries = [codes[0], codes[1][:4], FIRST_NAMES[3][:2], LAST_NAMES[5], f"{FIRST_NAMES[1]} {LAST_NAMES[2]}"[:9]]
+
+    def search():
+        # Without this every repeat after the first replays memoized rankings
+        index.clear_memo()
+        for q in queries:
+            index.search(q, page=0, page_size=20)
+    results['search'] = _time(search, repeat) / len(queries)
+
+    allocator = SequenceAllocator.for_records(os.path.join(directory, SEQUENCE_FILE), store)
+
+    def allocate():
+        for _ in range(100):
+            allocator.allocate("PH")
+    results['generate_unique_id'] = _time(allocate, repeat) / 100
+
+    record = store.get(codes[0])
+    results['risk_factors'] = _time(lambda: risk.risk_factors(record), repeat)
+    results['risk_cohort'] = _time(lambda: risk.assess(store.table.frame(risk.ASSESSMENT_COLUMNS)), repeat)
+    results['aggregates_rebuild'] = _time(lambda: ScreeningAggregates.from_table(store.table), repeat)
+    results['summary_cards'] = _time(lambda: store.aggregates.prevalence('Department'), repeat)
+
+    def export_csv():
+        with tempfile.TemporaryFile() as out:
+            export.write_export(store.table, "CSV", out)
+    results['export_csv'] = _time(export_csv, repeat)
+
+    if app:
+        results.update(_run_app(directory, codes[0], repeat))
+    return results
+
+
+def _run_app(directory, code, repeat):
+    # Full script runs through Streamlit's headless test harness
+    import streamlit as st
+    from streamlit.testing.v1 import AppTest
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        def cold():
+            st.cache_resource.clear()
+            st.cache_data.clear()
+            AppTest.from_file(script, default_timeout=600).run()
+        results = {'app_cold_start': _time(cold, repeat)}
+
+        at = AppTest.from_file(script, default_timeout=600).run()
+        at.sidebar.radio[0].set_value("General Assessment").run()
+
+        def lookup():
+            at.text_input[0].input(code).run()
+            at.text_input[0].input("").run()
+        results['app_patient_lookup'] = _time(lookup, repeat) / 2
+        return results
+    finally:
+        os.chdir(cwd)
+
+
+def run(sizes=DEFAULT_SIZES, backend="csv", repeat=3, app=False):
+    return {
+        'created': datetime.now().isoformat(timespec="seconds"),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'backend': backend,
+        'repeat': repeat,
+        'results': {str(n): run_size(n, backend, repeat, app) for n in sizes},
+    }
+
+
+def compare(current, baseline, tolerance=TOLERANCE):
+    # Returns (rows, regressions); a row is (size, operation, baseline, current)
+    rows = []
+    regressions = []
+    for size, operations in current['results'].items():
+        for operation, seconds in operations.items():
+            before = baseline.get('results', {}).get(size, {}).get(operation)
+            rows.append((size, operation, before, seconds))
+            if before is not None and seconds > before * (1 + tolerance) and seconds - before > MIN_SECONDS:
+                regressions.append(rows[-1])
+    return rows, regressions
+
+
+def save(results, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+
+def load(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
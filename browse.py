@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import aggregates
+import risk
+
+# Paged record browser for Data Export. Filters are masks over the
+# table's typed column arrays (category codes, int16 ages, int32 day
+# numbers), the row count is the mask's popcount, and sorting uses a
+# permutation cached per data version and column. Only the rows on the
+# page being shown are ever turned into Python objects.
+PAGE_SIZE = 50
+BROWSE_COLUMNS = [
+    'Unique Code', 'First Name', 'Last Name', 'Sex', 'Age', 'Department', 'Job Title',
+    'Registration Date', 'Blood Pressure', 'BMI', 'Blood Glucose', 'Referred',
+]
+REFERRED = ["Any", "Yes", "No"]
+CACHED_ORDERS = 8
+
+
+def _days(value):
+    return pd.Timestamp(value).to_datetime64().astype("datetime64[D]").astype(np.int64)
+
+
+class RecordBrowser:
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._orders = OrderedDict()  # (version, column, descending) -> row permutation
+        self._risk = (None, None)  # (version, {condition: mask})
+
+    def _category(self, table, name, values, size):
+        column = table.columns[name]
+        codes = [column.lookup[v] for v in values if v in column.lookup]
+        return np.isin(column.data[:size], codes)
+
+    def _risk_flags(self, table, size):
+        version = self.store.version
+        if self._risk[0] != version:
+            flags = aggregates.condition_flags(table, np.arange(size))
+            self._risk = (version, flags)
+        return self._risk[1]
+
+    def mask(self, departments=None, sexes=None, age_bands=None, start=None, end=None,
+             referred="Any", risk_categories=None):
+        table = self.store.table
+        size = len(table)
+        mask = np.ones(size, dtype=bool)
+        if departments:
+            mask &= self._category(table, 'Department', departments, size)
+        if sexes:
+            mask &= self._category(table, 'Sex', sexes, size)
+        if age_bands:
+            age = table.columns['Age'].data[:size]
+            in_band = np.zeros(size, dtype=bool)
+            for band in age_bands:
+                i = risk.AGE_BANDS.index(band)
+                low, high = risk.AGE_BINS[i], risk.AGE_BINS[i + 1]
+                in_band |= (age >= max(low, 0)) & (age < min(high, np.iinfo(np.int16).max))
+            mask &= in_band
+        if start is not None or end is not None:
+            day = table.columns['Registration Date'].data[:size]
+            if start is not None:
+                mask &= day >= _days(start)
+            if end is not None:
+                mask &= (day <= _days(end)) & (day != table.columns['Registration Date'].MISSING)
+        if referred != "Any":
+            flag = table.columns['Referred'].data[:size]
+            mask &= (flag == 1) if referred == "Yes" else (flag != 1)
+        if risk_categories:
+            flags = self._risk_flags(table, size)
+            mask &= np.logical_or.reduce([flags[c] for c in risk_categories])
+        return mask
+
+    def _order(self, column, descending):
+        # Row permutation for one sort; unset values always go last
+        key = (self.store.version, column, descending)
+        with self._lock:
+            order = self._orders.get(key)
+            if order is not None:
+                self._orders.move_to_end(key)
+                return order
+        table = self.store.table
+        keys = table.columns[column].sort_keys(np.arange(len(table)))
+        keys = np.where(np.isnan(keys), np.inf, -keys if descending else keys)
+        order = np.argsort(keys, kind='stable')
+        with self._lock:
+            self._orders[key] = order
+            while len(self._orders) > CACHED_ORDERS:
+                self._orders.popitem(last=False)
+        return order
+
+    def page(self, page=0, page_size=PAGE_SIZE, sort_by=None, descending=False, columns=BROWSE_COLUMNS, **filters):
+        # Returns (frame of one page, total matching rows)
+        mask = self.mask(**filters)
+        if sort_by:
+            order = self._order(sort_by, descending)
+            if len(order) != len(mask):
+                # Records were added between the mask and the sort
+                order = np.concatenate([order[order < len(mask)], np.arange(len(order), len(mask))])
+            matching = order[mask[order]]
+        else:
+            matching = np.flatnonzero(mask)
+        rows = matching[page * page_size:(page + 1) * page_size]
+        return self.store.table.frame(columns, rows), len(matching)
+
+    def count(self, **filters):
+        return int(np.count_nonzero(self.mask(**filters)))
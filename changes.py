@@ -0,0 +1,104 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+KEY = "Unique Code"
+
+# Change sequence for the nightly sync with the health-information office.
+# Every write that goes through RecordStore (registrations, section saves,
+# batch entry, device readings, roster imports, station merges) adds one
+# row per record here after the write itself is on disk. SQLite hands the
+# sequence numbers out in commit order whichever process writes, so a
+# reader that has seen change N has seen every change before it. Rows name
+# the fields a change touched; a delta export reads the records' current
+# values for them, so its cost follows the day's activity instead of the
+# size of the dataset.
+
+
+class ChangeLog:
+    def __init__(self, path, station=""):
+        self.path = path
+        self.station = station
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                unique_code TEXT NOT NULL,
+                fields_json TEXT,
+                changed_at TEXT NOT NULL,
+                station TEXT)""")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @classmethod
+    def for_records(cls, path, store, station=""):
+        # A new log starts with every existing record as one whole-record
+        # change, so a sync from watermark 0 gets the full dataset
+        log = cls(path, station)
+        log.seed(list(store.by_code))
+        return log
+
+    def seed(self, codes):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            seeded = 0
+            if conn.execute("SELECT 1 FROM changes LIMIT 1").fetchone() is None:
+                changed_at = datetime.now().isoformat(timespec="milliseconds")
+                conn.executemany("INSERT INTO changes (unique_code, fields_json, changed_at, station) "
+                                 "VALUES (?, NULL, ?, 'import')", ((code, changed_at) for code in codes))
+                seeded = len(codes)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return seeded
+
+    def add_changes(self, changes, changed_at=None):
+        # changes: (unique_code, {field: value}) pairs as written; returns
+        # the sequence of the last one
+        changed_at = changed_at or datetime.now().isoformat(timespec="milliseconds")
+        return self.add_entries({KEY: code, "ts": changed_at, "fields": fields} for code, fields in changes)
+
+    def add_entries(self, entries):
+        # Journal-style entries; a merged one keeps its own time and station
+        rows = [(entry[KEY], json.dumps(sorted(entry.get("fields", {})), ensure_ascii=False),
+                 entry.get("ts") or datetime.now().isoformat(timespec="milliseconds"),
+                 entry.get("station") or self.station) for entry in entries]
+        if not rows:
+            return self.watermark()
+        with self._connect() as conn:
+            conn.executemany("INSERT INTO changes (unique_code, fields_json, changed_at, station) "
+                             "VALUES (?, ?, ?, ?)", rows)
+            return conn.execute("SELECT MAX(seq) FROM changes").fetchone()[0]
+
+    def watermark(self):
+        # Sequence of the newest change, 0 if there is none
+        return self._connect().execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def since(self, watermark, upto=None):
+        # (seq, unique_code, fields or None for the whole record) after the
+        # watermark, oldest first
+        upto = self.watermark() if upto is None else upto
+        rows = self._connect().execute(
+            "SELECT seq, unique_code, fields_json FROM changes WHERE seq > ? AND seq <= ? ORDER BY seq",
+            (watermark, upto))
+        for seq, code, fields in rows:
+            yield seq, code, None if fields is None else json.loads(fields)
+
+    def changed(self, watermark, upto=None):
+        # {unique_code: (latest seq, set of fields or None)} after the
+        # watermark, in the order the records last changed
+        changed = {}
+        for seq, code, fields in self.since(watermark, upto):
+            _, before = changed.pop(code, (0, set()))
+            changed[code] = (seq, None if before is None or fields is None else before | set(fields))
+        return changed
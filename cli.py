@@ -0,0 +1,471 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pandas as pd
+
+import aggregates
+import bench
+import dedup
+import export
+import ingest
+import journal
+import loadtest
+import merge
+import notify
+import reports
+import risk
+import roster
+import settings
+from history import MeasurementHistory
+from ids import SequenceAllocator
+from browse import REFERRED, RecordBrowser
+from changes import ChangeLog
+from storage import CsvStorage, ShardedStorage, SqliteStorage, department_code
+from store import open_record_store
+
+# Maintenance commands that run outside Streamlit, e.g.
+#   python cli.py migrate --csv medical_records.csv --db medical_records.db
+
+
+def migrate(args):
+    df, entries = CsvStorage(args.csv).load()
+    records = journal.replay(df.to_dict('records'), entries)
+    count = SqliteStorage(args.db).import_records(records)
+    print(f"Imported {count} records from {args.csv} into {args.db}")
+
+
+def shard(args):
+    df, entries = CsvStorage(args.csv).load()
+    records = journal.replay(df.to_dict('records'), entries)
+    count = ShardedStorage(args.csv).import_records(records)
+    sizes = Counter(department_code(r[journal.KEY]) for r in records)
+    print(f"Split {count} records from {args.csv} into department shards: "
+          + ", ".join(f"{code} {n}" for code, n in sorted(sizes.items())))
+    print("Set WRHD_STORAGE=sharded to use them")
+
+
+def open_store(args):
+    store = open_record_store(args.backend, args.data, args.db, settings.STATION)
+    store.refresh()
+    # Stamps every write made through the store, as the app does
+    store.change_log = ChangeLog.for_records(args.changes_file, store, settings.STATION)
+    return store
+
+
+def import_roster(args):
+    store = open_store(args)
+    allocator = SequenceAllocator.for_records(args.seq_file, store)
+    imported, errors = roster.import_roster(roster.read_roster(args.roster), store, allocator)
+    print(f"Registered {len(imported)} staff from {args.roster}")
+    if len(errors):
+        errors.to_csv(args.errors, index=False)
+        print(f"{len(errors)} rows were not imported, see {args.errors}")
+
+
+def notify_worker(args):
+    # Drains the SMS outbox from outside Streamlit, e.g. on a separate host
+    logging.basicConfig(level=logging.INFO)
+    notifier = notify.open_notifier(args.outbox, args.transport, args.workers, args.per_second).start()
+    print(f"Draining {args.outbox} with {args.workers} workers; Ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        notifier.stop()
+
+
+def _allocate_many(path, threads, per_thread):
+    allocator = SequenceAllocator(path)
+    with ThreadPoolExecutor(threads) as pool:
+        batches = pool.map(lambda _: [allocator.allocate("PH") for _ in range(per_thread)], range(threads))
+        return [n for batch in batches for n in batch]
+
+
+def check_ids(args):
+    # Hammers one sequence from many threads in many processes and checks
+    # that no number is handed out twice
+    path = args.seq_file or os.path.join(tempfile.mkdtemp(), "stress.seq.db")
+    SequenceAllocator(path)
+    with ProcessPoolExecutor(args.processes) as pool:
+        futures = [pool.submit(_allocate_many, path, args.threads, args.per_thread)
+                   for _ in range(args.processes)]
+        numbers = [n for f in futures for n in f.result()]
+    expected = args.processes * args.threads * args.per_thread
+    duplicates = len(numbers) - len(set(numbers))
+    print(f"Allocated {len(numbers)} of {expected} numbers, {duplicates} duplicates")
+    if duplicates or len(numbers) != expected or sorted(numbers) != list(range(min(numbers), min(numbers) + expected)):
+        raise SystemExit("Unique code allocator check FAILED")
+    print("Unique code allocator check passed")
+
+
+def check_merge(args):
+    # Two offline stations hand the same Unique Code to different people;
+    # the merge must keep both, under different codes, and a second merge
+    # of the same journals must change nothing
+    directory = tempfile.mkdtemp(prefix="wrhd-merge-check-")
+    store = open_record_store(args.backend, os.path.join(directory, settings.DATA_FILE),
+                              os.path.join(directory, settings.DB_FILE))
+    store.refresh()
+    allocator = SequenceAllocator.for_records(os.path.join(directory, settings.SEQUENCE_FILE), store)
+    code_map = merge.CodeMap(os.path.join(directory, settings.MERGE_FILE))
+    people = {"stationA": ("Jane", "Doe"), "stationB": ("John", "Dade")}
+    paths = []
+    for station, (first, last) in people.items():
+        path = os.path.join(directory, f"{station}.csv.journal")
+        journal.append_entries(path, [("JDPH0001", {"Unique Code": "JDPH0001", "First Name": first, "Last Name": last,
+                                                    "DOB": "1990-01-01", "Department": "Public Health"})], station)
+        paths.append(path)
+        time.sleep(0.01)  # distinct timestamps, so station B registers later
+
+    summary, renumbered = merge.merge_files(store, paths, allocator, code_map)
+    names = {(r.get('First Name'), r.get('Last Name')): r['Unique Code'] for r in store.table.views()}
+    print(f"Records: {len(store)}, renumbered: {renumbered[['Station Code', 'New Code']].values.tolist()}")
+    again, _ = merge.merge_files(store, paths, allocator, code_map)
+    problems = []
+    if set(names) != set(people.values()) or len(set(names.values())) != len(people):
+        problems.append(f"expected both people under different codes, got {names}")
+    if (renumbered['Station Code'] == renumbered['New Code']).any():
+        problems.append("a code was renumbered to itself")
+    if again['fields written'] or again['already merged'] != again['entries']:
+        problems.append(f"merging the same journals again changed records: {again}")
+    for problem in problems:
+        print(f"  {problem}")
+    if problems:
+        raise SystemExit("Station merge check FAILED")
+    print("Station merge check passed")
+
+
+def run_bench(args):
+    results = bench.run(args.sizes, args.backend, args.repeat, args.app)
+    if args.out:
+        bench.save(results, args.out)
+        print(f"Results written to {args.out}")
+    baseline = bench.load(args.baseline) if args.baseline else {}
+    rows, regressions = bench.compare(results, baseline, args.tolerance)
+    for size, operation, before, seconds in rows:
+        change = f"{(seconds / before - 1) * 100:+.0f}%" if before else ""
+        print(f"{size:>8} {operation:<20} {seconds * 1000:10.2f} ms {change}")
+    if regressions:
+        raise SystemExit(f"{len(regressions)} operations regressed by more than {args.tolerance:.0%}")
+
+
+def duplicate_report(args):
+    store = open_store(args)
+    start = time.perf_counter()
+    report = dedup.duplicate_report(store.table, args.window)
+    report.to_csv(args.out, index=False)
+    print(f"Checked {len(store)} records in {time.perf_counter() - start:.1f}s: "
+          f"{len(report)} possible duplicate pairs written to {args.out}")
+
+
+def merge_stations(args):
+    store = open_store(args)
+    store.history = MeasurementHistory.for_records(args.history_file, store, settings.STATION)
+    allocator = SequenceAllocator.for_records(args.seq_file, store)
+    start = time.perf_counter()
+    try:
+        summary, renumbered = merge.merge_files(store, args.journals, allocator, merge.CodeMap(args.merge_file))
+    except ValueError as e:
+        raise SystemExit(str(e))
+    print(f"Merged {len(args.journals)} files in {time.perf_counter() - start:.1f}s")
+    for name, value in summary.items():
+        print(f"  {name}: {value}")
+    if len(renumbered):
+        renumbered.to_csv(args.renumbered, index=False)
+        print(f"{len(renumbered)} codes were renumbered, see {args.renumbered}")
+
+
+def ingest_readings(args):
+    store = open_store(args)
+    store.history = MeasurementHistory.for_records(args.history_file, store, settings.STATION)
+    readings = ingest.read_readings(args.readings)
+    start = time.perf_counter()
+    accepted = 0
+    rejected = []
+    for i in range(0, len(readings), args.batch_size):
+        n, errors, _ = ingest.ingest(store, readings[i:i + args.batch_size])
+        accepted += n
+        rejected.append(errors.assign(Row=errors['Row'] + i))
+    seconds = time.perf_counter() - start
+    print(f"Ingested {accepted} of {len(readings)} readings in {seconds:.2f}s "
+          f"({len(readings) / max(seconds, 1e-9):.0f} readings/s)")
+    rejected = pd.concat(rejected) if rejected else pd.DataFrame()
+    if len(rejected):
+        rejected.to_csv(args.errors, index=False)
+        print(f"{len(rejected)} readings were rejected, see {args.errors}")
+
+
+def ingest_serve(args):
+    logging.basicConfig(level=logging.INFO)
+    store = open_store(args)
+    store.history = MeasurementHistory.for_records(args.history_file, store, settings.STATION)
+    server = ingest.serve(store, args.host, args.port, settings.INGEST_TOKEN, args.batch_size, args.max_wait)
+    print(f"Accepting readings on http://{args.host}:{args.port}/readings; Ctrl-C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+def fake_devices(args):
+    # Simulated device feed against a running ingest-serve, for throughput checks
+    store = open_store(args)
+    codes = list(store.by_code)
+    if not codes:
+        raise SystemExit("The store has no records to post readings for")
+    sent, accepted, rejected, seconds = ingest.fake_feed(
+        args.url, codes, args.devices, args.readings, args.per_request, settings.INGEST_TOKEN)
+    print(f"{args.devices} devices sent {sent} readings in {seconds:.2f}s "
+          f"({sent / max(seconds, 1e-9):.0f} readings/s): {accepted} accepted, {rejected} rejected")
+
+
+def check_aggregates(args):
+    # Recounts the screening tallies from every record and compares them
+    # with the persisted tallies plus the journal replayed on top
+    store = open_store(args)
+    start = time.perf_counter()
+    differences = store.rebuild_aggregates()
+    print(f"Recounted {len(store)} records in {time.perf_counter() - start:.2f}s")
+    for (dimension, value), (kept, recounted) in differences.items():
+        print(f"  {dimension} {value}: kept {kept}, recounted {recounted}")
+    if differences:
+        path = aggregates.aggregates_path(args.data)
+        if args.backend == "csv" and os.path.exists(path):
+            os.remove(path)
+            print(f"Removed {path}; it is rebuilt on the next load")
+        raise SystemExit(f"{len(differences)} groups had wrong tallies")
+    print("Screening tallies match the records")
+
+
+def result_slips(args):
+    store = open_store(args)
+    rows = RecordBrowser(store).mask(
+        departments=args.department, sexes=args.sex, start=args.start, end=args.end,
+        referred=args.referred, risk_categories=args.risk).nonzero()[0]
+    if not len(rows):
+        raise SystemExit("No records match those filters")
+    start = time.perf_counter()
+
+    def progress(done, total):
+        print(f"\r{done}/{total} participants", end="", flush=True)
+
+    count = reports.generate(store.table, rows, args.out, args.format, args.workers, progress=progress)
+    seconds = time.perf_counter() - start
+    print(f"\nWrote {count} result slips ({', '.join(args.format)}) to {args.out} in {seconds:.1f}s "
+          f"({count / max(seconds, 1e-9):.0f} per second)")
+
+
+def load_test(args):
+    # Concurrent sessions against a synthetic dataset, then a check that
+    # every acknowledged write made it to disk
+    directory = args.dir or tempfile.mkdtemp(prefix="wrhd-load-")
+    if args.size:
+        loadtest.prepare(directory, args.size, args.backend)
+    mix = dict(zip(loadtest.MIX, (args.register, args.search, args.measure)))
+    print(f"{args.sessions} {args.client} sessions x {args.actions} actions in {directory}")
+    events, seconds = loadtest.run(directory, args.sessions, args.actions, args.processes, args.client,
+                                   args.backend, mix, args.think, hot_patients=args.patients)
+    summary = loadtest.summarize(events, seconds)
+    checks = loadtest.verify(directory, args.backend, events)
+    print(f"{len(events)} reruns in {seconds:.1f}s ({summary['reruns_per_second']:.1f} per second)")
+    print(f"{'action':<10} {'reruns':>7} {'errors':>7}" + "".join(f"{f'p{p} ms':>10}" for p in loadtest.PERCENTILES)
+          + f"{'max ms':>10}")
+    for action, row in summary['actions'].items():
+        print(f"{action:<10} {row['reruns']:>7} {row['errors']:>7}"
+              + "".join(f"{row[f'p{p}']:>10.1f}" for p in loadtest.PERCENTILES) + f"{row['max']:>10.1f}")
+    for error, count in summary['errors'].items():
+        print(f"  {count} x {error}")
+    print(f"Registrations: {checks['registrations']}, duplicate codes: {checks['duplicate_codes']}, "
+          f"missing: {checks['missing_registrations']}")
+    print(f"Saved fields checked: {checks['checked_fields']}, lost updates: {checks['lost_updates']}")
+    for lost in checks['lost'][:10]:
+        print(f"  {lost['Unique Code']} {lost['Field']}: {lost['On Disk']!r} on disk, "
+              f"expected one of {lost['Expected One Of']!r}")
+    if args.out:
+        bench.save({'summary': summary, 'checks': checks}, args.out)
+        print(f"Results written to {args.out}")
+    if checks['duplicate_codes'] or checks['missing_registrations'] or checks['lost_updates']:
+        raise SystemExit("Load test found lost or duplicated writes")
+
+
+def delta_export(args):
+    # Records changed after a watermark, for the nightly sync; with --state
+    # the watermark is read from and, once the file is written, saved to it
+    since = args.since
+    if since is None and args.state and os.path.exists(args.state):
+        with open(args.state, encoding="utf-8") as f:
+            since = int(f.read().strip() or 0)
+    since = since or 0
+    fmt = next(name for name, (ext, _) in export.DELTA_FORMATS.items() if ext == args.format)
+    store = open_store(args)
+    upto = store.change_log.watermark()
+    store.refresh()  # holds every change up to upto
+    start = time.perf_counter()
+    if args.out == "-":
+        written, upto = export.write_delta(store.table, store.change_log, since, fmt,
+                                           sys.stdout.buffer, args.fields_only, upto)
+        sys.stdout.buffer.flush()
+    else:
+        with open(args.out, "wb") as out:
+            written, upto = export.write_delta(store.table, store.change_log, since, fmt,
+                                               out, args.fields_only, upto)
+    if args.state:
+        with open(args.state + ".tmp", "w", encoding="utf-8") as f:
+            f.write(f"{upto}\n")
+        os.replace(args.state + ".tmp", args.state)
+    print(f"Wrote {written} records changed in {since + 1}-{upto} to {args.out} "
+          f"in {time.perf_counter() - start:.2f}s; next watermark {upto}", file=sys.stderr)
+
+
+def add_store_arguments(p):
+    p.add_argument("--backend", choices=["csv", "sharded", "sqlite"], default=settings.STORAGE_BACKEND)
+    p.add_argument("--data", default=settings.DATA_FILE)
+    p.add_argument("--db", default=settings.DB_FILE)
+    p.add_argument("--seq-file", default=settings.SEQUENCE_FILE)
+    p.add_argument("--changes-file", default=settings.CHANGES_FILE)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="WRHD Medical Screening maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("migrate", help="Import a CSV data file (and its journal) into SQLite")
+    p.add_argument("--csv", default=settings.DATA_FILE)
+    p.add_argument("--db", default=settings.DB_FILE)
+    p.set_defaults(func=migrate)
+
+    p = commands.add_parser("shard", help="Split a CSV data file (and its journal) into per-department shards")
+    p.add_argument("--csv", default=settings.DATA_FILE)
+    p.set_defaults(func=shard)
+
+    p = commands.add_parser("import-roster", help="Pre-register staff from a CSV or .xlsx roster")
+    p.add_argument("roster")
+    p.add_argument("--errors", default="roster_errors.csv", help="Where to write the per-row error report")
+    add_store_arguments(p)
+    p.set_defaults(func=import_roster)
+
+    p = commands.add_parser("notify-worker", help="Send queued SMS notifications")
+    p.add_argument("--outbox", default=settings.OUTBOX_FILE)
+    p.add_argument("--transport", choices=["fake", "twilio"], default=settings.SMS_TRANSPORT)
+    p.add_argument("--workers", type=int, default=settings.SMS_WORKERS)
+    p.add_argument("--per-second", type=float, default=settings.SMS_PER_SECOND)
+    p.set_defaults(func=notify_worker)
+
+    p = commands.add_parser("check-ids", help="Stress-test the Unique Code allocator for duplicates")
+    p.add_argument("--seq-file", help="Sequence file to use (default: a fresh temporary one)")
+    p.add_argument("--processes", type=int, default=4)
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--per-thread", type=int, default=200)
+    p.set_defaults(func=check_ids)
+
+    p = commands.add_parser("check-merge", help="Merge two stations that used the same Unique Code and check both are kept")
+    p.add_argument("--backend", choices=["csv", "sharded"], default="csv")
+    p.set_defaults(func=check_merge)
+
+    p = commands.add_parser("bench", help="Time the hot paths on synthetic records")
+    p.add_argument("--sizes", type=int, nargs="+", default=bench.DEFAULT_SIZES)
+    p.add_argument("--backend", choices=["csv", "sharded", "sqlite"], default="csv")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--app", action="store_true", help="Also time full script runs with Streamlit's AppTest")
+    p.add_argument("--out", help="Write the results as JSON")
+    p.add_argument("--baseline", help="JSON results to compare against")
+    p.add_argument("--tolerance", type=float, default=bench.TOLERANCE)
+    p.set_defaults(func=run_bench)
+
+    p = commands.add_parser("merge-stations", help="Merge the change journals of offline stations")
+    p.add_argument("journals", nargs="+", help="Station journals (.journal, .journal.archive) or CSV snapshots")
+    p.add_argument("--merge-file", default=settings.MERGE_FILE)
+    p.add_argument("--history-file", default=settings.HISTORY_FILE)
+    p.add_argument("--renumbered", default="renumbered_codes.csv", help="Where to list renumbered codes")
+    add_store_arguments(p)
+    p.set_defaults(func=merge_stations)
+
+    p = commands.add_parser("dedup-report", help="List likely duplicate registrations")
+    p.add_argument("--out", default="duplicate_registrations.csv")
+    p.add_argument("--window", type=int, default=dedup.REPORT_WINDOW,
+                   help="Neighbours each record is compared with after sorting")
+    add_store_arguments(p)
+    p.set_defaults(func=duplicate_report)
+
+    p = commands.add_parser("ingest", help="Load device readings from a JSON, JSON-lines or CSV file")
+    p.add_argument("readings")
+    p.add_argument("--batch-size", type=int, default=settings.INGEST_BATCH)
+    p.add_argument("--errors", default="ingest_errors.csv", help="Where to write the rejected readings")
+    p.add_argument("--history-file", default=settings.HISTORY_FILE)
+    add_store_arguments(p)
+    p.set_defaults(func=ingest_readings)
+
+    p = commands.add_parser("ingest-serve", help="Accept device readings over local HTTP")
+    p.add_argument("--host", default=settings.INGEST_HOST)
+    p.add_argument("--port", type=int, default=settings.INGEST_PORT)
+    p.add_argument("--batch-size", type=int, default=settings.INGEST_BATCH)
+    p.add_argument("--max-wait", type=float, default=settings.INGEST_WAIT,
+                   help="Seconds to wait for more readings before writing a batch")
+    p.add_argument("--history-file", default=settings.HISTORY_FILE)
+    add_store_arguments(p)
+    p.set_defaults(func=ingest_serve)
+
+    p = commands.add_parser("fake-devices", help="Post simulated device readings to ingest-serve")
+    p.add_argument("--url", default=f"http://{settings.INGEST_HOST}:{settings.INGEST_PORT}")
+    p.add_argument("--devices", type=int, default=8)
+    p.add_argument("--readings", type=int, default=20000)
+    p.add_argument("--per-request", type=int, default=100)
+    add_store_arguments(p)
+    p.set_defaults(func=fake_devices)
+
+    p = commands.add_parser("check-aggregates", help="Recount the screening tallies and compare")
+    add_store_arguments(p)
+    p.set_defaults(func=check_aggregates)
+
+    p = commands.add_parser("reports", help="Write per-participant result slips into a zip")
+    p.add_argument("--out", default="result_slips.zip")
+    p.add_argument("--format", choices=reports.FORMATS, nargs="+", default=list(reports.FORMATS))
+    p.add_argument("--workers", type=int, help="Worker processes (default: one per CPU)")
+    p.add_argument("--department", nargs="+")
+    p.add_argument("--sex", nargs="+")
+    p.add_argument("--start", help="Registered on or after (YYYY-MM-DD)")
+    p.add_argument("--end", help="Registered on or before (YYYY-MM-DD)")
+    p.add_argument("--referred", choices=REFERRED, default="Any")
+    p.add_argument("--risk", nargs="+", choices=risk.CONDITIONS)
+    add_store_arguments(p)
+    p.set_defaults(func=result_slips)
+
+    p = commands.add_parser("load-test", help="Simulate concurrent screening stations and check for lost writes")
+    p.add_argument("--dir", help="Data directory to use (default: a fresh temporary one)")
+    p.add_argument("--size", type=int, default=10000, help="Synthetic records to start from (0 keeps --dir as is)")
+    p.add_argument("--backend", choices=["csv", "sharded", "sqlite"], default=settings.STORAGE_BACKEND)
+    p.add_argument("--client", choices=loadtest.CLIENTS, default="store",
+                   help="store: the app's RecordStore calls on threads; app: the full script through AppTest")
+    p.add_argument("--sessions", type=int, default=8)
+    p.add_argument("--processes", type=int, default=1, help="Server processes the store sessions are spread over")
+    p.add_argument("--actions", type=int, default=50, help="Actions per session")
+    p.add_argument("--register", type=float, default=loadtest.MIX['register'])
+    p.add_argument("--search", type=float, default=loadtest.MIX['search'])
+    p.add_argument("--measure", type=float, default=loadtest.MIX['measure'])
+    p.add_argument("--patients", type=int, default=loadtest.HOT_PATIENTS,
+                   help="Patients the saves are spread over; fewer means more contention")
+    p.add_argument("--think", type=float, default=0.0, help="Mean seconds between a session's actions")
+    p.add_argument("--out", help="Write the results as JSON")
+    p.set_defaults(func=load_test)
+
+    p = commands.add_parser("delta-export", help="Export the records changed after a watermark")
+    p.add_argument("--since", type=int, help="Watermark: export changes with a higher sequence (default 0)")
+    p.add_argument("--state", help="File holding the watermark between runs, updated after each export")
+    p.add_argument("--out", default="-", help="Output file, or - for stdout")
+    p.add_argument("--format", choices=[ext for ext, _ in export.DELTA_FORMATS.values()], default="csv")
+    p.add_argument("--fields-only", action="store_true", help="Only the fields each record had changed")
+    add_store_arguments(p)
+    p.set_defaults(func=delta_export)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
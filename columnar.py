@@ -0,0 +1,555 @@
+import sys
+import threading
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+import journal
+from storage import REGISTRATION_COLUMNS, SECTION_COLUMNS
+
+# Typed columnar copy of the records. Each field is one NumPy array:
+# dictionary-encoded codes for repeated strings, int16 for age and blood
+# pressure, float32 for measurements and int32 day numbers for dates, so a
+# record costs a few dozen bytes instead of a dict of Python objects.
+# RecordView gives the section forms a dict-like window onto one row.
+KEY = journal.KEY
+# float32 keeps about 7 significant digits; values are read back rounded
+# to this many decimals so 5.7 stays 5.7
+FLOAT_DECIMALS = 4
+MIN_CAPACITY = 1024
+
+
+def _objects(values):
+    # Any list or Series -> object ndarray with None for missing values
+    s = pd.Series(values, dtype=object)
+    return s.where(s.notna(), None).to_numpy(dtype=object)
+
+
+def _padded(data, size, capacity, fill):
+    out = np.full(capacity, fill, dtype=data.dtype)
+    out[:size] = data[:size]
+    return out
+
+
+def _decode(text, ends, missing, capacity):
+    text = bytes(text).decode("utf-8")
+    ends = ends.tolist()
+    data = np.full(capacity, None, dtype=object)
+    data[:len(ends)] = [text[start:end] for start, end in zip([0] + ends[:-1], ends)]
+    data[np.flatnonzero(missing)] = None
+    return data
+
+
+class TextColumn:
+    # Free text and values unique to each record. A column restored from a
+    # binary snapshot stays one encoded buffer until something reads it.
+    def __init__(self):
+        self._data = np.full(0, None, dtype=object)
+        self._encoded = None
+
+    @property
+    def data(self):
+        if self._encoded is not None:
+            self._data = _decode(*self._encoded)
+            self._encoded = None
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._encoded = None
+
+    def resize(self, capacity):
+        data = np.full(capacity, None, dtype=object)
+        data[:len(self.data)] = self.data
+        self.data = data
+
+    def set(self, rows, values):
+        self.data[rows] = _objects(values)
+
+    def value(self, row):
+        return self.data[row]
+
+    def series(self, rows):
+        return pd.Series(self.data[rows], dtype=object)
+
+    def sort_keys(self, rows):
+        # float64 keys in sort order, NaN where unset
+        values = pd.Series(self.data[rows], dtype=object)
+        codes, _ = pd.factorize(values.where(values.isna(), values.astype(str).str.lower()), sort=True)
+        return np.where(codes < 0, np.nan, codes)
+
+    def nbytes(self):
+        return self.data.nbytes + sum(sys.getsizeof(v) for v in self.data if v is not None)
+
+    def dump(self, size, capacity):
+        values = self.data[:size]
+        if pd.api.types.infer_dtype(values, skipna=True) not in ("string", "empty"):
+            return {'objects': values}, {}
+        text = [v or "" for v in values]
+        return {
+            'text': np.frombuffer("".join(text).encode("utf-8"), dtype=np.uint8),
+            'ends': np.cumsum([len(t) for t in text], dtype=np.int64),
+            'missing': np.array([v is None for v in values], dtype=bool),
+        }, {}
+
+    def restore(self, arrays, meta, capacity):
+        if 'objects' in arrays:
+            self.data = _padded(arrays['objects'], len(arrays['objects']), capacity, None)
+        else:
+            self._encoded = (arrays['text'], arrays['ends'], arrays['missing'], capacity)
+
+
+class CategoryColumn:
+    # Repeated strings stored once, rows hold codes (-1 when unset) in the
+    # narrowest integer type that fits the number of distinct values
+    def __init__(self):
+        self.data = np.full(0, -1, dtype=np.int8)
+        self.values = []
+        self.lookup = {}
+
+    def resize(self, capacity):
+        data = np.full(capacity, -1, dtype=self.data.dtype)
+        data[:len(self.data)] = self.data
+        self.data = data
+
+    def _code(self, value):
+        code = self.lookup.get(value)
+        if code is None:
+            code = self.lookup[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def set(self, rows, values):
+        codes, uniques = pd.factorize(_objects(values))
+        mapping = np.array([self._code(v) for v in uniques] + [-1], dtype=np.int32)
+        if len(self.values) > np.iinfo(self.data.dtype).max:
+            self.data = self.data.astype(np.int16 if len(self.values) <= np.iinfo(np.int16).max else np.int32)
+        self.data[rows] = mapping[codes]
+
+    def value(self, row):
+        code = self.data[row]
+        return None if code < 0 else self.values[code]
+
+    def series(self, rows):
+        categories = pd.Index(self.values, dtype=object)
+        return pd.Series(pd.Categorical.from_codes(self.data[rows], categories=categories))
+
+    def sort_keys(self, rows):
+        ranks = np.empty(len(self.values) + 1)
+        ranks[np.argsort(np.array([str(v).lower() for v in self.values] + [""]), kind='stable')] = np.arange(len(ranks))
+        ranks[-1] = np.nan  # code -1
+        return ranks[self.data[rows]]
+
+    def nbytes(self):
+        return self.data.nbytes + sum(sys.getsizeof(v) for v in self.values)
+
+    def dump(self, size, capacity):
+        return {'codes': _padded(self.data, size, capacity, -1)}, {'values': self.values}
+
+    def restore(self, arrays, meta, capacity):
+        self.data = arrays['codes']
+        self.values = meta['values']
+        self.lookup = {v: i for i, v in enumerate(self.values)}
+
+
+class IntegerColumn:
+    MISSING = -32768
+
+    def __init__(self):
+        self.data = np.full(0, self.MISSING, dtype=np.int16)
+
+    def resize(self, capacity):
+        data = np.full(capacity, self.MISSING, dtype=np.int16)
+        data[:len(self.data)] = self.data
+        self.data = data
+
+    def set(self, rows, values):
+        numbers = pd.to_numeric(pd.Series(_objects(values)), errors='coerce').to_numpy(dtype=np.float64, copy=True)
+        numbers[~((numbers > self.MISSING) & (numbers <= 32767))] = self.MISSING
+        self.data[rows] = numbers.round().astype(np.int16)
+
+    def value(self, row):
+        value = self.data[row]
+        return None if value == self.MISSING else int(value)
+
+    def series(self, rows):
+        data = self.data[rows]
+        return pd.Series(pd.arrays.IntegerArray(data, data == self.MISSING))
+
+    def sort_keys(self, rows):
+        data = self.data[rows]
+        return np.where(data == self.MISSING, np.nan, data)
+
+    def nbytes(self):
+        return self.data.nbytes
+
+    def dump(self, size, capacity):
+        return {'data': _padded(self.data, size, capacity, self.MISSING)}, {}
+
+    def restore(self, arrays, meta, capacity):
+        self.data = arrays['data']
+
+
+class FloatColumn:
+    def __init__(self):
+        self.data = np.full(0, np.nan, dtype=np.float32)
+
+    def resize(self, capacity):
+        data = np.full(capacity, np.nan, dtype=np.float32)
+        data[:len(self.data)] = self.data
+        self.data = data
+
+    def set(self, rows, values):
+        self.data[rows] = pd.to_numeric(pd.Series(_objects(values)), errors='coerce').to_numpy(dtype=np.float32)
+
+    def value(self, row):
+        value = self.data[row]
+        return None if np.isnan(value) else round(float(value), FLOAT_DECIMALS)
+
+    def series(self, rows):
+        return pd.Series(self.data[rows].astype(np.float64).round(FLOAT_DECIMALS))
+
+    def sort_keys(self, rows):
+        return self.data[rows].astype(np.float64)
+
+    def nbytes(self):
+        return self.data.nbytes
+
+    def dump(self, size, capacity):
+        return {'data': _padded(self.data, size, capacity, np.nan)}, {}
+
+    def restore(self, arrays, meta, capacity):
+        self.data = arrays['data']
+
+
+class BooleanColumn:
+    # int8: 1 true, 0 false, -1 unset
+    TRUTH = {True: 1, False: 0, "True": 1, "False": 0, "true": 1, "false": 0}
+
+    def __init__(self):
+        self.data = np.full(0, -1, dtype=np.int8)
+
+    def resize(self, capacity):
+        data = np.full(capacity, -1, dtype=np.int8)
+        data[:len(self.data)] = self.data
+        self.data = data
+
+    def set(self, rows, values):
+        flags = pd.Series(_objects(values)).map(lambda v: self.TRUTH.get(v, -1) if isinstance(v, (bool, str, int, float)) else -1)
+        self.data[rows] = flags.to_numpy(dtype=np.int8)
+
+    def value(self, row):
+        value = self.data[row]
+        return None if value < 0 else bool(value)
+
+    def series(self, rows):
+        data = self.data[rows]
+        return pd.Series(pd.arrays.BooleanArray(data == 1, data < 0))
+
+    def sort_keys(self, rows):
+        data = self.data[rows]
+        return np.where(data < 0, np.nan, data)
+
+    def nbytes(self):
+        return self.data.nbytes
+
+    def dump(self, size, capacity):
+        return {'data': _padded(self.data, size, capacity, -1)}, {}
+
+    def restore(self, arrays, meta, capacity):
+        self.data = arrays['data']
+
+
+class DateColumn:
+    # Calendar dates as int32 days since 1970; read back as "YYYY-MM-DD"
+    # strings like the forms write them, or as Timestamps for DOB
+    MISSING = np.iinfo(np.int32).min
+
+    def __init__(self, timestamps=False):
+        self.timestamps = timestamps
+        self.data = np.full(0, self.MISSING, dtype=np.int32)
+
+    def resize(self, capacity):
+        data = np.full(capacity, self.MISSING, dtype=np.int32)
+        data[:len(self.data)] = self.data
+        self.data = data
+
+    def _days(self, values):
+        if isinstance(values, pd.Series) and pd.api.types.is_datetime64_any_dtype(values):
+            return values.to_numpy().astype("datetime64[D]")
+        values = pd.Series(_objects(values))
+        text = values.map(lambda v: isinstance(v, str))
+        dates = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+        if text.any():
+            dates[text] = pd.to_datetime(values[text], errors='coerce', format='ISO8601')
+        if (~text).any():
+            dates[~text] = pd.to_datetime(values[~text], errors='coerce')
+        return dates.to_numpy().astype("datetime64[D]")
+
+    def set(self, rows, values):
+        days = self._days(values)
+        self.data[rows] = np.where(np.isnat(days), self.MISSING, days.astype(np.int64))
+
+    def value(self, row):
+        value = self.data[row]
+        if value == self.MISSING:
+            return None
+        day = np.datetime64(int(value), "D")
+        return pd.Timestamp(day) if self.timestamps else str(day)
+
+    def series(self, rows):
+        data = self.data[rows]
+        days = data.astype("datetime64[D]")
+        days[data == self.MISSING] = np.datetime64("NaT")
+        return pd.Series(days.astype("datetime64[s]"))
+
+    def sort_keys(self, rows):
+        data = self.data[rows]
+        return np.where(data == self.MISSING, np.nan, data)
+
+    def nbytes(self):
+        return self.data.nbytes
+
+    def dump(self, size, capacity):
+        return {'data': _padded(self.data, size, capacity, self.MISSING)}, {}
+
+    def restore(self, arrays, meta, capacity):
+        self.data = arrays['data']
+
+
+class BloodPressureColumn:
+    # "120/80" as two int16 columns; anything that does not parse is kept
+    # verbatim so the invalid-format warning still shows it
+    MISSING = -1
+
+    def __init__(self):
+        self.systolic = np.full(0, self.MISSING, dtype=np.int16)
+        self.diastolic = np.full(0, self.MISSING, dtype=np.int16)
+        self.raw = {}
+
+    def resize(self, capacity):
+        for name in ('systolic', 'diastolic'):
+            data = np.full(capacity, self.MISSING, dtype=np.int16)
+            old = getattr(self, name)
+            data[:len(old)] = old
+            setattr(self, name, data)
+
+    def set(self, rows, values):
+        values = pd.Series(_objects(values))
+        parts = values.astype(object).where(values.notna(), "").astype(str).str.extract(r"^\s*(\d{1,4})\s*/\s*(\d{1,4})\s*$")
+        parsed = parts[0].notna().to_numpy()
+        self.systolic[rows] = np.where(parsed, pd.to_numeric(parts[0]).fillna(self.MISSING), self.MISSING)
+        self.diastolic[rows] = np.where(parsed, pd.to_numeric(parts[1]).fillna(self.MISSING), self.MISSING)
+        rows = np.atleast_1d(rows)
+        if self.raw:
+            for row in rows.tolist():
+                self.raw.pop(row, None)
+        for i in np.flatnonzero(~parsed & values.notna().to_numpy()):
+            self.raw[int(rows[i])] = values.iat[i]
+
+    def value(self, row):
+        if row in self.raw:
+            return self.raw[row]
+        if self.systolic[row] == self.MISSING:
+            return None
+        return f"{self.systolic[row]}/{self.diastolic[row]}"
+
+    def series(self, rows):
+        systolic, diastolic = self.systolic[rows], self.diastolic[rows]
+        text = pd.Series(systolic.astype(str), dtype=object) + "/" + pd.Series(diastolic.astype(str), dtype=object)
+        text[systolic == self.MISSING] = None
+        if self.raw:
+            for i, row in enumerate(rows.tolist()):
+                if row in self.raw:
+                    text.iat[i] = self.raw[row]
+        return text
+
+    def sort_keys(self, rows):
+        # By systolic, then diastolic; unparseable readings sort with the unset
+        systolic, diastolic = self.systolic[rows], self.diastolic[rows]
+        return np.where(systolic == self.MISSING, np.nan, systolic * 1000.0 + diastolic)
+
+    def nbytes(self):
+        return self.systolic.nbytes + self.diastolic.nbytes
+
+    def dump(self, size, capacity):
+        return {
+            'systolic': _padded(self.systolic, size, capacity, self.MISSING),
+            'diastolic': _padded(self.diastolic, size, capacity, self.MISSING),
+        }, {'raw': {str(row): value for row, value in self.raw.items()}}
+
+    def restore(self, arrays, meta, capacity):
+        self.systolic = arrays['systolic']
+        self.diastolic = arrays['diastolic']
+        self.raw = {int(row): value for row, value in meta['raw'].items()}
+
+
+COLUMN_KINDS = {
+    KEY: TextColumn,
+    'DOB': lambda: DateColumn(timestamps=True),
+    'Age': IntegerColumn,
+    'Email': TextColumn,
+    'Phone Number': TextColumn,
+    'Blood Pressure': BloodPressureColumn,
+    'BP Notes': TextColumn,
+    'Weight': FloatColumn,
+    'Height': FloatColumn,
+    'BMI': FloatColumn,
+    'Blood Glucose': FloatColumn,
+    'Visual Examination Notes': TextColumn,
+    'Clinical Notes': TextColumn,
+    'Referred': BooleanColumn,
+    'Referral Details': TextColumn,
+}
+for _name in ('Registration Date', 'BP Date', 'BMI Date', 'Glucose Date', 'Vision Test Date', 'Referral Date'):
+    COLUMN_KINDS[_name] = DateColumn
+# Everything else in the schema repeats across records (names, department,
+# yes/no answers, classifications); fields outside it are kept as text
+
+
+class RecordTable:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.columns = {}
+        self.rows = {}  # Unique Code -> row
+        self.size = 0
+        self._capacity = 0
+        for name in REGISTRATION_COLUMNS + SECTION_COLUMNS:
+            self._column(name, COLUMN_KINDS.get(name, CategoryColumn))
+
+    def __len__(self):
+        return self.size
+
+    def _column(self, name, kind=TextColumn):
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = kind()
+            column.resize(self._capacity)
+        return column
+
+    def _reserve(self, count):
+        if self.size + count <= self._capacity:
+            return
+        # Grow by a quarter: whole-table doubling would cost more than the
+        # dicts this replaces
+        self._capacity = max(MIN_CAPACITY, (self.size + count) * 5 // 4)
+        for column in self.columns.values():
+            column.resize(self._capacity)
+
+    @classmethod
+    def from_frame(cls, df):
+        table = cls()
+        if KEY not in df or not len(df):
+            return table
+        df = df.drop_duplicates(KEY, keep='last').reset_index(drop=True)
+        table._capacity = len(df)
+        for column in table.columns.values():
+            column.resize(len(df))
+        table.size = len(df)
+        rows = np.arange(len(df))
+        for name in df.columns:
+            table._column(name).set(rows, df[name])
+        table.rows = dict(zip(table.columns[KEY].data[:len(df)].tolist(), rows.tolist()))
+        return table
+
+    def dump(self):
+        # (size, capacity, {name: (kind, arrays, meta)}) for a binary
+        # snapshot; a quarter of free rows is kept so the first new
+        # registrations after a restore need no resize
+        with self._lock:
+            capacity = max(MIN_CAPACITY, self.size * 5 // 4)
+            return self.size, capacity, {name: (type(column).__name__, *column.dump(self.size, capacity))
+                                         for name, column in self.columns.items()}
+
+    @classmethod
+    def restore(cls, size, capacity, columns):
+        # The inverse of dump(); arrays may be memory-mapped files
+        table = cls()
+        for name, (kind, arrays, meta) in columns.items():
+            column = table.columns.setdefault(name, TextColumn())
+            if type(column).__name__ != kind:
+                raise ValueError(f"{name} is stored as {kind}, expected {type(column).__name__}")
+            column.restore(arrays, meta, capacity)
+        for name, column in table.columns.items():
+            if name not in columns:
+                column.resize(capacity)
+        table._capacity = capacity
+        table.size = size
+        table.rows = dict(zip(table.columns[KEY].data[:size].tolist(), range(size)))
+        return table
+
+    def apply(self, entries):
+        # Replays journal-style entries; returns the rows that changed
+        with self._lock:
+            touched = {}
+            changes = {}
+            for entry in entries:
+                code = entry.get(KEY)
+                row = self.rows.get(code)
+                if row is None:
+                    self._reserve(1)
+                    row = self.rows[code] = self.size
+                    self.columns[KEY].data[row] = code
+                    self.size += 1
+                touched[row] = None
+                for name, value in entry.get("fields", {}).items():
+                    if name != KEY:
+                        changes.setdefault(name, {})[row] = value
+            for name, values in changes.items():
+                self._column(name).set(np.fromiter(values, dtype=np.int64, count=len(values)), list(values.values()))
+            return list(touched)
+
+    def value(self, row, name):
+        column = self.columns.get(name)
+        return None if column is None else column.value(row)
+
+    def view(self, row):
+        return RecordView(self, row)
+
+    def views(self, rows=None):
+        return [RecordView(self, row) for row in (range(self.size) if rows is None else rows)]
+
+    def get(self, unique_code):
+        row = self.rows.get(unique_code)
+        return None if row is None else RecordView(self, row)
+
+    def frame(self, columns=None, rows=None):
+        # Typed DataFrame of some columns for all rows, a slice or a row array
+        columns = list(columns or self.columns)
+        with self._lock:
+            index = np.arange(self.size)
+            if rows is not None:
+                index = index[rows]
+            data = {c: self.columns[c].series(index) for c in columns if c in self.columns}
+        return pd.DataFrame(data, columns=columns)
+
+    def nbytes(self):
+        return sum(column.nbytes() for column in self.columns.values())
+
+
+class RecordView(Mapping):
+    # One row as a read-only mapping; unset fields are absent, as in the old
+    # dicts. Changes go through RecordStore.update and show up here once the
+    # store's refresh has applied them.
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, name):
+        value = self.table.value(self.row, name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __iter__(self):
+        return (name for name in list(self.table.columns) if self.table.value(self.row, name) is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"RecordView({dict(self)!r})"
@@ -0,0 +1,186 @@
+import re
+import threading
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from search import normalize
+
+# Duplicate registration checks. Each record gets a few blocking keys
+# (phonetic last name + DOB, normalized email, normalized phone); a new
+# registration is checked with one dict lookup per key instead of against
+# every record. The batch report sorts the records on the same keys and
+# compares each one only with its neighbours in a small window.
+KEY = "Unique Code"
+REPORT_WINDOW = 10
+KINDS = ('name', 'email', 'phone')
+REASONS = {
+    "name": "Similar last name and same DOB",
+    "email": "Same email",
+    "phone": "Same phone number",
+}
+_SOUNDEX = str.maketrans("bfpvcgjkqsxzdtlmnr", "111122222222334556")
+_NOT_DIGIT = re.compile(r"\D")
+
+
+def soundex(name):
+    # American Soundex of the whole name, e.g. "Mensah" -> "M520"
+    letters = "".join(c for c in normalize(name) if "a" <= c <= "z")
+    if not letters:
+        return ""
+    digits = letters.translate(_SOUNDEX)
+    code = []
+    previous = digits[0]
+    for letter, digit in zip(letters[1:], digits[1:]):
+        if digit.isdigit() and digit != previous:
+            code.append(digit)
+        if letter not in "hw":
+            previous = digit
+    return (letters[0].upper() + "".join(code) + "000")[:4]
+
+
+def _dob(value):
+    if value is None or value is pd.NaT or (isinstance(value, float) and value != value):
+        return ""
+    try:
+        return pd.Timestamp(value).strftime('%Y-%m-%d')
+    except (ValueError, TypeError):
+        return ""
+
+
+def _email(value):
+    return normalize(value).replace(" ", "") if isinstance(value, str) and "@" in value else ""
+
+
+def _phone(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    if isinstance(value, float):
+        value = int(value)
+    digits = _NOT_DIGIT.sub("", str(value))
+    # Last nine digits, so 0771234567 and +94 77 123 4567 agree
+    return digits[-9:] if len(digits) >= 7 else ""
+
+
+def blocking_keys(record):
+    # (name key, email key, phone key), "" where the record lacks the fields
+    last, dob = soundex(record.get('Last Name')), _dob(record.get('DOB'))
+    email = _email(record.get('Email'))
+    phone = _phone(record.get('Phone Number'))
+    return (f"name:{last}:{dob}" if last and dob else "",
+            f"email:{email}" if email else "",
+            f"phone:{phone}" if phone else "")
+
+
+def blocking_frame(df):
+    # The same keys for a whole frame, one column per key type ("" if absent)
+    if df.empty:
+        return pd.DataFrame({kind: pd.Series(dtype=object) for kind in KINDS}, index=df.index)
+
+    def per_value(column, func):
+        values = df[column].astype(object) if column in df else pd.Series(None, index=df.index, dtype=object)
+        uniques = values.dropna().unique()
+        return values.map(dict(zip(uniques, map(func, uniques)))).fillna("")
+
+    last = per_value('Last Name', soundex)
+    dob = df['DOB'].dt.strftime('%Y-%m-%d').fillna("") if 'DOB' in df else pd.Series("", index=df.index)
+    name = ("name:" + last + ":" + dob).where((last != "") & (dob != ""), "")
+    email = per_value('Email', _email)
+    phone = per_value('Phone Number', _phone)
+    return pd.DataFrame({
+        'name': name,
+        'email': ("email:" + email).where(email != "", ""),
+        'phone': ("phone:" + phone).where(phone != "", ""),
+    }, index=df.index)
+
+
+class DuplicateIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._blocks = defaultdict(set)  # blocking key -> Unique Codes
+        self._keys = {}  # Unique Code -> its blocking keys
+
+    @classmethod
+    def from_table(cls, table):
+        index = cls()
+        df = table.frame([KEY, 'Last Name', 'DOB', 'Email', 'Phone Number'])
+        keys = blocking_frame(df)
+        codes = df[KEY].tolist()
+        columns = [keys[kind].tolist() for kind in KINDS]
+        blocks = index._blocks
+        for column in columns:
+            for code, k in zip(codes, column):
+                if k:
+                    blocks[k].add(code)
+        index._keys = dict(zip(codes, zip(*columns)))
+        return index
+
+    def add(self, record):
+        code = record.get(KEY)
+        keys = blocking_keys(record)
+        with self._lock:
+            old = self._keys.get(code, ())
+            if old == keys:
+                return
+            for k in old:
+                if k:
+                    self._blocks[k].discard(code)
+            for k in keys:
+                if k:
+                    self._blocks[k].add(code)
+            self._keys[code] = keys
+
+    def add_many(self, records):
+        for record in records:
+            self.add(record)
+
+    def find(self, record):
+        # {Unique Code: [reasons]} for registered people sharing a blocking key
+        found = {}
+        with self._lock:
+            for kind, k in zip(KINDS, blocking_keys(record)):
+                for code in self._blocks.get(k, ()) if k else ():
+                    if code != record.get(KEY):
+                        found.setdefault(code, []).append(REASONS[kind])
+        return found
+
+
+def duplicate_report(table, window=REPORT_WINDOW):
+    # Sorted-neighbourhood pass per key type: after sorting on the key each
+    # record is compared with the next window-1 records only, as whole
+    # shifted columns, so the cost is O(n log n + n * window)
+    df = table.frame([KEY, 'First Name', 'Last Name', 'DOB', 'Department', 'Email', 'Phone Number'])
+    keys = blocking_frame(df)
+    pairs = []
+    for kind in KINDS:
+        order = np.argsort(keys[kind].to_numpy(dtype=object).astype(str), kind='stable')
+        sorted_keys = keys[kind].to_numpy(dtype=object)[order]
+        for offset in range(1, window):
+            same = (sorted_keys[:-offset] == sorted_keys[offset:]) & (sorted_keys[:-offset] != "")
+            hits = np.flatnonzero(same)
+            if len(hits):
+                pairs.append(pd.DataFrame({'a': order[hits], 'b': order[hits + offset], 'Reason': REASONS[kind]}))
+    columns = ['Unique Code', 'Name', 'DOB', 'Department', 'Duplicate Code', 'Duplicate Name',
+               'Duplicate DOB', 'Duplicate Department', 'Reasons']
+    if not pairs:
+        return pd.DataFrame(columns=columns)
+    found = pd.concat(pairs)
+    first, second = np.minimum(found['a'], found['b']), np.maximum(found['a'], found['b'])
+    found = pd.DataFrame({'a': first, 'b': second, 'Reason': found['Reason']})
+    found = found.groupby(['a', 'b'])['Reason'].agg(lambda r: "; ".join(sorted(set(r)))).reset_index()
+
+    name = df['First Name'].astype(object).fillna("") + " " + df['Last Name'].astype(object).fillna("")
+    dob = df['DOB'].dt.strftime('%Y-%m-%d')
+    a, b = found['a'].to_numpy(), found['b'].to_numpy()
+    return pd.DataFrame({
+        'Unique Code': df[KEY].to_numpy()[a],
+        'Name': name.to_numpy()[a],
+        'DOB': dob.to_numpy()[a],
+        'Department': df['Department'].astype(object).to_numpy()[a],
+        'Duplicate Code': df[KEY].to_numpy()[b],
+        'Duplicate Name': name.to_numpy()[b],
+        'Duplicate DOB': dob.to_numpy()[b],
+        'Duplicate Department': df['Department'].astype(object).to_numpy()[b],
+        'Reasons': found['Reason'].to_numpy(),
+    }, columns=columns)
@@ -0,0 +1,183 @@
+import gzip
+import io
+import json
+
+import pandas as pd
+
+import risk
+
+# Chunked export of the shared record table. Filters run on each chunk
+# before it is serialized, so memory stays bounded by one chunk plus the
+# output file instead of a full DataFrame, its CSV text and the encoded
+# bytes at once.
+CHUNK_ROWS = 10000
+FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "CSV (gzip)": ("csv.gz", "application/gzip"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+NUMERIC_COLUMNS = ['Age', 'Weight', 'Height', 'BMI', 'Blood Glucose']
+# Delta exports for the nightly sync: the records (or only the fields)
+# changed after a watermark, each with the sequence of its latest change.
+# The highest sequence in the file is the watermark for the next pull.
+DELTA_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "JSON Lines": ("jsonl", "application/x-ndjson"),
+}
+SEQ_COLUMN = 'Change Seq'
+CHANGED_COLUMN = 'Changed Fields'
+KEY_COLUMN = 'Unique Code'
+
+
+def export_columns(table):
+    return list(table.columns)
+
+
+def _filter(df, departments=None, start=None, end=None, risk_categories=None):
+    mask = pd.Series(True, index=df.index)
+    if departments:
+        mask &= df['Department'].isin(departments)
+    if start is not None or end is not None:
+        registered = pd.to_datetime(df['Registration Date'], errors='coerce')
+        if start is not None:
+            mask &= registered >= pd.Timestamp(start)
+        if end is not None:
+            mask &= registered <= pd.Timestamp(end)
+    if risk_categories:
+        assessed = risk.assess(df[mask])
+        flagged = assessed[risk_categories].any(axis=1)
+        mask &= flagged.reindex(df.index, fill_value=False)
+    return df[mask]
+
+
+def iter_chunks(table, columns=None, chunk_rows=CHUNK_ROWS, **filters):
+    columns = columns or export_columns(table)
+    for start in range(0, len(table), chunk_rows):
+        chunk = _filter(table.frame(columns, slice(start, start + chunk_rows)), **filters)
+        if len(chunk):
+            yield chunk
+
+
+def _typed(df):
+    df = df.copy()
+    for c in NUMERIC_COLUMNS:
+        df[c] = pd.to_numeric(df[c], errors='coerce')
+    df['DOB'] = pd.to_datetime(df['DOB'], errors='coerce')
+    df['Referred'] = df['Referred'].map({True: True, False: False, 1: True, 0: False}).astype('boolean')
+    for c in df.columns:
+        if c not in NUMERIC_COLUMNS and c not in ('DOB', 'Referred'):
+            df[c] = df[c].astype('string')
+    return df
+
+
+def _write_parquet(table, out, **filters):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = export_columns(table)
+    writer = None
+    for chunk in iter_chunks(table, columns, **filters):
+        arrow = pa.Table.from_pandas(_typed(chunk), preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(out, arrow.schema, compression='zstd')
+        writer.write_table(arrow.cast(writer.schema))
+    if writer is None:
+        empty = pa.Table.from_pandas(_typed(pd.DataFrame(columns=columns)), preserve_index=False)
+        pq.write_table(empty, out)
+    else:
+        writer.close()
+
+
+def _write_csv(table, out, **filters):
+    columns = export_columns(table)
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='', write_through=True)
+    header = True
+    for chunk in iter_chunks(table, columns, **filters):
+        chunk.to_csv(text, index=False, header=header)
+        header = False
+    if header:
+        pd.DataFrame(columns=columns).to_csv(text, index=False)
+    text.flush()
+    text.detach()
+
+
+def write_export(table, fmt, out, **filters):
+    # Writes the filtered records to the binary file object out
+    if fmt == "Parquet":
+        _write_parquet(table, out, **filters)
+    elif fmt == "CSV (gzip)":
+        with gzip.GzipFile(fileobj=out, mode='wb') as gz:
+            _write_csv(table, gz, **filters)
+    else:
+        _write_csv(table, out, **filters)
+
+
+def _json_value(value):
+    if value is None or value is pd.NaT or (isinstance(value, float) and value != value):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.strftime('%Y-%m-%d') if value == value.normalize() else value.isoformat()
+    if hasattr(value, "item"):  # numpy scalars
+        return value.item()
+    return value
+
+
+def _delta_columns(table):
+    return [KEY_COLUMN] + [c for c in export_columns(table) if c != KEY_COLUMN]
+
+
+def iter_delta(table, changed, fields_only=False, chunk_rows=CHUNK_ROWS):
+    # changed: ChangeLog.changed() output. Yields (chunk, fields per row),
+    # the fields being None where the whole record is wanted
+    columns = _delta_columns(table)
+    known = [(code, seq, fields) for code, (seq, fields) in changed.items() if code in table.rows]
+    for start in range(0, len(known), chunk_rows):
+        part = known[start:start + chunk_rows]
+        chunk = table.frame(columns, [table.rows[code] for code, _, _ in part])
+        chunk.insert(1, SEQ_COLUMN, [seq for _, seq, _ in part])
+        fields = [None if not fields_only or f is None else [c for c in columns[1:] if c in f]
+                  for _, _, f in part]
+        yield chunk, fields
+
+
+def _write_delta_csv(table, changed, out, fields_only):
+    columns = _delta_columns(table)
+    header = columns[:1] + [SEQ_COLUMN] + columns[1:]
+    if fields_only:
+        # Blank cells are fields the change did not touch; the list tells
+        # them apart from values that were cleared
+        header.insert(2, CHANGED_COLUMN)
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='', write_through=True)
+    pd.DataFrame(columns=header).to_csv(text, index=False)
+    for chunk, fields in iter_delta(table, changed, fields_only):
+        if fields_only:
+            for c in columns[1:]:
+                chunk[c] = chunk[c].where([f is None or c in f for f in fields])
+            chunk.insert(2, CHANGED_COLUMN, [";".join(columns[1:] if f is None else f) for f in fields])
+        chunk.to_csv(text, index=False, header=False)
+    text.flush()
+    text.detach()
+
+
+def _write_delta_jsonl(table, changed, out, fields_only):
+    for chunk, fields in iter_delta(table, changed, fields_only):
+        lines = []
+        for row, f in zip(chunk.astype(object).to_dict('records'), fields):
+            if f is not None:
+                row = {c: row[c] for c in [KEY_COLUMN, SEQ_COLUMN] + f}
+            lines.append(json.dumps({c: _json_value(v) for c, v in row.items()}, ensure_ascii=False))
+        out.write(("\n".join(lines) + "\n").encode('utf-8'))
+
+
+def write_delta(table, change_log, since, fmt, out, fields_only=False, upto=None):
+    # Writes what changed after the watermark since (up to and including
+    # upto, the current watermark if not given) to the binary file object
+    # out; the table must already hold those changes, i.e. the store was
+    # refreshed after upto was read. Returns (records written, upto).
+    upto = change_log.watermark() if upto is None else upto
+    changed = change_log.changed(since, upto)
+    if fmt == "JSON Lines":
+        _write_delta_jsonl(table, changed, out, fields_only)
+    else:
+        _write_delta_csv(table, changed, out, fields_only)
+    return sum(code in table.rows for code in changed), upto
@@ -0,0 +1,159 @@
+import json
+import re
+import sqlite3
+import threading
+from datetime import datetime
+
+import pandas as pd
+
+# Append-only measurement history. Every saved reading becomes one row
+# (patient, type, values, time, station) indexed by patient and time, so a
+# re-screening never overwrites the previous one and one patient's latest
+# values or trend is an index range scan. The record itself keeps only the
+# latest values, which the cohort views and exports read.
+KEY = "Unique Code"
+MEASUREMENTS = {
+    "Blood Pressure": ['Blood Pressure', 'BP Notes'],
+    "BMI": ['Weight', 'Height', 'BMI', 'BMI Classification'],
+    "Blood Glucose": ['Blood Glucose', 'Fasting Status'],
+    "Visual Acuity": ['Visual Acuity Right', 'Visual Acuity Left',
+                      'Right Eye with Glasses', 'Left Eye with Glasses', 'Visual Examination Notes'],
+}
+DATE_FIELDS = {
+    "Blood Pressure": 'BP Date',
+    "BMI": 'BMI Date',
+    "Blood Glucose": 'Glucose Date',
+    "Visual Acuity": 'Vision Test Date',
+}
+TREND_COLUMNS = ['Systolic', 'Diastolic', 'BMI', 'Blood Glucose']
+# Same format risk.parse_bp accepts, for one reading at a time
+_BP = re.compile(r"^\s*(\d+)\s*/\s*(\d+)\s*$")
+
+
+def _plain(value):
+    if value is None or value is pd.NaT or (isinstance(value, float) and value != value):
+        return None
+    if hasattr(value, "item"):  # numpy scalars
+        return value.item()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+def _values(kind, fields):
+    values = {f: _plain(fields.get(f)) for f in MEASUREMENTS[kind]}
+    if kind == "Blood Pressure":
+        match = _BP.match(str(values['Blood Pressure'] or ""))
+        values['Systolic'] = int(match.group(1)) if match else None
+        values['Diastolic'] = int(match.group(2)) if match else None
+    return json.dumps(values, ensure_ascii=False)
+
+
+class MeasurementHistory:
+    def __init__(self, path, station=""):
+        self.path = path
+        self.station = station
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS measurements (
+                id INTEGER PRIMARY KEY,
+                unique_code TEXT NOT NULL,
+                type TEXT NOT NULL,
+                value_json TEXT NOT NULL,
+                measured_at TEXT NOT NULL,
+                station TEXT)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_measurements_patient "
+                         "ON measurements (unique_code, measured_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @classmethod
+    def for_records(cls, path, store, station=""):
+        # A new history starts from the readings already on the records
+        history = cls(path, station)
+        if history.empty():
+            history.seed(store.table)
+        return history
+
+    def empty(self):
+        return self._connect().execute("SELECT 1 FROM measurements LIMIT 1").fetchone() is None
+
+    def add_changes(self, changes, measured_at=None):
+        # changes: (unique_code, {field: value}) pairs as saved to the records;
+        # each measurement type a change touches becomes one history row
+        measured_at = measured_at or datetime.now().isoformat(timespec="seconds")
+        return self.add_entries({KEY: code, "ts": measured_at, "fields": fields} for code, fields in changes)
+
+    def add_entries(self, entries):
+        # Journal-style entries; a merged one keeps its own time and station
+        rows = []
+        for entry in entries:
+            fields = entry.get("fields", {})
+            for kind, names in MEASUREMENTS.items():
+                if names[0] in fields:
+                    rows.append((entry[KEY], kind, _values(kind, fields), entry.get("ts", ""),
+                                 entry.get("station") or self.station))
+        if rows:
+            with self._connect() as conn:
+                conn.executemany("INSERT INTO measurements (unique_code, type, value_json, measured_at, station) "
+                                 "VALUES (?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def seed(self, table):
+        rows = []
+        for kind, names in MEASUREMENTS.items():
+            df = table.frame([KEY, DATE_FIELDS[kind], 'Registration Date'] + names)
+            df = df[df[names[0]].notna()]
+            when = df[DATE_FIELDS[kind]].fillna(df['Registration Date']).dt.strftime('%Y-%m-%d').fillna("")
+            for code, day, fields in zip(df[KEY], when, df[names].astype(object).to_dict('records')):
+                rows.append((code, kind, _values(kind, fields), day, "import"))
+        with self._connect() as conn:
+            conn.executemany("INSERT INTO measurements (unique_code, type, value_json, measured_at, station) "
+                             "VALUES (?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def history(self, unique_code):
+        # One patient's readings, oldest first, values spread into columns
+        rows = self._connect().execute(
+            "SELECT type, measured_at, station, value_json FROM measurements "
+            "WHERE unique_code = ? ORDER BY measured_at, id", (unique_code,)).fetchall()
+        return pd.DataFrame([{'Type': kind, 'Measured At': when, 'Station': station, **json.loads(values)}
+                             for kind, when, station, values in rows])
+
+    def latest(self, unique_code):
+        # {type: {values..., 'Measured At', 'Station'}} for the newest reading of each type
+        latest = {}
+        rows = self._connect().execute(
+            "SELECT type, measured_at, station, value_json FROM measurements "
+            "WHERE unique_code = ? ORDER BY measured_at DESC, id DESC", (unique_code,))
+        for kind, when, station, values in rows:
+            if kind not in latest:
+                latest[kind] = {**json.loads(values), 'Measured At': when, 'Station': station}
+        return latest
+
+    def trend(self, unique_code):
+        # Numeric readings over time, ready for a line chart
+        df = self.history(unique_code)
+        if df.empty:
+            return pd.DataFrame(columns=TREND_COLUMNS)
+        df['Measured At'] = pd.to_datetime(df['Measured At'], errors='coerce', format='ISO8601')
+        trend = df.reindex(columns=['Measured At'] + TREND_COLUMNS).set_index('Measured At')
+        return trend.apply(pd.to_numeric, errors='coerce').dropna(how='all').groupby(level=0).last()
+
+
+def describe(kind, values):
+    # One-line reading for the latest-values table
+    if kind == "Blood Pressure":
+        return f"{values.get('Blood Pressure')} mmHg"
+    if kind == "BMI":
+        return f"{values.get('BMI')} ({values.get('BMI Classification')}), {values.get('Weight')} kg, {values.get('Height')} m"
+    if kind == "Blood Glucose":
+        return f"{values.get('Blood Glucose')} ({values.get('Fasting Status')})"
+    return f"R {values.get('Visual Acuity Right') or '-'}, L {values.get('Visual Acuity Left') or '-'}"
@@ -0,0 +1,89 @@
+import re
+import sqlite3
+import threading
+
+from settings import departments
+
+# Persistent per-department sequence numbers for Unique Codes. Each
+# allocation is one short IMMEDIATE transaction on a small SQLite file, so
+# it is atomic across sessions and across server processes and never needs
+# the records themselves.
+# "KMPH0042" -> ("PH", "0042")
+_CODE = re.compile(r"^.{2}([A-Z]{2})(\d+)$")
+PREFIXES = list(departments.values()) + ["NA"]
+
+
+def format_code(first_name, last_name, department_code, sequence):
+    return f"{first_name[0].upper()}{last_name[0].upper()}{department_code}{str(sequence).zfill(4)}"
+
+
+class SequenceAllocator:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS sequences (prefix TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @classmethod
+    def for_records(cls, path, store):
+        # Only a new sequence file is seeded from the records; after that
+        # the file alone knows the numbers, so a restart reads no codes
+        allocator = cls(path)
+        if allocator.empty():
+            allocator.seed(store.by_code)
+        return allocator
+
+    def empty(self):
+        return self._connect().execute("SELECT 1 FROM sequences LIMIT 1").fetchone() is None
+
+    def _transaction(self, statements):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = statements(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def allocate(self, prefix, count=1):
+        # Reserves count consecutive numbers and returns the first
+        return self.allocate_blocks({prefix: count})[prefix]
+
+    def allocate_blocks(self, counts):
+        # Reserves a block per prefix in a single transaction; returns the
+        # first number of each block
+        def bump(conn):
+            firsts = {}
+            for prefix, count in counts.items():
+                conn.execute("INSERT OR IGNORE INTO sequences (prefix, value) VALUES (?, 0)", (prefix,))
+                conn.execute("UPDATE sequences SET value = value + ? WHERE prefix = ?", (count, prefix))
+                value = conn.execute("SELECT value FROM sequences WHERE prefix = ?", (prefix,)).fetchone()[0]
+                firsts[prefix] = value - count + 1
+            return firsts
+        return self._transaction(bump)
+
+    def seed(self, codes):
+        # Moves each department's sequence past the highest number its own
+        # codes use; codes without a known department count towards "NA"
+        highest = dict.fromkeys(PREFIXES, 0)
+        for code in codes:
+            match = _CODE.match(str(code))
+            if match:
+                prefix = match.group(1) if match.group(1) in highest else "NA"
+                highest[prefix] = max(highest[prefix], int(match.group(2)))
+
+        def raise_to(conn):
+            for prefix, value in highest.items():
+                conn.execute("INSERT OR IGNORE INTO sequences (prefix, value) VALUES (?, 0)", (prefix,))
+                conn.execute("UPDATE sequences SET value = MAX(value, ?) WHERE prefix = ?", (value, prefix))
+        self._transaction(raise_to)
@@ -0,0 +1,323 @@
+import json
+import logging
+import queue
+import random
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import batch
+import risk
+from history import DATE_FIELDS, MEASUREMENTS
+from measurements import calculate_bmis
+from settings import INGEST_BATCH, INGEST_WAIT
+
+# Headless ingestion of device readings (BP monitors, glucometers, scales).
+# Readings arrive as JSON objects keyed by Unique Code, either over a small
+# local HTTP service or from a file on the command line, and go through the
+# same validation and BMI rules as the batch entry grid. Concurrent requests
+# are queued and committed together, so a burst of single-reading posts
+# still costs one journal append and one refresh per batch.
+log = logging.getLogger(__name__)
+
+KEY = "Unique Code"
+READING_COLUMNS = ['Systolic', 'Diastolic', 'Weight', 'Height', 'Blood Glucose', 'Fasting Status']
+NUMERIC_COLUMNS = ['Systolic', 'Diastolic', 'Weight', 'Height', 'Blood Glucose']
+MAX_BODY = 16 << 20
+
+
+def _frame(readings):
+    df = pd.DataFrame.from_records(list(readings))
+    for c in [KEY, 'Date'] + READING_COLUMNS:
+        if c not in df:
+            df[c] = None
+    return df.reset_index(drop=True)
+
+
+def ingest(store, readings, today=None):
+    # readings: dicts with Unique Code, any of the READING_COLUMNS and an
+    # optional Date (YYYY-MM-DD) the reading was taken. Writes the valid ones
+    # as one batch and returns (accepted, rejected rows, flagged rows), where
+    # the row numbers count from 0 within readings. A reading older than the
+    # record's own one of its kind only goes into the history.
+    today = today or datetime.today().strftime('%Y-%m-%d')
+    df = _frame(readings)
+    codes = df[KEY].astype(object)
+    problems = pd.Series("", index=df.index)
+
+    def problem(mask, message):
+        nonlocal problems
+        problems = problems.where(~np.asarray(mask, dtype=bool), problems + "; " + message)
+
+    known = codes.map(lambda c: isinstance(c, str) and c in store.by_code).astype(bool)
+    problem(~known, "Unknown Unique Code")
+    given = df[READING_COLUMNS].notna()
+    problem(~given.any(axis=1), "No readings given")
+    for c in NUMERIC_COLUMNS:
+        numeric = pd.to_numeric(df[c], errors='coerce')
+        problem(given[c] & numeric.isna(), f"{c} must be a number")
+        df[c] = numeric
+    problem(given['Fasting Status'] & df['Blood Glucose'].isna(), "Fasting Status needs a Blood Glucose")
+    dates = pd.to_datetime(df['Date'], errors='coerce', format='%Y-%m-%d')
+    problem(df['Date'].notna() & dates.isna(), "Date must look like 2024-01-31")
+    df['Date'] = dates.dt.strftime('%Y-%m-%d').fillna(today)
+
+    # The grid's checks see every reading as an edit of an empty row
+    edited = pd.DataFrame({c: df[c] if c in df else None for c in batch.GRID_COLUMNS})
+    edited[KEY] = codes
+    edited['Name'] = np.arange(len(df))  # carries the row number into the error report
+    original = edited.copy()
+    original[batch.EDITABLE_COLUMNS] = np.nan
+    ok = (problems == "").to_numpy()
+    changes, errors = batch.collect_changes(original[ok], edited[ok], df.loc[ok, 'Date'])
+    problems.iloc[errors['Name'].to_numpy(dtype=int)] = ("; " + errors['Errors']).to_numpy()
+
+    failed = (problems != "").to_numpy()
+    rejected = pd.DataFrame({'Row': np.flatnonzero(failed), KEY: codes[failed].to_numpy(),
+                             'Errors': problems[failed].str.lstrip("; ").to_numpy()})
+    changes, readings = _current(store, changes, today)
+    if readings:
+        store.write_many(changes, readings)
+    return len(readings), rejected, flagged(df[~failed])
+
+
+def _current(store, changes, today):
+    # A device may upload readings days after taking them. Every reading
+    # goes into the history at the date it was taken, but a measurement only
+    # replaces the record's values when the record's own date for it is not
+    # newer. Returns (changes for the records, history entries).
+    now = datetime.now().isoformat(timespec="seconds")
+    rows = [store.by_code[code] for code, _ in changes]
+    dated = store.table.frame(list(DATE_FIELDS.values()), rows)
+    latest = {c: dated[c].dt.strftime('%Y-%m-%d').fillna("").tolist() for c in dated}
+    current = []
+    readings = []
+    for i, (code, fields) in enumerate(changes):
+        keep = dict(fields)
+        day = ""
+        for kind, names in MEASUREMENTS.items():
+            date_field = DATE_FIELDS[kind]
+            if date_field in fields:
+                day = fields[date_field]
+                if latest[date_field][i] > day:
+                    for f in names + [date_field]:
+                        keep.pop(f, None)
+        readings.append({KEY: code, "ts": now if day == today else day, "fields": fields})
+        if keep:
+            current.append((code, keep))
+    return current, readings
+
+
+def flagged(df):
+    # Risk conditions each accepted reading meets on its own, for the device
+    # to show; the record's assessment still combines every reading
+    bmi, _ = calculate_bmis(df['Weight'], df['Height'])
+    fasting = df['Fasting Status'].astype(object)
+    conditions = risk.flags(df['Systolic'].to_numpy(dtype=float), df['Diastolic'].to_numpy(dtype=float), bmi,
+                            df['Blood Glucose'].to_numpy(dtype=float),
+                            (fasting == "Fasting").to_numpy(), (fasting == "Random").to_numpy())
+    names = pd.Series("", index=df.index)
+    for name, mask in conditions.items():
+        names = names.where(~mask, names + ", " + name)
+    hit = (names != "").to_numpy()
+    return pd.DataFrame({'Row': df.index[hit], KEY: df[KEY].to_numpy()[hit],
+                         'Conditions': names[hit].str.lstrip(", ").to_numpy()})
+
+
+def result(accepted, rejected, flagged_rows):
+    return {
+        'accepted': accepted,
+        'rejected': rejected.to_dict('records'),
+        'flagged': flagged_rows.to_dict('records'),
+    }
+
+
+class Ingestor:
+    # Group commit: requests queue their readings and one writer thread
+    # validates and writes everything queued within max_wait seconds (up to
+    # batch_size readings) together, then hands each request its own rows
+    def __init__(self, store, batch_size=INGEST_BATCH, max_wait=INGEST_WAIT):
+        self.store = store
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+        self._thread.start()
+        return self
+
+    def submit(self, readings):
+        # Blocks until the readings are written; returns the result dict
+        if not readings:
+            return {'accepted': 0, 'rejected': [], 'flagged': []}
+        job = {'readings': readings, 'done': threading.Event()}
+        self._queue.put(job)
+        job['done'].wait()
+        if 'error' in job:
+            raise job['error']
+        return job['result']
+
+    def _take(self):
+        jobs = [self._queue.get()]
+        size = len(jobs[0]['readings'])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.batch_size:
+            try:
+                job = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            jobs.append(job)
+            size += len(job['readings'])
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._take()
+            try:
+                self.store.refresh()
+                accepted, rejected, flagged_rows = ingest(
+                    self.store, [r for job in jobs for r in job['readings']])
+                log.info("Ingested %d readings from %d requests, %d rejected",
+                         accepted, len(jobs), len(rejected))
+                start = 0
+                for job in jobs:
+                    end = start + len(job['readings'])
+                    mine = [frame[(frame['Row'] >= start) & (frame['Row'] < end)].assign(Row=lambda f: f['Row'] - start)
+                            for frame in (rejected, flagged_rows)]
+                    job['result'] = result(len(job['readings']) - len(mine[0]), *mine)
+                    start = end
+            except Exception as e:
+                log.exception("Ingest batch failed")
+                for job in jobs:
+                    job['error'] = e
+            for job in jobs:
+                job['done'].set()
+
+
+def parse_readings(body):
+    # A JSON list of readings, {"readings": [...]}, or one reading per line
+    text = body.decode("utf-8") if isinstance(body, bytes) else body
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(data, dict):
+        data = data.get('readings', [data])
+    if not isinstance(data, list) or not all(isinstance(r, dict) for r in data):
+        raise ValueError("Expected a list of reading objects")
+    return data
+
+
+def read_readings(path):
+    if path.lower().endswith(".csv"):
+        df = pd.read_csv(path, dtype={KEY: str, 'Date': str, 'Fasting Status': str})
+        return df.astype(object).where(df.notna(), None).to_dict('records')
+    with open(path, "rb") as f:
+        return parse_readings(f.read())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    ingestor = None
+    token = ""
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        if self.token and self.headers.get("Authorization") != f"Bearer {self.token}":
+            self._reply(401, {'error': "Missing or wrong token"})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path != "/health":
+            return self._reply(404, {'error': "Not found"})
+        self._reply(200, {'records': len(self.ingestor.store), 'version': self.ingestor.store.version})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if self.path != "/readings":
+            return self._reply(404, {'error': "Not found"})
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY:
+            return self._reply(413, {'error': f"Send at most {MAX_BODY} bytes per request"})
+        try:
+            readings = parse_readings(self.rfile.read(length))
+        except ValueError as e:
+            return self._reply(400, {'error': str(e)})
+        try:
+            self._reply(200, self.ingestor.submit(readings))
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # many devices connecting at once
+
+
+def serve(store, host, port, token="", batch_size=INGEST_BATCH, max_wait=INGEST_WAIT):
+    # Returns the server; call serve_forever() on it (or shutdown() to stop)
+    handler = type("IngestHandler", (_Handler,), {
+        'ingestor': Ingestor(store, batch_size, max_wait).start(),
+        'token': token,
+    })
+    return _Server((host, port), handler)
+
+
+def fake_reading(code, rng):
+    # One plausible device reading; about one in fifty is out of range
+    kind = rng.choice(("bp", "bmi", "glucose"))
+    if kind == "bp":
+        reading = {'Systolic': rng.randint(95, 180), 'Diastolic': rng.randint(60, 110)}
+    elif kind == "bmi":
+        reading = {'Weight': round(rng.uniform(45, 110), 1), 'Height': round(rng.uniform(1.45, 1.95), 2)}
+    else:
+        reading = {'Blood Glucose': round(rng.uniform(4, 13), 1), 'Fasting Status': rng.choice(("Fasting", "Random"))}
+    if rng.random() < 0.02:
+        reading['Systolic'], reading['Diastolic'] = 400, 80
+    return dict(reading, **{KEY: code})
+
+
+def fake_feed(url, codes, devices=8, readings=20000, per_request=100, token="", seed=0):
+    # Several simulated devices posting readings for the given codes at
+    # once; returns (readings sent, accepted, rejected, seconds)
+    def device(n):
+        rng = random.Random(seed + n)
+        sent = accepted = rejected = 0
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        while sent < readings // devices:
+            body = [fake_reading(rng.choice(codes), rng) for _ in range(min(per_request, readings // devices - sent))]
+            request = urllib.request.Request(url.rstrip("/") + "/readings", json.dumps(body).encode("utf-8"), headers)
+            with urllib.request.urlopen(request) as response:
+                reply = json.load(response)
+            sent += len(body)
+            accepted += reply['accepted']
+            rejected += len(reply['rejected'])
+        return sent, accepted, rejected
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(devices) as pool:
+        totals = [sum(t) for t in zip(*pool.map(device, range(devices)))]
+    return (*totals, time.perf_counter() - start)
@@ -0,0 +1,247 @@
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime
+
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:  # Windows: threads of one process are still serialized
+    fcntl = None
+
+# Append-only change journal kept next to the CSV snapshot.
+# Each line holds only the fields one save touched, keyed by Unique Code,
+# so a save costs one small fsync'd append instead of a full-file rewrite.
+KEY = "Unique Code"
+JOURNAL_SUFFIX = ".journal"
+
+log = logging.getLogger(__name__)
+
+_append_lock = threading.Lock()
+
+
+def journal_path(data_file):
+    return data_file + JOURNAL_SUFFIX
+
+
+def compacting_path(data_file):
+    # Where the journal sits while compaction folds it into the snapshot
+    return journal_path(data_file) + ".compacting"
+
+
+def archive_path(data_file):
+    # Every entry already folded into the snapshot, oldest first
+    return journal_path(data_file) + ".archive"
+
+
+def journal_files(data_file):
+    # The complete change history in order: archive, compacting, live journal
+    paths = [archive_path(data_file), compacting_path(data_file), journal_path(data_file)]
+    return [p for p in paths if os.path.exists(p)]
+
+
+def _encode(value):
+    if isinstance(value, (datetime, date, pd.Timestamp)):
+        return value.isoformat()
+    if hasattr(value, "item"):  # numpy scalars
+        return value.item()
+    return str(value)
+
+
+def _clean(value):
+    if isinstance(value, float) and value != value:  # NaN
+        return None
+    return value
+
+
+def _line(entry):
+    return json.dumps(entry, default=_encode, ensure_ascii=False) + "\n"
+
+
+def _entry(unique_code, fields, ts, station=""):
+    entry = {KEY: unique_code, "ts": ts}
+    # Which station made the change, so journals from several can be merged
+    if station:
+        entry["station"] = station
+    entry["fields"] = {k: _clean(v) for k, v in fields.items()}
+    return entry
+
+
+@contextmanager
+def file_lock(path):
+    # Exclusive across processes while held, via a side file at path
+    with open(path, "ab") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def _last_newline(f, end):
+    # Offset just past the last "\n" in the file, 0 if there is none
+    block = 1 << 16
+    pos = end
+    while pos > 0:
+        start = max(0, pos - block)
+        f.seek(start)
+        chunk = f.read(pos - start)
+        i = chunk.rfind(b"\n")
+        if i >= 0:
+            return start + i + 1
+        pos = start
+    return 0
+
+
+def _append(path, data):
+    # Appends are serialized across processes, so a line without its "\n"
+    # at the end can only be one torn by a crash; it is cut off before the
+    # new lines go in, or they would be glued onto it and lost with it
+    with _append_lock, file_lock(path + ".lock"):
+        with open(path, "a+b") as f:
+            end = f.seek(0, os.SEEK_END)
+            if end:
+                f.seek(end - 1)
+                if f.read(1) != b"\n":
+                    keep = _last_newline(f, end)
+                    log.warning("Dropping %d bytes of a torn line at the end of %s", end - keep, path)
+                    f.truncate(keep)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+    return len(data)
+
+
+def append_entries(path, changes, station=""):
+    # One write and one fsync for a whole batch of (unique_code, fields);
+    # returns the number of bytes appended
+    ts = datetime.now().isoformat(timespec="milliseconds")
+    return _append(path, "".join(_line(_entry(code, fields, ts, station))
+                                 for code, fields in changes).encode("utf-8"))
+
+
+def append_entry(path, unique_code, fields, station=""):
+    return append_entries(path, [(unique_code, fields)], station)
+
+
+def append_journal(path, entries):
+    # Entries that already carry their own timestamp and station (a merge)
+    return _append(path, "".join(_line(_entry(e[KEY], e.get("fields", {}), e.get("ts", ""), e.get("station", "")))
+                                 for e in entries).encode("utf-8"))
+
+
+def tail(path, offset=0):
+    # Read the complete lines appended since offset. Returns the entries, the
+    # offset just past the last complete line and the file's inode, so a
+    # reader can tell a journal that grew from one that was replaced.
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return [], 0, None
+    entries = []
+    with f:
+        inode = os.fstat(f.fileno()).st_ino
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # Still being written, or torn by a crash mid-append
+                break
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                log.warning("Skipping an unreadable line at offset %d of %s", offset, path)
+            offset += len(line)
+    return entries, offset, inode
+
+
+def read_entries(path):
+    return tail(path)[0]
+
+
+def iter_entries(f):
+    # Streams the complete lines of an open binary journal
+    for line in f:
+        if not line.endswith(b"\n"):
+            break
+        try:
+            yield json.loads(line)
+        except ValueError:
+            log.warning("Skipping an unreadable line in %s", getattr(f, "name", "a journal"))
+
+
+def replay(records, entries, by_code=None):
+    # by_code lets a caller that keeps its own Unique Code index replay
+    # a few new entries without rebuilding it
+    if by_code is None:
+        by_code = {r.get(KEY): r for r in records}
+    for entry in entries:
+        code = entry.get(KEY)
+        record = by_code.get(code)
+        if record is None:
+            record = {KEY: code}
+            by_code[code] = record
+            records.append(record)
+        record.update(entry.get("fields", {}))
+        # Journaled registrations carry DOB as an ISO string
+        if isinstance(record.get("DOB"), str):
+            try:
+                record["DOB"] = pd.Timestamp(record["DOB"])
+            except ValueError:
+                record["DOB"] = pd.NaT
+    return records
+
+
+def read_snapshot(data_file):
+    if not os.path.exists(data_file):
+        return pd.DataFrame(columns=[KEY])
+    # A shard may hold only records registered without a DOB
+    dates = ["DOB"] if "DOB" in pd.read_csv(data_file, nrows=0).columns else None
+    return pd.read_csv(data_file, parse_dates=dates)
+
+
+def load_snapshot(data_file):
+    return read_snapshot(data_file).to_dict("records")
+
+
+def _write_snapshot(records, data_file):
+    tmp = data_file + ".tmp"
+    with open(tmp, "w", encoding="utf-8", newline="") as f:
+        pd.DataFrame(records).to_csv(f, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, data_file)
+
+
+def compact(data_file):
+    # Only one process compacts a data file at a time; appends are held off
+    # just while the journal is moved aside
+    with file_lock(data_file + ".compact.lock"):
+        return _compact(data_file)
+
+
+def _compact(data_file):
+    # Fold the journal into a fresh snapshot. The live journal is moved aside
+    # first so saves arriving meanwhile start a new one; the snapshot is then
+    # swapped in atomically and only after that is the old journal dropped.
+    # Replaying a journal onto a snapshot that already contains it is harmless.
+    path = journal_path(data_file)
+    pending = compacting_path(data_file)
+    with _append_lock, file_lock(path + ".lock"):
+        if os.path.exists(path) and not os.path.exists(pending):
+            os.replace(path, pending)
+    records = load_snapshot(data_file)
+    entries = read_entries(pending)
+    if not entries:
+        if os.path.exists(pending):
+            os.remove(pending)
+        return 0
+    replay(records, entries)
+    _write_snapshot(records, data_file)
+    # Folded entries keep their timestamps in the archive, which merges
+    # need to tell which of two changes to a field is the newer one
+    with open(pending, "rb") as src:
+        data = src.read()
+    _append(archive_path(data_file), data[:data.rfind(b"\n") + 1])
+    os.remove(pending)
+    return len(entries)
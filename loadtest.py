@@ -0,0 +1,354 @@
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import bench
+from changes import ChangeLog
+from history import MeasurementHistory
+from ids import SequenceAllocator, format_code
+from measurements import calculate_bmi
+from settings import (departments, CHANGES_FILE, DATA_FILE, DB_FILE, HISTORY_FILE, JOURNAL_COMPACT_THRESHOLD,
+                      SEQUENCE_FILE, STATION)
+from store import open_record_store
+
+# Many screening stations against one data directory at once, e.g.
+#   python cli.py load-test --sessions 16 --processes 2 --actions 200
+# Each session repeats a mix of registrations, patient searches and
+# measurement saves. The "store" client does what the app does on a rerun
+# (refresh, then the search or the save through the same RecordStore
+# calls) with sessions as threads sharing one store per process, so a
+# process stands for one server. The "app" client runs the real script
+# through Streamlit's AppTest, one session per process since AppTest is
+# not safe to drive from several threads. Afterwards the data is loaded
+# fresh from disk and every acknowledged write is checked for.
+CLIENTS = ["store", "app"]
+MIX = {'register': 0.1, 'search': 0.5, 'measure': 0.4}
+PERCENTILES = [50, 90, 99]
+# Patients the measurement saves are spread over; fewer means more
+# stations saving the same patient at the same time
+HOT_PATIENTS = 200
+MEASUREMENT_FIELDS = {
+    'bp': ['Blood Pressure', 'BP Date', 'BP Notes'],
+    'bmi': ['Weight', 'Height', 'BMI', 'BMI Classification', 'BMI Date'],
+    'glucose': ['Blood Glucose', 'Glucose Date', 'Fasting Status'],
+    'notes': ['Clinical Notes'],
+}
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+def prepare(directory, size, backend="csv", seed=0):
+    # A synthetic dataset plus the sequence and history files, so no session
+    # pays for creating them
+    os.makedirs(directory, exist_ok=True)
+    bench.write_dataset(bench.synthetic_records(size, seed), directory, backend)
+    store = _open(directory, backend)
+    SequenceAllocator.for_records(os.path.join(directory, SEQUENCE_FILE), store)
+    MeasurementHistory.for_records(os.path.join(directory, HISTORY_FILE), store, STATION)
+    ChangeLog.for_records(os.path.join(directory, CHANGES_FILE), store, STATION)
+    return store
+
+
+def _open(directory, backend):
+    store = open_record_store(backend, os.path.join(directory, DATA_FILE), os.path.join(directory, DB_FILE), STATION)
+    store.refresh()
+    return store
+
+
+def _person(rng, token):
+    department = rng.choice(list(departments))
+    return {
+        'First Name': rng.choice(bench.FIRST_NAMES),
+        'Middle Name': "",
+        'Last Name': rng.choice(bench.LAST_NAMES),
+        'DOB': date(1960, 1, 1) + timedelta(days=rng.randrange(40 * 365)),
+        'Sex': rng.choice(["Male", "Female"]),
+        'Department': department,
+        'Job Title': rng.choice(bench.JOB_TITLES),
+        'Email': f"load{token}@example.org",
+        'Phone Number': "",
+        'Family History of Diabetes': "Don't Know",
+        'Family History of Hypertension': "Don't Know",
+    }
+
+
+def _measurement(rng, kind, token):
+    today = datetime.today().strftime('%Y-%m-%d')
+    if kind == 'bp':
+        return {'Blood Pressure': f"{rng.randint(95, 180)}/{rng.randint(60, 110)}", 'BP Date': today,
+                'BP Notes': f"load {token}"}
+    if kind == 'bmi':
+        weight, height = round(rng.uniform(45, 110), 1), round(rng.uniform(1.45, 1.95), 2)
+        bmi, classification = calculate_bmi(weight, height)
+        return {'Weight': weight, 'Height': height, 'BMI': bmi, 'BMI Classification': classification,
+                'BMI Date': today}
+    if kind == 'glucose':
+        return {'Blood Glucose': round(rng.uniform(4, 13), 1), 'Glucose Date': today,
+                'Fasting Status': rng.choice(["Fasting", "Random"])}
+    return {'Clinical Notes': f"load {token}"}
+
+
+def _event(session, action, started, seconds, error=None, writes=(), code=None, names=None):
+    # One rerun; writes are (unique code, field, value) the session was told were saved
+    return {'session': session, 'action': action, 'start': started, 'end': started + seconds,
+            'seconds': seconds, 'error': error, 'writes': list(writes), 'code': code, 'names': names}
+
+
+class StoreSession:
+    # What one browser session makes the server do on each rerun
+    def __init__(self, store, allocator, session, patients, rng):
+        self.store = store
+        self.allocator = allocator
+        self.session = session
+        self.patients = patients
+        self.rng = rng
+
+    def _load_data(self):
+        self.store.refresh()
+        if self.store.pending >= JOURNAL_COMPACT_THRESHOLD:
+            self.store.compact()
+
+    def register(self, token):
+        self._load_data()
+        person = _person(self.rng, token)
+        self.store.duplicates.find(person)
+        code = format_code(person['First Name'], person['Last Name'], departments[person['Department']],
+                           self.allocator.allocate(departments[person['Department']]))
+        record = dict(person, **{'Unique Code': code, 'Registration Date': datetime.today().strftime('%Y-%m-%d')})
+        self.store.save(record, record.keys())
+        return {'code': code, 'names': (person['First Name'], person['Last Name'])}
+
+    def search(self, token):
+        self._load_data()
+        code = self.rng.choice(self.patients)
+        term = self.rng.choice([code, code[:4], self.store.get(code).get('Last Name') or code])
+        self.store.search.search(term, page=0, page_size=20)
+        return {}
+
+    def measure(self, token):
+        # Search, pick the patient, then save the new values for it, as the
+        # section forms do
+        self._load_data()
+        code = self.rng.choice(self.patients)
+        matches, _ = self.store.search.search(code, page=0, page_size=20)
+        record = next((m for m in matches if m['Unique Code'] == code), None) or self.store.get(code)
+        values = _measurement(self.rng, self.rng.choice(list(MEASUREMENT_FIELDS)), token)
+        self.store.update(record['Unique Code'], values)
+        return {'writes': [(code, field, value) for field, value in values.items()]}
+
+
+def _widget(elements, label):
+    return next(w for w in elements if w.label == label)
+
+
+class AppSession:
+    # One browser session through Streamlit's AppTest; every run() is a rerun
+    def __init__(self, session, patients, rng):
+        from streamlit.testing.v1 import AppTest
+        self.session = session
+        self.patients = patients
+        self.rng = rng
+        self.at = AppTest.from_file(APP, default_timeout=300).run()
+        self.events = []
+
+    def _run(self, action, element):
+        started = time.time()
+        start = time.perf_counter()
+        element.run()
+        error = "; ".join(str(e.value) for e in list(self.at.exception) + list(self.at.error)) or None
+        self.events.append(_event(self.session, action, started, time.perf_counter() - start, error))
+        if error:
+            raise RuntimeError(error)
+        return self.events[-1]
+
+    def _section(self, name):
+        radio = self.at.sidebar.radio[0]
+        if radio.value != name:
+            self._run("navigate", radio.set_value(name))
+
+    def register(self, token):
+        self._section("General Information")
+        person = _person(self.rng, token)
+        at = self.at
+        _widget(at.text_input, "First Name*").input(person['First Name'])
+        _widget(at.text_input, "Last Name*").input(person['Last Name'])
+        _widget(at.text_input, "Email").input(person['Email'])
+        _widget(at.date_input, "Date of Birth*").set_value(person['DOB'])
+        _widget(at.selectbox, "Sex*").select(person['Sex'])
+        _widget(at.selectbox, "Department*").select(person['Department'])
+        _widget(at.checkbox, "Register even if this person may already be registered").check()
+        event = self._run("register", _widget(at.button, "💾 Save Record").click())
+        event['code'] = at.session_state["last_unique_code"]
+        event['names'] = (person['First Name'], person['Last Name'])
+
+    def _find(self, code):
+        self._section("Blood Pressure")
+        self._run("search", _widget(self.at.text_input, "🔍 Search by Name or Unique Code").input(code))
+
+    def search(self, token):
+        self._find(self.rng.choice(self.patients))
+
+    def measure(self, token):
+        code = self.rng.choice(self.patients)
+        self._find(code)
+        at = self.at
+        pick = [s for s in at.selectbox if s.label == "Select patient"]
+        if pick:
+            self._run("select", pick[0].select_index(next(i for i, o in enumerate(pick[0].options)
+                                                          if f"({code})" in o)))
+        values = _measurement(self.rng, 'bp', token)
+        systolic, diastolic = values['Blood Pressure'].split("/")
+        _widget(at.number_input, "Systolic (mmHg)").set_value(int(systolic))
+        _widget(at.number_input, "Diastolic (mmHg)").set_value(int(diastolic))
+        _widget(at.text_area, "Clinical Notes").input(values['BP Notes'])
+        event = self._run("measure", _widget(at.button, "💾 Save Blood Pressure").click())
+        event['writes'] = [(code, field, value) for field, value in values.items()]
+
+
+def _actions(session, actions, mix, seed):
+    rng = random.Random(seed * 7919 + session)
+    return rng, rng.choices(list(mix), list(mix.values()), k=actions)
+
+
+def _store_session(store, allocator, session, actions, mix, think, seed, patients, barrier):
+    rng, plan = _actions(session, actions, mix, seed)
+    client = StoreSession(store, allocator, session, patients, rng)
+    barrier.wait()
+    events = []
+    for i, action in enumerate(plan):
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            result = getattr(client, action)(f"{session}-{i}")
+            events.append(_event(session, action, started, time.perf_counter() - start, **result))
+        except Exception as e:
+            events.append(_event(session, action, started, time.perf_counter() - start, repr(e)))
+        if think:
+            time.sleep(rng.expovariate(1 / think))
+    return events
+
+
+def _app_session(session, actions, mix, think, seed, patients, barrier):
+    rng, plan = _actions(session, actions, mix, seed)
+    client = AppSession(session, patients, rng)
+    barrier.wait()
+    for i, action in enumerate(plan):
+        started = time.time()
+        done = len(client.events)
+        try:
+            getattr(client, action)(f"{session}-{i}")
+        except Exception as e:
+            # A failed rerun is already recorded; anything else (a widget
+            # that never appeared) is recorded here
+            if not any(event['error'] for event in client.events[done:]):
+                client.events.append(_event(session, action, started, time.time() - started, repr(e)))
+        if think:
+            time.sleep(rng.expovariate(1 / think))
+    return client.events
+
+
+def _run_process(directory, backend, client, sessions, actions, mix, think, seed, patients, barrier):
+    # One server process: its own store shared by its sessions
+    os.chdir(directory)
+    if client == "app":
+        return [e for s in sessions for e in _app_session(s, actions, mix, think, seed, patients, barrier)]
+    store = _open(directory, backend)
+    store.history = MeasurementHistory.for_records(HISTORY_FILE, store, STATION)
+    store.change_log = ChangeLog.for_records(CHANGES_FILE, store, STATION)
+    allocator = SequenceAllocator.for_records(SEQUENCE_FILE, store)
+    with ThreadPoolExecutor(len(sessions)) as pool:
+        runs = [pool.submit(_store_session, store, allocator, s, actions, mix, think, seed, patients, barrier)
+                for s in sessions]
+        return [e for run in runs for e in run.result()]
+
+
+def run(directory, sessions=8, actions=50, processes=1, client="store", backend="csv", mix=MIX,
+        think=0.0, seed=0, hot_patients=HOT_PATIENTS):
+    # Drives the sessions against an already prepared directory; returns
+    # (events, seconds from the start signal until the last session ended)
+    if client == "app":
+        processes = sessions
+    processes = max(1, min(processes, sessions))
+    store = _open(directory, backend)
+    patients = random.Random(seed).sample(list(store.by_code), min(hot_patients, len(store)))
+    groups = [list(range(sessions))[p::processes] for p in range(processes)]
+    # Children read WRHD_STORAGE when they import settings
+    os.environ["WRHD_STORAGE"] = backend
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager, ProcessPoolExecutor(processes, mp_context=context) as pool:
+        barrier = manager.Barrier(sessions + 1)
+        futures = [pool.submit(_run_process, directory, backend, client, group, actions, mix, think, seed,
+                               patients, barrier) for group in groups]
+        barrier.wait(timeout=600)
+        start = time.time()
+        events = [e for f in futures for e in f.result()]
+    return events, time.time() - start
+
+
+def verify(directory, backend, events):
+    # What was acknowledged but is not on disk: registrations that are
+    # missing or share a code, and (patient, field) pairs whose saved value
+    # is not one any save could have left there last
+    store = _open(directory, backend)
+    registered = [e for e in events if e['code'] and not e['error']]
+    codes = [e['code'] for e in registered]
+    missing = sum(1 for e in registered if store.get(e['code']) is None
+                  or (store.get(e['code']).get('First Name'), store.get(e['code']).get('Last Name')) != e['names'])
+    writes = {}
+    for e in events:
+        if not e['error']:
+            for code, field, value in e['writes']:
+                writes.setdefault((code, field), []).append((e['start'], e['end'], value))
+    lost = []
+    for (code, field), saved in writes.items():
+        record = store.get(code)
+        final = record.get(field) if record is not None else None
+        # A save counts as possibly last if no other save to the field
+        # started after it was acknowledged
+        last = [value for start, end, value in saved if not any(s > end for s, _, _ in saved)]
+        if not any(_same(final, value) for value in last):
+            lost.append({'Unique Code': code, 'Field': field, 'On Disk': final, 'Expected One Of': last})
+    return {
+        'registrations': len(codes),
+        'duplicate_codes': len(codes) - len(set(codes)),
+        'missing_registrations': missing,
+        'checked_fields': len(writes),
+        'lost_updates': len(lost),
+        'lost': lost,
+    }
+
+
+def _same(stored, written):
+    if stored is None:
+        return written is None
+    if isinstance(stored, pd.Timestamp):
+        stored = stored.strftime('%Y-%m-%d')
+    try:
+        return abs(float(stored) - float(written)) < 1e-6
+    except (TypeError, ValueError):
+        return str(stored) == str(written)
+
+
+def summarize(events, seconds):
+    # Rerun latency percentiles (ms) per action and overall, plus throughput
+    df = pd.DataFrame(events, columns=['action', 'seconds', 'error'])
+    rows = {}
+    for action, group in list(df.groupby('action')) + [("all", df)]:
+        ms = group['seconds'].to_numpy() * 1000
+        rows[action] = {
+            'reruns': len(group),
+            'errors': int(group['error'].notna().sum()),
+            **{f'p{p}': float(np.percentile(ms, p)) if len(ms) else 0.0 for p in PERCENTILES},
+            'max': float(ms.max()) if len(ms) else 0.0,
+        }
+    return {
+        'seconds': seconds,
+        'reruns_per_second': len(df) / max(seconds, 1e-9),
+        'actions': rows,
+        'errors': df['error'].dropna().value_counts().head(5).to_dict(),
+    }
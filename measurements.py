@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+# BMI rules shared by the single-patient form and the batch paths
+BMI_CLASSES = ["Underweight", "Normal weight", "Overweight", "Obesity"]
+GLUCOSE_UNIT = "mmol/L"  # the unit risk.py's glucose cut-offs are in
+
+
+def calculate_bmi(weight, height):
+    if height > 0:
+        bmi = weight / (height ** 2)
+        if bmi < 18.5:
+            classification = "Underweight"
+        elif 18.5 <= bmi < 24.9:
+            classification = "Normal weight"
+        elif 25 <= bmi < 29.9:
+            classification = "Overweight"
+        else:
+            classification = "Obesity"
+        return round(bmi, 2), classification
+    return None, None
+
+
+def calculate_bmis(weight, height):
+    # calculate_bmi over whole columns; rows without a usable height get NaN/None
+    weight = pd.to_numeric(weight, errors='coerce').to_numpy(dtype=float)
+    height = pd.to_numeric(height, errors='coerce').to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bmi = np.where(height > 0, weight / height ** 2, np.nan)
+    classification = np.select(
+        [bmi < 18.5, (bmi >= 18.5) & (bmi < 24.9), (bmi >= 25) & (bmi < 29.9), ~np.isnan(bmi)],
+        BMI_CLASSES, default=None)
+    return np.round(bmi, 2), classification
@@ -0,0 +1,200 @@
+import heapq
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+import journal
+from history import MEASUREMENTS
+from ids import format_code
+from search import normalize
+from settings import departments
+
+# Merges the change journals of offline stations into the main store. All
+# journals are streamed together in timestamp order and every field keeps
+# its newest value, so two stations editing different fields of one record
+# both win. A Unique Code that two stations handed out to different people
+# is renumbered for the later registration; renumberings are remembered
+# and entries already merged are recognised, so merging a journal twice
+# changes nothing.
+KEY = journal.KEY
+JOURNAL_SUFFIXES = (".archive", ".compacting", ".journal", ".csv")
+READING_FIELDS = {names[0] for names in MEASUREMENTS.values()}
+# Sequence numbers reserved at a time for renumbered codes; the unused
+# rest of the last block is left as a gap
+RENUMBER_BLOCK = 100
+
+
+class CodeMap:
+    # (station, code the station used) -> code in the main store
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS code_map (
+                station TEXT NOT NULL,
+                code TEXT NOT NULL,
+                new_code TEXT NOT NULL,
+                PRIMARY KEY (station, code))""")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self):
+        rows = self._connect().execute("SELECT station, code, new_code FROM code_map")
+        return {(station, code): new_code for station, code, new_code in rows}
+
+    def add(self, rows):
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO code_map (station, code, new_code) VALUES (?, ?, ?)", rows)
+
+
+def station_name(name):
+    # "laptop3.csv.journal.archive" -> "laptop3"; only used for entries
+    # written before journals were station-tagged
+    name = os.path.basename(name)
+    while name.endswith(JOURNAL_SUFFIXES):
+        name = os.path.splitext(name)[0]
+    return name
+
+
+def read_station_file(f, name):
+    # Entries from a station journal, or from a station's CSV snapshot whose
+    # values count as older than any journaled change
+    station = station_name(name)
+    if name.lower().endswith(".csv"):
+        for row in pd.read_csv(f, dtype=object).to_dict('records'):
+            fields = {k: v for k, v in row.items() if isinstance(v, str) and k != KEY}
+            yield {KEY: row.get(KEY), "ts": "", "station": station, "fields": fields}
+        return
+    for entry in journal.iter_entries(f):
+        entry.setdefault("station", station)
+        yield entry
+
+
+def _identity(fields):
+    return (normalize(fields.get('First Name')), normalize(fields.get('Last Name')),
+            str(fields.get('DOB') or "")[:10])
+
+
+class _Numbers:
+    def __init__(self, allocator):
+        self.allocator = allocator
+        self.blocks = {}  # department code -> [next number, end of block]
+
+    def next(self, department):
+        block = self.blocks.get(department)
+        if block is None or block[0] == block[1]:
+            first = self.allocator.allocate(department, RENUMBER_BLOCK)
+            block = self.blocks[department] = [first, first + RENUMBER_BLOCK]
+        block[0] += 1
+        return block[0] - 1
+
+
+def merge(store, sources, allocator, code_map):
+    # sources: (file name, open seekable binary file) pairs. Returns
+    # (summary, the codes that were renumbered as a DataFrame)
+    if not store.storage.timestamped:
+        # Without per-field times older station values would overwrite newer
+        # edits here, and merging a journal twice would apply it again
+        raise ValueError("Station journals can only be merged into the csv or sharded backend")
+    # A renumbered code must not be one a station already handed out, so the
+    # sequences first move past every incoming code
+    incoming = set()
+    for name, f in sources:
+        incoming.update(entry.get(KEY) for entry in read_station_file(f, name))
+        f.seek(0)
+    allocator.seed(incoming)
+
+    newest = {}  # (code, field) -> timestamp of its newest change
+    seen = set()  # (code, ts, station) of entries already in the store
+    for entry in store.storage.changes():
+        ts = entry.get("ts", "")
+        seen.add((entry.get(KEY), ts, entry.get("station", "")))
+        for field in entry.get("fields", {}):
+            if ts > newest.get((entry.get(KEY), field), ""):
+                newest[(entry.get(KEY), field)] = ts
+
+    remap = code_map.load()
+    holders = {}  # code -> identity of the person who holds it
+    winners = {}  # (code, field) -> (ts, station, value)
+    grouped = {}  # (ts, code, station) -> fields, one per merged entry
+    readings = []
+    renumbered = []
+    numbers = _Numbers(allocator)
+    summary = {'files': len(sources), 'entries': 0, 'already merged': 0, 'superseded': 0}
+    streams = [read_station_file(f, name) for name, f in sources]
+    for entry in heapq.merge(*streams, key=lambda e: e.get("ts") or ""):
+        summary['entries'] += 1
+        ts, station, fields = entry.get("ts") or "", entry.get("station", ""), entry.get("fields", {})
+        code = remap.get((station, entry.get(KEY)), entry.get(KEY))
+        if (code, ts, station) in seen:
+            summary['already merged'] += 1
+            continue
+
+        if 'First Name' in fields and (station, entry.get(KEY)) not in remap:
+            identity = _identity(fields)
+            holder = holders.get(code)
+            if holder is None and store.get(code) is not None:
+                holder = _identity(store.get(code))
+            if holder is not None and holder != identity:
+                department = departments.get(fields.get('Department'), "NA")
+                new_code = code
+                while new_code in holders or new_code in incoming or store.get(new_code) is not None:
+                    new_code = format_code(fields['First Name'], fields.get('Last Name') or "?", department,
+                                           numbers.next(department))
+                remap[(station, entry.get(KEY))] = new_code
+                renumbered.append((station, entry.get(KEY), new_code,
+                                   f"{fields['First Name']} {fields.get('Last Name') or ''}".strip()))
+                code = new_code
+            holders[code] = identity
+        # Written even if every field loses, to mark the entry as merged
+        grouped.setdefault((ts, code, station), {})
+
+        for field, value in fields.items():
+            if field == KEY:
+                continue
+            if (code, field) not in newest or ts > newest[(code, field)]:
+                summary['superseded'] += (code, field) in winners
+                newest[(code, field)] = ts
+                winners[(code, field)] = (ts, station, value)
+            else:
+                summary['superseded'] += 1
+        if READING_FIELDS.intersection(fields):
+            readings.append({KEY: code, "ts": ts, "station": station, "fields": fields})
+
+    # One journal entry per original change, keeping its time and station
+    for (code, field), (ts, station, value) in winners.items():
+        grouped[(ts, code, station)][field] = value
+    entries = [{KEY: code, "ts": ts, "station": station, "fields": fields}
+               for (ts, code, station), fields in sorted(grouped.items())]
+    before = len(store)
+    if entries:
+        store.write_entries(entries)
+    if readings and store.history is not None:
+        store.history.add_entries(readings)
+    if renumbered:
+        code_map.add([row[:3] for row in renumbered])
+
+    summary.update({
+        'records added': len(store) - before,
+        'records changed': len({code for code, _ in winners}),
+        'fields written': len(winners),
+        'codes renumbered': len(renumbered),
+    })
+    return summary, pd.DataFrame(renumbered, columns=['Station', 'Station Code', 'New Code', 'Name'])
+
+
+def merge_files(store, paths, allocator, code_map):
+    files = [open(path, "rb") for path in paths]
+    try:
+        return merge(store, list(zip(paths, files)), allocator, code_map)
+    finally:
+        for f in files:
+            f.close()
@@ -0,0 +1,190 @@
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from settings import METRICS_ENABLED, METRICS_FILE, METRICS_ROTATE_SECONDS, METRICS_BACKUPS
+
+# Timing spans around the app's hot paths. Each span records its latency,
+# the records it touched and the bytes it wrote under an (operation,
+# section) pair. Snapshots go to a local file in Prometheus text format
+# that is rotated hourly; with instrumentation off span() hands back one
+# shared no-op object, so the only cost is a function call.
+WINDOW = 1000  # latencies kept per series for the percentiles
+FLUSH_SECONDS = 10
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, records):
+        pass
+
+    def wrote(self, size):
+        pass
+
+    def finish(self):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Span:
+    __slots__ = ("registry", "operation", "section", "records", "written", "_start")
+
+    def __init__(self, registry, operation, section):
+        self.registry = registry
+        self.operation = operation
+        self.section = section
+        self.records = 0
+        self.written = 0
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.operation, self.section, time.perf_counter() - self._start,
+                              self.records, self.written, failed=exc_type is not None)
+        return False
+
+    def count(self, records):
+        self.records += records or 0
+
+    def wrote(self, size):
+        self.written += size or 0
+
+    def finish(self):
+        self.__exit__(None, None, None)
+
+
+class _Series:
+    def __init__(self):
+        self.latencies = deque(maxlen=WINDOW)
+        self.count = 0
+        self.seconds = 0.0
+        self.records = 0
+        self.written = 0
+        self.errors = 0
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Registry:
+    def __init__(self, path=None, enabled=True, rotate_seconds=METRICS_ROTATE_SECONDS, backups=METRICS_BACKUPS):
+        self.path = path
+        self.enabled = enabled
+        self.rotate_seconds = rotate_seconds
+        self.backups = backups
+        self._series = {}
+        self._lock = threading.Lock()
+        self._flushed = 0.0
+        self._rotated = time.time()
+
+    def span(self, operation, section=""):
+        if not self.enabled:
+            return _NOOP
+        return Span(self, operation, section or "")
+
+    def start(self, operation, section=""):
+        # For spans that cannot wrap a with-block; call finish() at the end
+        return self.span(operation, section).__enter__()
+
+    def observe(self, operation, section, seconds, records=0, written=0, failed=False):
+        with self._lock:
+            series = self._series.get((operation, section))
+            if series is None:
+                series = self._series[(operation, section)] = _Series()
+            series.latencies.append(seconds)
+            series.count += 1
+            series.seconds += seconds
+            series.records += records
+            series.written += written
+            series.errors += failed
+        if self.path and time.monotonic() - self._flushed >= FLUSH_SECONDS:
+            self.flush()
+
+    def _snapshot(self):
+        with self._lock:
+            return [(key, np.array(s.latencies), s.count, s.seconds, s.records, s.written, s.errors)
+                    for key, s in sorted(self._series.items())]
+
+    def summary(self):
+        # One row per operation and section, latencies in milliseconds
+        rows = []
+        for (operation, section), latencies, count, seconds, records, written, errors in self._snapshot():
+            p50, p95, p99 = np.quantile(latencies, QUANTILES) * 1000
+            rows.append({
+                'Operation': operation, 'Section': section, 'Calls': count,
+                'p50 (ms)': round(p50, 2), 'p95 (ms)': round(p95, 2), 'p99 (ms)': round(p99, 2),
+                'Records': records, 'Bytes Written': written, 'Errors': errors,
+            })
+        return pd.DataFrame(rows, columns=['Operation', 'Section', 'Calls', 'p50 (ms)', 'p95 (ms)',
+                                           'p99 (ms)', 'Records', 'Bytes Written', 'Errors'])
+
+    def exposition(self):
+        snapshot = self._snapshot()
+        lines = [
+            "# HELP wrhd_operation_seconds Latency of instrumented operations over the recent window",
+            "# TYPE wrhd_operation_seconds summary",
+        ]
+        for (operation, section), latencies, count, seconds, *_ in snapshot:
+            labels = f'operation="{_label(operation)}",section="{_label(section)}"'
+            for q, value in zip(QUANTILES, np.quantile(latencies, QUANTILES)):
+                lines.append(f'wrhd_operation_seconds{{{labels},quantile="{q}"}} {value:.6f}')
+            lines.append(f"wrhd_operation_seconds_sum{{{labels}}} {seconds:.6f}")
+            lines.append(f"wrhd_operation_seconds_count{{{labels}}} {count}")
+        for name, index, text in (("records", 4, "Records touched"), ("bytes", 5, "Bytes written"),
+                                  ("errors", 6, "Operations that raised")):
+            lines.append(f"# HELP wrhd_operation_{name}_total {text} by instrumented operations")
+            lines.append(f"# TYPE wrhd_operation_{name}_total counter")
+            for row in snapshot:
+                (operation, section) = row[0]
+                lines.append(f'wrhd_operation_{name}_total{{operation="{_label(operation)}",'
+                             f'section="{_label(section)}"}} {row[index]}')
+        return "\n".join(lines) + "\n"
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if os.path.exists(self.path):
+            os.replace(self.path, f"{self.path}.1")
+
+    def flush(self):
+        # Rewrites the metrics file atomically so a scraper never sees half of it
+        self._flushed = time.monotonic()
+        text = self.exposition()
+        try:
+            if self.backups and time.time() - self._rotated >= self.rotate_seconds:
+                self._rotated = time.time()
+                self._rotate()
+            tmp = f"{self.path}.tmp.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass  # a full or read-only disk must not break the screening
+
+
+registry = Registry(METRICS_FILE, enabled=METRICS_ENABLED)
+
+
+def span(operation, section=""):
+    return registry.span(operation, section)
+
+
+def start(operation, section=""):
+    return registry.start(operation, section)
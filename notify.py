@@ -0,0 +1,213 @@
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+# Outbound SMS. Saves only enqueue a row in a small SQLite outbox; a pool
+# of background workers drains it through a pluggable transport with rate
+# limiting, retry with exponential backoff and de-duplication by key, so
+# the Streamlit script never waits on an HTTP round trip.
+log = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 30
+CLAIM_BATCH = 20
+# Rows left in 'sending' this long (e.g. by a killed process) are retried
+STALE_SECONDS = 300
+
+
+class TwilioTransport:
+    def __init__(self, account_sid, auth_token, from_number):
+        from twilio.rest import Client
+
+        self.client = Client(account_sid, auth_token)
+        self.from_number = from_number
+
+    def send(self, to_number, body):
+        self.client.messages.create(to=to_number, from_=self.from_number, body=body)
+
+
+class FakeTransport:
+    # Local stand-in: keeps what would have been sent, and can be told to
+    # fail the first few attempts to exercise retries
+    def __init__(self, fail_first=0, delay=0.0):
+        self.sent = []
+        self.fail_first = fail_first
+        self.delay = delay
+        self._lock = threading.Lock()
+
+    def send(self, to_number, body):
+        time.sleep(self.delay)
+        with self._lock:
+            if self.fail_first > 0:
+                self.fail_first -= 1
+                raise RuntimeError("simulated delivery failure")
+            self.sent.append((to_number, body))
+        log.info("SMS to %s: %s", to_number, body)
+
+
+class Outbox:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                dedup_key TEXT UNIQUE,
+                to_number TEXT NOT NULL,
+                body TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                last_error TEXT,
+                created REAL NOT NULL,
+                sent REAL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_due ON messages (status, next_attempt)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, to_number, body, dedup_key=None):
+        # Returns False when a message with the same key was queued before
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO messages (dedup_key, to_number, body, next_attempt, created) "
+                "VALUES (?, ?, ?, ?, ?)", (dedup_key, to_number, body, now, now))
+        return cur.rowcount == 1
+
+    def claim(self, limit=CLAIM_BATCH):
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE messages SET status = 'pending' WHERE status = 'sending' AND next_attempt < ?",
+                         (now - STALE_SECONDS,))
+            rows = conn.execute(
+                "SELECT id, to_number, body, attempts FROM messages "
+                "WHERE status = 'pending' AND next_attempt <= ? ORDER BY next_attempt LIMIT ?",
+                (now, limit)).fetchall()
+            conn.executemany("UPDATE messages SET status = 'sending', next_attempt = ? WHERE id = ?",
+                             [(now, r[0]) for r in rows])
+        return rows
+
+    def mark_sent(self, message_id):
+        with self._connect() as conn:
+            conn.execute("UPDATE messages SET status = 'sent', sent = ?, last_error = NULL WHERE id = ?",
+                         (time.time(), message_id))
+
+    def mark_failed(self, message_id, attempts, error):
+        if attempts >= MAX_ATTEMPTS:
+            status, next_attempt = 'failed', time.time()
+        else:
+            # Exponential backoff with jitter
+            delay = BACKOFF_SECONDS * 2 ** (attempts - 1) * random.uniform(0.8, 1.2)
+            status, next_attempt = 'pending', time.time() + delay
+        with self._connect() as conn:
+            conn.execute("UPDATE messages SET status = ?, attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                         (status, attempts, next_attempt, str(error)[:500], message_id))
+
+    def counts(self):
+        rows = self._connect().execute("SELECT status, COUNT(*) FROM messages GROUP BY status").fetchall()
+        return dict(rows)
+
+
+class RateLimiter:
+    # Token bucket shared by the workers of one process
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+class Notifier:
+    def __init__(self, outbox, transport, workers=2, per_second=1.0, poll_seconds=2.0):
+        self.outbox = outbox
+        self.transport = transport
+        self.limiter = RateLimiter(per_second)
+        self.poll_seconds = poll_seconds
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._run, name=f"sms-worker-{i}", daemon=True)
+                         for i in range(workers)]
+
+    def start(self):
+        for t in self._threads:
+            t.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join()
+
+    def notify(self, to_number, body, dedup_key=None):
+        to_number = "".join(str(to_number or "").split())
+        if not to_number:
+            return False
+        queued = self.outbox.enqueue(to_number, body, dedup_key)
+        self._wake.set()
+        return queued
+
+    def drain_once(self):
+        # Sends one claimed batch; returns how many messages were attempted
+        batch = self.outbox.claim()
+        for message_id, to_number, body, attempts in batch:
+            self.limiter.wait()
+            try:
+                self.transport.send(to_number, body)
+            except Exception as e:
+                log.warning("SMS %s to %s failed: %s", message_id, to_number, e)
+                self.outbox.mark_failed(message_id, attempts + 1, e)
+            else:
+                self.outbox.mark_sent(message_id)
+        return len(batch)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.drain_once():
+                    continue
+            except Exception:
+                log.exception("SMS worker error")
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+
+def code_message(unique_code):
+    return (f"WRHD Medical Screening: you are registered. Your Unique Code is {unique_code}. "
+            "Please quote it at each screening station.")
+
+
+def referral_message(first_name, details=""):
+    text = f"WRHD Medical Screening: {first_name}, you have been referred to a specialist."
+    if details:
+        text += f" {details}"
+    return text
+
+
+def open_notifier(outbox_file, transport_name, workers, per_second):
+    if transport_name == "twilio":
+        transport = TwilioTransport(os.environ["TWILIO_ACCOUNT_SID"],
+                                    os.environ["TWILIO_AUTH_TOKEN"],
+                                    os.environ["TWILIO_FROM_NUMBER"])
+    elif transport_name == "fake":
+        transport = FakeTransport()
+    else:
+        raise ValueError(f"Unknown SMS transport: {transport_name}")
+    return Notifier(Outbox(outbox_file), transport, workers=workers, per_second=per_second)
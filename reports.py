@@ -0,0 +1,215 @@
+import multiprocessing
+import os
+import re
+import textwrap
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+from jinja2 import Environment, select_autoescape
+
+import risk
+from measurements import GLUCOSE_UNIT
+
+# Per-participant result slips after a screening drive. The main process
+# reads the cohort in chunks from the shared table and runs the General
+# Assessment rules over each chunk at once; worker processes turn the
+# chunks into HTML (a Jinja template compiled once per worker) and PDF (a
+# small built-in writer, no extra dependency) and the results are streamed
+# into one zip. Only a few chunks are in flight at a time, so memory stays
+# flat however large the cohort is.
+CHUNK_SIZE = 200
+FORMATS = ("html", "pdf")
+REPORT_COLUMNS = [
+    'Unique Code', 'First Name', 'Middle Name', 'Last Name', 'DOB', 'Age', 'Sex',
+    'Department', 'Job Title', 'Registration Date',
+    'Blood Pressure', 'BP Date', 'Weight', 'Height', 'BMI', 'BMI Classification', 'BMI Date',
+    'Blood Glucose', 'Fasting Status', 'Glucose Date',
+    'Visual Acuity Right', 'Visual Acuity Left', 'Right Eye with Glasses', 'Left Eye with Glasses',
+    'Vision Test Date', 'Referred', 'Referral Date', 'Referral Details',
+]
+TITLE = "WRHD Medical Screening - Result Slip"
+NOT_RECORDED = "Not recorded"
+PDF_WIDTH = 95  # characters of 10pt Helvetica per line
+_UNSAFE = re.compile(r"[^A-Za-z0-9_-]")
+
+TEMPLATE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{{ title }} - {{ slip.code }}</title>
+<style>
+body { font-family: sans-serif; margin: 2em; color: #222; }
+h1 { font-size: 1.3em; } h2 { font-size: 1.05em; border-bottom: 1px solid #ccc; }
+table { border-collapse: collapse; } td { padding: 2px 12px 2px 0; vertical-align: top; }
+td:first-child { color: #555; } .risk { color: #a00; font-weight: bold; }
+</style></head>
+<body>
+<h1>{{ title }}</h1>
+{% for heading, rows in slip.sections %}
+<h2>{{ heading }}</h2>
+<table>{% for label, value in rows %}<tr><td>{{ label }}</td><td>{{ value }}</td></tr>{% endfor %}</table>
+{% endfor %}
+<h2>Risk Factors</h2>
+{% if slip.risk_factors %}<p class="risk">{{ slip.risk_factors | join(", ") }}</p>
+{% else %}<p>None detected</p>{% endif %}
+<p><small>Generated {{ slip.generated }}</small></p>
+</body></html>
+"""
+
+_template = None
+
+
+def _init_worker():
+    # Compiled once per worker process and reused for every slip it renders
+    global _template
+    if _template is None:
+        _template = Environment(autoescape=select_autoescape(default=True)).from_string(TEMPLATE)
+    return _template
+
+
+def _text(value, unit=""):
+    if value is None or value is pd.NaT or (isinstance(value, float) and value != value):
+        return NOT_RECORDED
+    if isinstance(value, (pd.Timestamp, datetime)):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, float):
+        value = f"{value:g}"
+    return f"{value}{unit}"
+
+
+def _with_date(value, day):
+    return value if value == NOT_RECORDED or _text(day) == NOT_RECORDED else f"{value} ({_text(day)})"
+
+
+def slips(table, rows):
+    # Plain per-participant dicts for some rows, ready to send to a worker
+    df = table.frame(REPORT_COLUMNS, rows).astype(object)
+    df = df.where(df.notna(), None)
+    assessed = risk.assess(df)
+    generated = datetime.now().strftime('%Y-%m-%d %H:%M')
+    out = []
+    for (_, r), (_, a) in zip(df.iterrows(), assessed.iterrows()):
+        name = " ".join(p for p in (r['First Name'], r['Middle Name'], r['Last Name']) if p)
+        bmi = _text(r['BMI'])
+        if bmi != NOT_RECORDED and r['BMI Classification']:
+            bmi = f"{bmi} ({r['BMI Classification']})"
+        glucose = _text(r['Blood Glucose'], f" {GLUCOSE_UNIT}")
+        if glucose != NOT_RECORDED and r['Fasting Status']:
+            glucose = f"{glucose}, {r['Fasting Status']}"
+        referral = "Yes" if r['Referred'] else "No"
+        if r['Referred'] and r['Referral Details']:
+            referral = f"Yes - {r['Referral Details']}"
+        out.append({
+            'code': r['Unique Code'],
+            'generated': generated,
+            'risk_factors': risk.factor_labels(a, r['Fasting Status']),
+            'sections': [
+                ("Participant", [
+                    ("Name", name or NOT_RECORDED), ("Unique Code", r['Unique Code']),
+                    ("Date of Birth", _text(r['DOB'])), ("Age", _text(r['Age'])), ("Sex", _text(r['Sex'])),
+                    ("Department", _text(r['Department'])), ("Job Title", _text(r['Job Title'])),
+                    ("Registered", _text(r['Registration Date'])),
+                ]),
+                ("Measurements", [
+                    ("Blood Pressure", _with_date(_text(r['Blood Pressure'], " mmHg"), r['BP Date'])),
+                    ("Weight / Height", f"{_text(r['Weight'], ' kg')} / {_text(r['Height'], ' m')}"),
+                    ("BMI", _with_date(bmi, r['BMI Date'])),
+                    ("Blood Glucose", _with_date(glucose, r['Glucose Date'])),
+                ]),
+                ("Visual Acuity", [
+                    ("Right / Left", f"{_text(r['Visual Acuity Right'])} / {_text(r['Visual Acuity Left'])}"),
+                    ("With Glasses", f"{_text(r['Right Eye with Glasses'])} / {_text(r['Left Eye with Glasses'])}"),
+                    ("Tested", _text(r['Vision Test Date'])),
+                ]),
+                ("Referral", [("Referred", _with_date(referral, r['Referral Date']))]),
+            ],
+        })
+    return out
+
+
+def _pdf_string(text):
+    text = str(text).encode("latin-1", "replace").decode("latin-1")
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+
+def render_pdf(slip):
+    # One A4 page of Helvetica text, written as a minimal PDF by hand
+    lines = [("F2", 14, TITLE), ("F1", 10, "")]
+    for heading, rows in slip['sections']:
+        lines.append(("F2", 12, heading))
+        lines.extend(("F1", 10, text) for label, value in rows
+                     for text in textwrap.wrap(f"{label}: {value}", PDF_WIDTH))
+        lines.append(("F1", 10, ""))
+    lines.append(("F2", 12, "Risk Factors"))
+    lines.extend(("F1", 10, text) for text in textwrap.wrap(", ".join(slip['risk_factors']) or "None detected", PDF_WIDTH))
+    lines.append(("F1", 10, ""))
+    lines.append(("F1", 8, f"Generated {slip['generated']}"))
+    stream = ["BT", "50 790 Td"]
+    for font, size, text in lines:
+        stream.append(f"/{font} {size} Tf 0 -{size + 6} Td {_pdf_string(text)} Tj")
+    stream.append("ET")
+    content = "\n".join(stream).encode("latin-1")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+        b"/Resources << /Font << /F1 4 0 R /F2 5 0 R >> >> /Contents 6 0 R >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>",
+        b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def render(chunk, formats=FORMATS):
+    # Runs in a worker: [(file name in the zip, bytes)] for a chunk of slips
+    template = _init_worker()
+    files = []
+    for slip in chunk:
+        name = _UNSAFE.sub("_", str(slip['code']))
+        if "html" in formats:
+            files.append((f"html/{name}.html", template.render(title=TITLE, slip=slip).encode("utf-8")))
+        if "pdf" in formats:
+            files.append((f"pdf/{name}.pdf", render_pdf(slip)))
+    return files
+
+
+def generate(table, rows, out, formats=FORMATS, workers=None, chunk_size=CHUNK_SIZE, progress=None):
+    # Writes slips for the given table rows into a zip at out (a path or a
+    # binary file); progress(done, total) is called after every chunk.
+    # Returns the number of participants.
+    workers = workers or os.cpu_count() or 1
+    chunks = (rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size))
+    done = 0
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as archive:
+        def write(files):
+            nonlocal done
+            for name, data in files:
+                archive.writestr(name, data)
+            done += sum(1 for name, _ in files if name.endswith(f".{formats[0]}"))
+            if progress:
+                progress(done, len(rows))
+
+        if workers == 1:
+            for chunk in chunks:
+                write(render(slips(table, chunk), formats))
+            return done
+        # spawn, not fork: the Streamlit server has threads running
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker) as pool:
+            pending = []
+            for chunk in chunks:
+                pending.append(pool.submit(render, slips(table, chunk), formats))
+                if len(pending) >= workers * 2:
+                    write(pending.pop(0).result())
+            for future in pending:
+                write(future.result())
+    return done
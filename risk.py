@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+
+# Screening risk rules, applied to a whole cohort at once with column masks.
+# The per-patient view in General Assessment runs the same rules on a
+# one-row frame so the two can never disagree.
+CONDITIONS = ["Hypertension", "Obesity", "Prediabetes", "Diabetes"]
+ASSESSMENT_COLUMNS = [
+    'Unique Code', 'Department', 'Sex', 'Age',
+    'Blood Pressure', 'BMI', 'Blood Glucose', 'Fasting Status',
+]
+AGE_BINS = [0, 30, 40, 50, 60, np.inf]
+AGE_BANDS = ["<30", "30-39", "40-49", "50-59", "60+"]
+
+# Which measurement each condition's prevalence is taken over
+SCREENED_BY = {
+    "Hypertension": "BP Screened",
+    "Obesity": "BMI Screened",
+    "Prediabetes": "Glucose Screened",
+    "Diabetes": "Glucose Screened",
+}
+
+
+def _column(df, name):
+    if name in df:
+        return df[name]
+    return pd.Series(np.nan, index=df.index, dtype=object)
+
+
+def parse_bp(bp):
+    # "120/80" strings -> numeric Systolic/Diastolic columns (NaN if absent or malformed)
+    parts = bp.astype("string").str.extract(r"^\s*(\d+)\s*/\s*(\d+)\s*$")
+    return pd.DataFrame({
+        'Systolic': pd.to_numeric(parts[0], errors='coerce').astype('float64'),
+        'Diastolic': pd.to_numeric(parts[1], errors='coerce').astype('float64'),
+    }, index=bp.index)
+
+
+def assess(df):
+    out = pd.DataFrame(index=df.index)
+    for c in ('Unique Code', 'Department', 'Sex'):
+        out[c] = _column(df, c)
+    age = pd.to_numeric(_column(df, 'Age'), errors='coerce')
+    out['Age Band'] = pd.cut(age, AGE_BINS, right=False, labels=AGE_BANDS)
+
+    bp_text = _column(df, 'Blood Pressure')
+    bp = parse_bp(bp_text)
+    systolic, diastolic = bp['Systolic'], bp['Diastolic']
+    bmi = pd.to_numeric(_column(df, 'BMI'), errors='coerce')
+    glucose = pd.to_numeric(_column(df, 'Blood Glucose'), errors='coerce')
+    fasting = _column(df, 'Fasting Status')
+    is_fasting = (fasting == "Fasting").to_numpy()
+    is_random = (fasting == "Random").to_numpy()
+
+    out['Systolic'] = systolic
+    out['Diastolic'] = diastolic
+    out['BMI'] = bmi
+    out['Blood Glucose'] = glucose
+    out['BP Screened'] = systolic.notna() & diastolic.notna()
+    bp_given = (bp_text.astype("string").str.strip().fillna("") != "").astype(bool)
+    out['BP Invalid'] = bp_given & ~out['BP Screened']
+    out['BMI Screened'] = bmi.notna()
+    out['Glucose Screened'] = glucose.notna() & (is_fasting | is_random)
+
+    conditions = flags(systolic.to_numpy(), diastolic.to_numpy(), bmi.to_numpy(dtype=float),
+                       glucose.to_numpy(dtype=float), is_fasting, is_random)
+    for name, mask in conditions.items():
+        out[name] = mask
+    return out
+
+
+def flags(systolic, diastolic, bmi, glucose, is_fasting, is_random):
+    # The rules on plain float arrays (NaN where not measured), shared by
+    # assess() and the record browser
+    with np.errstate(invalid='ignore'):
+        return {
+            'Hypertension': (systolic > 140) | (diastolic > 90),
+            'Obesity': bmi > 30,
+            'Overweight': (bmi >= 25) & (bmi < 30),
+            'Prediabetes': (is_fasting & (glucose >= 5.7) & (glucose <= 6.9))
+                           | (is_random & (glucose >= 7.8) & (glucose <= 11.0)),
+            'Diabetes': (is_fasting & (glucose >= 7.0)) | (is_random & (glucose >= 11.1)),
+        }
+
+
+def risk_factors(record):
+    # Risk factor labels for one patient, as shown in General Assessment
+    row = assess(pd.DataFrame([{c: record.get(c) for c in ASSESSMENT_COLUMNS}])).iloc[0]
+    return factor_labels(row, record.get('Fasting Status')), bool(row['BP Invalid'])
+
+
+def factor_labels(row, fasting_status):
+    # Labels for one row of assess(); also used for whole cohorts at once
+    factors = []
+    if row['Hypertension']:
+        factors.append("Hypertension")
+    if row['Obesity']:
+        factors.append("Obesity")
+    elif row['Overweight']:
+        factors.append("Overweight")
+    if row['Prediabetes']:
+        factors.append(f"Prediabetes ({fasting_status})")
+    elif row['Diabetes']:
+        factors.append(f"Diabetes ({fasting_status})")
+    return factors
+
+
+def prevalence(assessed, by=None):
+    # Records, screened counts and prevalence (%) of each condition among
+    # those screened for it, overall or per group
+    grouped = assessed.groupby(by, observed=False) if by else assessed.groupby(lambda _: "All")
+    table = pd.DataFrame({'Records': grouped.size()})
+    for condition, screened in SCREENED_BY.items():
+        n = grouped[screened].sum()
+        table[screened] = n
+        table[f'{condition} %'] = (grouped[condition].sum() / n.where(n > 0) * 100).round(1)
+    return table
@@ -0,0 +1,166 @@
+import os
+from datetime import datetime
+
+import pandas as pd
+
+from dedup import KINDS, REASONS, blocking_frame
+from ids import format_code
+from settings import departments
+
+# Bulk pre-registration from a staff roster (CSV or .xlsx). Every check is a
+# column mask over the whole roster, codes are reserved in one allocator
+# transaction and the accepted rows are written as one batch.
+REQUIRED_COLUMNS = ['First Name', 'Last Name', 'DOB', 'Sex', 'Department']
+OPTIONAL_COLUMNS = [
+    'Middle Name', 'Job Title', 'Email', 'Phone Number',
+    'Family History of Diabetes', 'Family History of Hypertension',
+]
+SEXES = ["Male", "Female", "Other"]
+HISTORY_ANSWERS = ["Yes", "No", "Don't Know"]
+
+
+def read_roster(file, name=None):
+    name = name or getattr(file, "name", str(file))
+    ext = os.path.splitext(name)[1].lower()
+    if ext == ".xls":
+        # Reading the old Excel format needs xlrd, which is not installed
+        raise ValueError("Save .xls rosters as .xlsx or CSV first")
+    if ext == ".xlsx":
+        df = pd.read_excel(file, dtype=str)
+    else:
+        df = pd.read_csv(file, dtype=str, keep_default_na=False)
+    # Match headers loosely: "first name", " First Name " -> "First Name"
+    canonical = {c.lower(): c for c in REQUIRED_COLUMNS + OPTIONAL_COLUMNS}
+    df.columns = [canonical.get(" ".join(str(c).split()).lower(), c) for c in df.columns]
+    return df
+
+
+def _department_names(column):
+    # Accepts department names or their codes, in any case
+    lookup = {name.lower(): name for name in departments}
+    lookup.update({code.lower(): name for name, code in departments.items()})
+    return column.str.strip().str.lower().map(lookup)
+
+
+def calculate_ages(dob, today=None):
+    today = pd.Timestamp(today or datetime.today())
+    before_birthday = (dob.dt.month > today.month) | ((dob.dt.month == today.month) & (dob.dt.day > today.day))
+    return today.year - dob.dt.year - before_birthday.astype(int)
+
+
+def validate(df):
+    # Returns (cleaned rows that passed, per-row error report)
+    df = df.copy()
+    for c in REQUIRED_COLUMNS + OPTIONAL_COLUMNS:
+        if c not in df:
+            df[c] = ""
+        df[c] = df[c].fillna("").astype(str).str.strip()
+
+    problems = []
+    for c in ('First Name', 'Last Name'):
+        problems.append((df[c] == "", f"{c} is required"))
+
+    dob = pd.to_datetime(df['DOB'], errors='coerce', format='mixed')
+    problems.append((df['DOB'] == "", "DOB is required"))
+    problems.append(((df['DOB'] != "") & dob.isna(), "DOB is not a valid date"))
+    problems.append((dob.notna() & ((dob < pd.Timestamp(1900, 1, 1)) | (dob > pd.Timestamp.today())),
+                     "DOB is out of range"))
+
+    sex = df['Sex'].str.title()
+    problems.append((~sex.isin(SEXES), f"Sex must be one of {', '.join(SEXES)}"))
+
+    department = _department_names(df['Department'])
+    problems.append((department.isna(), "Department is not in the department list"))
+
+    for c in ('Family History of Diabetes', 'Family History of Hypertension'):
+        answer = df[c].replace("", "Don't Know")
+        problems.append((~answer.isin(HISTORY_ANSWERS), f"{c} must be Yes, No or Don't Know"))
+        df[c] = answer
+
+    messages = pd.Series("", index=df.index)
+    for mask, message in problems:
+        messages = messages.where(~mask, messages + "; " + message)
+    messages = messages.str.lstrip("; ")
+    failed = messages != ""
+
+    # Spreadsheet row numbers: header is row 1
+    errors = pd.DataFrame({
+        'Row': df.index[failed] + 2,
+        'First Name': df.loc[failed, 'First Name'],
+        'Last Name': df.loc[failed, 'Last Name'],
+        'Errors': messages[failed],
+    }).reset_index(drop=True)
+
+    valid = df[~failed].copy()
+    valid['DOB'] = dob[~failed]
+    valid['Sex'] = sex[~failed]
+    valid['Department'] = department[~failed]
+    valid['Age'] = calculate_ages(valid['DOB'])
+    return valid, errors
+
+
+def build_records(valid, allocator, registration_date=None):
+    registration_date = registration_date or datetime.today().strftime('%Y-%m-%d')
+    codes = valid['Department'].map(departments)
+    firsts = allocator.allocate_blocks(codes.value_counts().to_dict()) if len(valid) else {}
+    # Number each department's rows consecutively from its reserved block
+    sequence = codes.map(firsts) + codes.groupby(codes).cumcount()
+
+    records = []
+    for row, code, seq in zip(valid.to_dict('records'), codes, sequence):
+        record = {c: row[c] for c in REQUIRED_COLUMNS + OPTIONAL_COLUMNS}
+        record['DOB'] = row['DOB'].date()
+        record['Age'] = int(row['Age'])
+        record['Unique Code'] = format_code(row['First Name'], row['Last Name'], code, int(seq))
+        record['Registration Date'] = registration_date
+        records.append(record)
+    return records
+
+
+def _already_registered(valid, store):
+    # Rows whose blocking keys match a registered person are reported, not
+    # imported, so uploading the same roster twice registers nobody twice
+    found = [store.duplicates.find(row) for row in valid.to_dict('records')]
+    matched = pd.Series([bool(f) for f in found], index=valid.index, dtype=bool)
+    errors = pd.DataFrame({
+        'Row': valid.index[matched] + 2,
+        'First Name': valid.loc[matched, 'First Name'],
+        'Last Name': valid.loc[matched, 'Last Name'],
+        'Errors': ["Possibly already registered as " + ", ".join(f) for f in found if f],
+    }).reset_index(drop=True)
+    return valid[~matched], errors
+
+
+def _listed_twice(valid):
+    # Later rows sharing a blocking key with an earlier row of the same
+    # roster are reported; only the first listing is imported
+    keys = blocking_frame(valid)
+    rows = pd.Series(valid.index, index=valid.index)
+    messages = pd.Series("", index=valid.index)
+    for kind in KINDS:
+        key = keys[kind]
+        shared = (key != "") & key.duplicated()
+        first = rows.groupby(key).transform('min') + 2
+        messages = messages.where(~shared, messages + "; " + REASONS[kind] + " as row " + first.astype(str))
+    matched = messages != ""
+    errors = pd.DataFrame({
+        'Row': valid.index[matched] + 2,
+        'First Name': valid.loc[matched, 'First Name'],
+        'Last Name': valid.loc[matched, 'Last Name'],
+        'Errors': "Listed more than once: " + messages[matched].str.lstrip("; "),
+    }).reset_index(drop=True)
+    return valid[~matched], errors
+
+
+def import_roster(df, store, allocator):
+    # Validates, allocates and saves in one batch; returns (records, errors)
+    valid, errors = validate(df)
+    valid, registered = _already_registered(valid, store)
+    valid, repeated = _listed_twice(valid)
+    duplicates = pd.concat([registered, repeated])
+    if len(duplicates):
+        errors = pd.concat([errors, duplicates]).sort_values('Row', ignore_index=True)
+    records = build_records(valid, allocator)
+    if records:
+        store.save_many([(r, r.keys()) for r in records])
+    return records, errors
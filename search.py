@@ -0,0 +1,176 @@
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+from collections import OrderedDict, defaultdict
+
+# Patient lookup shared by every section. Unique Codes are found with one
+# dict lookup; names and codes are indexed by trigram (substring queries of
+# three or more characters) and by sorted token (prefix queries of one or
+# two characters), so a search never scans the whole record list.
+KEY = "Unique Code"
+MAX_MATCHES = 1000
+# Batches at least this big are indexed by appending and re-sorting once
+BULK_THRESHOLD = 1000
+# Ranked results kept for recent queries; paging through them is free
+MEMO_SIZE = 256
+
+
+def normalize(text):
+    if text is None or (isinstance(text, float) and text != text):
+        return ""
+    text = str(text)
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.lower().split())
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def display_name(record):
+    return f"{record.get('First Name', '')} {record.get('Last Name', '')}"
+
+
+class SearchIndex:
+    def __init__(self, records=()):
+        self._lock = threading.RLock()
+        self._records = []  # index id -> record
+        self._ids = {}  # normalized Unique Code -> index id
+        self._text = []  # index id -> (normalized name, normalized code)
+        self._grams = defaultdict(set)  # trigram -> set of index ids
+        self._tokens = []  # sorted (token, index id)
+        self._bulk = False
+        self.version = 0  # bumped by every change to the index
+        self._memo = OrderedDict()  # normalized query -> (version, ranked ids)
+        self.add_many(records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def _keys(self, name, code):
+        return _trigrams(name) | _trigrams(code), set(name.split()) | {code}
+
+    def add(self, record):
+        # Indexes a new record, or re-indexes one whose name or code changed
+        name = normalize(display_name(record))
+        code = normalize(record.get(KEY))
+        with self._lock:
+            self.version += 1
+            rid = self._ids.get(code)
+            if rid is None:
+                rid = len(self._records)
+                self._records.append(record)
+                self._text.append(None)
+            elif self._text[rid] == (name, code):
+                self._records[rid] = record
+                return
+            else:
+                self._records[rid] = record
+                self._unindex(rid)
+            self._ids[code] = rid
+            self._text[rid] = (name, code)
+            grams, tokens = self._keys(name, code)
+            for g in grams:
+                self._grams[g].add(rid)
+            for t in tokens:
+                if self._bulk:
+                    self._tokens.append((t, rid))
+                else:
+                    insort(self._tokens, (t, rid))
+
+    def add_many(self, records):
+        if len(records) < BULK_THRESHOLD:
+            for r in records:
+                self.add(r)
+            return
+        # Bulk build: collect tokens unsorted and sort once at the end
+        with self._lock:
+            self._bulk = True
+            try:
+                for r in records:
+                    self.add(r)
+            finally:
+                self._bulk = False
+                self._tokens.sort()
+
+    def _unindex(self, rid):
+        grams, tokens = self._keys(*self._text[rid])
+        for g in grams:
+            self._grams[g].discard(rid)
+        for t in tokens:
+            i = bisect_left(self._tokens, (t, rid))
+            if i < len(self._tokens) and self._tokens[i] == (t, rid):
+                del self._tokens[i]
+            elif self._bulk:
+                # Token list is only partly sorted during a bulk build
+                self._tokens.remove((t, rid))
+
+    def get(self, unique_code):
+        rid = self._ids.get(normalize(unique_code))
+        return None if rid is None else self._records[rid]
+
+    def _rank(self, rid, q):
+        name, code = self._text[rid]
+        if code == q:
+            rank = 0
+        elif code.startswith(q):
+            rank = 1
+        elif name.startswith(q):
+            rank = 2
+        elif any(t.startswith(q) for t in name.split()):
+            rank = 3
+        else:
+            rank = 4
+        return (rank, name)
+
+    def _candidates(self, q):
+        # Token prefix matches first; they rank above plain substring matches
+        ids = {}
+        i = bisect_left(self._tokens, (q,))
+        while i < len(self._tokens) and self._tokens[i][0].startswith(q):
+            ids[self._tokens[i][1]] = None
+            if len(ids) >= MAX_MATCHES:
+                return list(ids)
+            i += 1
+        if len(q) < 3:
+            return list(ids)
+        postings = [self._grams.get(g) for g in _trigrams(q)]
+        if not all(postings):
+            return list(ids)
+        postings.sort(key=len)
+        rest = postings[1:]
+        for rid in postings[0]:
+            if rid in ids or not all(rid in p for p in rest):
+                continue
+            name, code = self._text[rid]
+            if q in name or q in code:
+                ids[rid] = None
+                if len(ids) >= MAX_MATCHES:
+                    break
+        return list(ids)
+
+    def clear_memo(self):
+        # Drops the cached rankings, so the next search of any query ranks afresh
+        with self._lock:
+            self._memo.clear()
+
+    def search(self, query, page=0, page_size=20):
+        # Returns one page of ranked matches and the total number of matches,
+        # which is capped at MAX_MATCHES
+        q = normalize(query)
+        if not q:
+            return [], 0
+        with self._lock:
+            memo = self._memo.get(q)
+            if memo is not None and memo[0] == self.version:
+                ranked = memo[1]
+                self._memo.move_to_end(q)
+            else:
+                ranked = sorted(self._candidates(q), key=lambda rid: self._rank(rid, q))
+                self._memo[q] = (self.version, ranked)
+                if len(self._memo) > MEMO_SIZE:
+                    self._memo.popitem(last=False)
+            start = page * page_size
+            return [self._records[rid] for rid in ranked[start:start + page_size]], len(ranked)
@@ -0,0 +1,60 @@
+import os
+import socket
+
+# Settings shared by the Streamlit app and the command line tools
+
+# Department mapping
+departments = {
+    "Public Health": "PH",
+    "Port Health and Aviation": "PO",
+    "Reference Lab": "RL",
+    "Office of RDHS": "RD",
+    "Clinical Care Department": "CC",
+    "HASS & Finance": "HF",
+    "Human Resource": "HR",
+    "Regional Medical Stores": "RM"
+}
+
+# Data file paths
+DATA_FILE = "medical_records.csv"
+DB_FILE = "medical_records.db"
+SEQUENCE_FILE = "medical_records.seq.db"
+# "csv" (snapshot + change journal), "sharded" (a snapshot + journal per
+# department, medical_records.PH.csv etc.) or "sqlite"
+STORAGE_BACKEND = os.environ.get("WRHD_STORAGE", "csv")
+# Fold the change journal back into the CSV snapshot once it gets this long
+JOURNAL_COMPACT_THRESHOLD = 5000
+# Keep a memory-mapped binary copy of the CSV snapshot for fast reloads
+# (WRHD_BINARY_SNAPSHOT=0 turns it off)
+BINARY_SNAPSHOT = os.environ.get("WRHD_BINARY_SNAPSHOT", "1") != "0"
+# Append-only measurement history, tagged with the station that took each reading
+HISTORY_FILE = "medical_records.history.db"
+# Change sequence behind the delta export for the nightly sync
+CHANGES_FILE = "medical_records.changes.db"
+# Journal entries are tagged with the station too, so the journals of
+# offline laptops can be merged later; renumbered codes are kept here
+STATION = os.environ.get("WRHD_STATION") or socket.gethostname()
+MERGE_FILE = "medical_records.merge.db"
+
+# Local HTTP service for device readings (python cli.py ingest-serve); set
+# WRHD_INGEST_TOKEN to require "Authorization: Bearer <token>". Readings
+# posted within INGEST_WAIT seconds of each other are written as one batch
+INGEST_HOST = os.environ.get("WRHD_INGEST_HOST", "127.0.0.1")
+INGEST_PORT = int(os.environ.get("WRHD_INGEST_PORT", "8502"))
+INGEST_TOKEN = os.environ.get("WRHD_INGEST_TOKEN", "")
+INGEST_BATCH = 2000
+INGEST_WAIT = 0.02
+
+# Outbound SMS: "fake" logs messages locally, "twilio" sends them using
+# TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN and TWILIO_FROM_NUMBER
+OUTBOX_FILE = "medical_records.outbox.db"
+SMS_TRANSPORT = os.environ.get("WRHD_SMS", "fake")
+SMS_WORKERS = 2
+SMS_PER_SECOND = 1.0
+
+# Timing instrumentation (WRHD_METRICS=0 turns it off): Prometheus text
+# snapshots, rotated hourly with a day of history kept
+METRICS_ENABLED = os.environ.get("WRHD_METRICS", "1") != "0"
+METRICS_FILE = "medical_records.metrics.prom"
+METRICS_ROTATE_SECONDS = 3600
+METRICS_BACKUPS = 24
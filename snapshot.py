@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+from columnar import RecordTable
+
+# Binary copy of the CSV snapshot, one .npy file per column array next to
+# medical_records.csv. Numeric columns are memory-mapped copy-on-write, so
+# a reload costs a few file opens and a column is only read from disk when
+# something uses it; text columns are one UTF-8 buffer each, decoded on
+# first use. The manifest records the format version and the CSV's size,
+# modification time and CRC-32, and a snapshot that no longer matches its
+# CSV is rebuilt on the next load. The CSV stays the file of record.
+SNAPSHOT_VERSION = 1
+SUFFIX = ".snapshot"
+MANIFEST = "manifest.json"
+CHUNK_SIZE = 1 << 20
+
+
+def snapshot_path(data_file):
+    return data_file + SUFFIX
+
+
+def checksum(path):
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def matches(source, signature):
+    # signature: (inode, mtime_ns, size) as CsvStorage records it
+    return source is not None and signature is not None and \
+        (source['mtime_ns'], source['size']) == tuple(signature[1:])
+
+
+def _load_array(path, size):
+    if os.path.getsize(path) != size:
+        raise ValueError(f"{path} is truncated")
+    if path.endswith(".objects.npy"):
+        # Text columns holding non-strings cannot be mapped
+        return np.load(path, allow_pickle=True)
+    return np.load(path, mmap_mode='c').view(np.ndarray)
+
+
+def read(data_file):
+    # Returns (table, source) or (None, None) if there is no current snapshot
+    directory = snapshot_path(data_file)
+    try:
+        with open(os.path.join(directory, MANIFEST), encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get('version') != SNAPSHOT_VERSION:
+            return None, None
+        stat = os.stat(data_file)
+        source = manifest['source']
+        if (source['size'], source['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+            # Same bytes under a new timestamp (a copy or restore) still count
+            if source['size'] != stat.st_size or source['crc32'] != checksum(data_file):
+                return None, None
+            source = dict(source, mtime_ns=stat.st_mtime_ns)
+            _write_manifest(directory, dict(manifest, source=source))
+        columns = {}
+        for column in manifest['columns']:
+            arrays = {part: _load_array(os.path.join(directory, file), size)
+                      for part, (file, size) in column['files'].items()}
+            columns[column['name']] = (column['kind'], arrays, column['meta'])
+        return RecordTable.restore(manifest['size'], manifest['capacity'], columns), source
+    except (OSError, ValueError, KeyError, TypeError):
+        return None, None
+
+
+def _write_manifest(directory, manifest):
+    tmp = os.path.join(directory, MANIFEST + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp, os.path.join(directory, MANIFEST))
+
+
+def write(table, data_file, signature):
+    # Builds the snapshot in a scratch directory and swaps it in; returns
+    # False (and leaves the CSV path to do the work) if anything goes wrong
+    if signature is None:
+        return False
+    directory = snapshot_path(data_file)
+    tmp = f"{directory}.tmp.{os.getpid()}"
+    old = f"{directory}.old.{os.getpid()}"
+    try:
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        size, capacity, columns = table.dump()
+        manifest = {
+            'version': SNAPSHOT_VERSION,
+            'source': {'size': signature[2], 'mtime_ns': signature[1], 'crc32': checksum(data_file)},
+            'size': size,
+            'capacity': capacity,
+            'columns': [],
+        }
+        for i, (name, (kind, arrays, meta)) in enumerate(columns.items()):
+            files = {}
+            for part, array in arrays.items():
+                file = f"{i}.{part}.npy"
+                np.save(os.path.join(tmp, file), array, allow_pickle=array.dtype == object)
+                files[part] = [file, os.path.getsize(os.path.join(tmp, file))]
+            manifest['columns'].append({'name': name, 'kind': kind, 'files': files, 'meta': meta})
+        _write_manifest(tmp, manifest)
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(directory):
+            os.replace(directory, old)
+        os.replace(tmp, directory)
+        shutil.rmtree(old, ignore_errors=True)
+        return True
+    except (OSError, ValueError, TypeError):
+        shutil.rmtree(tmp, ignore_errors=True)
+        return False
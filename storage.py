@@ -0,0 +1,325 @@
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+import pandas as pd
+
+import journal
+from settings import departments
+
+# Storage backends behind the shared RecordStore. Each backend loads the
+# full record set once (as a DataFrame plus journal entries still to be
+# replayed on top), writes only the fields a save changed for one record,
+# and reports every change since the previous poll (or None when the
+# in-memory copy has to be reloaded from scratch).
+KEY = journal.KEY
+# Shards of the "sharded" backend: one per department code, plus "NA" for
+# codes without a known department
+SHARD_CODES = list(departments.values()) + ["NA"]
+_CODE = re.compile(r"^.{2}([A-Z]{2})\d+$")
+
+REGISTRATION_COLUMNS = [
+    'Unique Code', 'First Name', 'Middle Name', 'Last Name', 'DOB', 'Age',
+    'Sex', 'Department', 'Job Title', 'Email', 'Phone Number',
+    'Family History of Diabetes', 'Family History of Hypertension',
+    'Registration Date',
+]
+SECTION_COLUMNS = [
+    'Blood Pressure', 'BP Date', 'BP Notes',
+    'Weight', 'Height', 'BMI', 'BMI Classification', 'BMI Date',
+    'Blood Glucose', 'Glucose Date', 'Fasting Status',
+    'Visual Acuity Right', 'Visual Acuity Left',
+    'Right Eye with Glasses', 'Left Eye with Glasses',
+    'Vision Test Date', 'Visual Examination Notes',
+    'Clinical Notes', 'Referred', 'Referral Date', 'Referral Details',
+]
+COLUMN_TYPES = {
+    'Age': 'INTEGER',
+    'Weight': 'REAL',
+    'Height': 'REAL',
+    'BMI': 'REAL',
+    'Blood Glucose': 'REAL',
+}
+
+
+class CsvStorage:
+    # CSV snapshot plus the append-only journal
+    timestamped = True  # changes() has every field's time, for station merges
+    def __init__(self, data_file, station=""):
+        self.data_file = data_file
+        self.station = station
+        self.journal_file = journal.journal_path(data_file)
+        self.pending = 0  # journal entries not yet folded into the snapshot
+        self._snapshot_sig = None
+        self._journal_inode = None
+        self._journal_offset = 0
+
+    def _signature(self):
+        try:
+            st = os.stat(self.data_file)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    @property
+    def signature(self):
+        # Of the snapshot the last load() read
+        return self._snapshot_sig
+
+    def load(self, frame=True):
+        # frame=False skips parsing the CSV, for a caller that has the
+        # snapshot's records from elsewhere
+        self._snapshot_sig = self._signature()
+        df = journal.read_snapshot(self.data_file) if frame else None
+        leftover = journal.read_entries(journal.compacting_path(self.data_file))
+        entries, self._journal_offset, self._journal_inode = journal.tail(self.journal_file)
+        self.pending = len(leftover) + len(entries)
+        return df, leftover + entries
+
+    def poll(self):
+        if self._signature() != self._snapshot_sig:
+            return None
+        try:
+            st = os.stat(self.journal_file)
+        except FileNotFoundError:
+            return None if self._journal_inode is not None else []
+        if self._journal_inode is None:
+            # First journal since the last load: read it from the start
+            self._journal_inode, self._journal_offset = st.st_ino, 0
+        if st.st_ino != self._journal_inode or st.st_size < self._journal_offset:
+            return None
+        if st.st_size == self._journal_offset:
+            return []
+        entries, self._journal_offset, _ = journal.tail(self.journal_file, self._journal_offset)
+        self.pending += len(entries)
+        return entries
+
+    def write(self, unique_code, fields):
+        return journal.append_entry(self.journal_file, unique_code, fields, self.station)
+
+    def write_many(self, changes):
+        # Returns the bytes written
+        return journal.append_entries(self.journal_file, changes, self.station)
+
+    def write_entries(self, entries):
+        # Merged entries keep the timestamp and station they were made with
+        return journal.append_journal(self.journal_file, entries)
+
+    def changes(self):
+        # Every journaled change with its timestamp, oldest first
+        for path in journal.journal_files(self.data_file):
+            with open(path, "rb") as f:
+                yield from journal.iter_entries(f)
+
+    def compact(self):
+        return journal.compact(self.data_file)
+
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+
+def _to_db(value):
+    if value is pd.NaT or (isinstance(value, float) and value != value):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.date().isoformat() if value == value.normalize() else value.isoformat()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if hasattr(value, "item"):  # numpy scalars
+        return value.item()
+    return value
+
+
+class SqliteStorage:
+    # Local SQLite file in WAL mode: one indexed row per patient
+    timestamped = False
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.pending = 0  # nothing to compact; kept for RecordStore
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+        self._columns = {row[1] for row in self._conn.execute("PRAGMA table_info(records)")}
+        self._data_version = None
+        self._own = []
+
+    def _create_schema(self):
+        # The primary key doubles as the Unique Code index
+        columns = [f"{_quote(KEY)} TEXT PRIMARY KEY"]
+        for c in REGISTRATION_COLUMNS[1:] + SECTION_COLUMNS:
+            columns.append(f"{_quote(c)} {COLUMN_TYPES.get(c, '')}".rstrip())
+        with self._conn:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS records ({', '.join(columns)})")
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_records_name ON records ("Last Name", "First Name")')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_records_department ON records ("Department")')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_records_registration_date ON records ("Registration Date")')
+
+    def _ensure_columns(self, fields):
+        for c in fields:
+            if c not in self._columns:
+                self._conn.execute(f"ALTER TABLE records ADD COLUMN {_quote(c)}")
+                self._columns.add(c)
+
+    def _version(self):
+        # Changes whenever another connection (any process) commits
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def load(self):
+        with self._lock:
+            self._data_version = self._version()
+            self._own = []
+            df = pd.read_sql_query("SELECT * FROM records", self._conn)
+        df['Referred'] = df['Referred'].map({1: True, 0: False})
+        return df, []
+
+    def poll(self):
+        with self._lock:
+            if self._version() != self._data_version:
+                return None
+            entries, self._own = self._own, []
+        return entries
+
+    def _upsert(self, unique_code, fields):
+        fields = {k: v for k, v in fields.items() if k != KEY}
+        self._ensure_columns(fields)
+        names = [KEY] + list(fields)
+        placeholders = ", ".join("?" * len(names))
+        sql = f"INSERT INTO records ({', '.join(map(_quote, names))}) VALUES ({placeholders})"
+        if fields:
+            updates = ", ".join(f"{_quote(c)}=excluded.{_quote(c)}" for c in fields)
+            sql += f" ON CONFLICT({_quote(KEY)}) DO UPDATE SET {updates}"
+        else:
+            sql += " ON CONFLICT DO NOTHING"
+        self._conn.execute(sql, [unique_code] + [_to_db(v) for v in fields.values()])
+
+    def write(self, unique_code, fields):
+        return self.write_many([(unique_code, fields)])
+
+    def write_many(self, changes):
+        # One transaction for the whole batch
+        with self._lock:
+            with self._conn:
+                for unique_code, fields in changes:
+                    self._upsert(unique_code, fields)
+            self._own.extend({KEY: code, "fields": dict(fields)} for code, fields in changes)
+        return None  # SQLite does not report the bytes a write cost
+
+    def write_entries(self, entries):
+        return self.write_many([(e[KEY], e.get("fields", {})) for e in entries])
+
+    def changes(self):
+        # Rows keep no per-field timestamps
+        return []
+
+    def import_records(self, records):
+        self.write_many([(r[KEY], r) for r in records])
+        with self._lock:
+            self._data_version = None  # force the next poll to reload
+        return len(records)
+
+    def compact(self):
+        with self._lock:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return 0
+
+
+def shard_path(data_file, department_code):
+    # medical_records.csv -> medical_records.PH.csv
+    root, ext = os.path.splitext(data_file)
+    return f"{root}.{department_code}{ext}"
+
+
+def department_code(unique_code):
+    # "KMPH0042" -> "PH"; codes that do not parse go to the "NA" shard
+    match = _CODE.match(str(unique_code or ""))
+    return match.group(1) if match and match.group(1) in SHARD_CODES else "NA"
+
+
+class ShardedStorage:
+    # One CSV snapshot plus journal per department, picked by the department
+    # code inside the Unique Code, so a save appends to (and compaction
+    # rewrites) only that department's files. Loads read the shards in
+    # parallel and hand RecordStore one merged frame.
+    timestamped = True
+
+    def __init__(self, data_file, station=""):
+        self.data_file = data_file
+        self.shards = {code: CsvStorage(shard_path(data_file, code), station) for code in SHARD_CODES}
+        self._pool = ThreadPoolExecutor(min(len(self.shards), os.cpu_count() or 1), thread_name_prefix="shard")
+
+    @property
+    def pending(self):
+        return sum(shard.pending for shard in self.shards.values())
+
+    @property
+    def signature(self):
+        # No single snapshot to key a binary copy or saved tallies by
+        return None
+
+    def shard(self, unique_code):
+        return self.shards[department_code(unique_code)]
+
+    def load(self):
+        loaded = list(self._pool.map(lambda shard: shard.load(), self.shards.values()))
+        frames = [df for df, _ in loaded if len(df)]
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=[KEY])
+        return df, [entry for _, entries in loaded for entry in entries]
+
+    def poll(self):
+        entries = []
+        for shard in self.shards.values():
+            changed = shard.poll()
+            if changed is None:
+                return None
+            entries.extend(changed)
+        return entries
+
+    def _routed(self, items, code_of):
+        grouped = {}
+        for item in items:
+            grouped.setdefault(department_code(code_of(item)), []).append(item)
+        return grouped
+
+    def write(self, unique_code, fields):
+        return self.shard(unique_code).write(unique_code, fields)
+
+    def write_many(self, changes):
+        return sum(self.shards[code].write_many(batch)
+                   for code, batch in self._routed(changes, lambda c: c[0]).items())
+
+    def write_entries(self, entries):
+        return sum(self.shards[code].write_entries(batch)
+                   for code, batch in self._routed(entries, lambda e: e[KEY]).items())
+
+    def changes(self):
+        for shard in self.shards.values():
+            yield from shard.changes()
+
+    def import_records(self, records):
+        # Splits whole records (e.g. from the single CSV) into the shards
+        for code, batch in self._routed(records, lambda r: r[KEY]).items():
+            shard = self.shards[code]
+            journal.append_entries(shard.journal_file, [(r[KEY], r) for r in batch])
+            shard.compact()
+        return len(records)
+
+    def compact(self):
+        # Only the shards with something to fold are rewritten
+        busy = [shard for shard in self.shards.values() if shard.pending]
+        return sum(self._pool.map(lambda shard: shard.compact(), busy))
+
+
+def open_storage(backend, path, station=""):
+    if backend == "sqlite":
+        return SqliteStorage(path)
+    if backend == "csv":
+        return CsvStorage(path, station)
+    if backend == "sharded":
+        return ShardedStorage(path, station)
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,183 @@
+import threading
+
+import aggregates
+import journal
+import snapshot
+from aggregates import ScreeningAggregates
+from columnar import RecordTable
+from dedup import DuplicateIndex
+from search import SearchIndex
+from settings import BINARY_SNAPSHOT
+from storage import open_storage
+
+# One in-memory copy of the records shared by every session of the server
+# process. The storage backend is asked for changes on every rerun; it
+# answers from a cheap stat or version check and only a change it cannot
+# express incrementally (compaction, a replaced file, another process
+# writing to SQLite) triggers a full reload. The search and duplicate
+# indexes are built on first use, so a section that never looks a patient
+# up does not pay for them after a reload. The screening tallies are kept
+# current on every change instead, since the summary cards always need them.
+# Writes are stamped in the change log only once they are on disk, so a
+# delta export never hands out a sequence whose values it cannot read yet.
+KEY = journal.KEY
+
+
+class RecordStore:
+    def __init__(self, storage, binary_snapshot=False):
+        self.storage = storage
+        self.binary_snapshot = binary_snapshot  # CSV backend only
+        self.table = RecordTable()
+        self._search = None
+        self._duplicates = None
+        self.aggregates = ScreeningAggregates()
+        self.version = 0  # bumped whenever the in-memory records change
+        self.history = None  # MeasurementHistory fed by every save, if set
+        self.change_log = None  # ChangeLog stamped by every write, if set
+        self._lock = threading.RLock()
+        self._loaded = False
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def pending(self):
+        return self.storage.pending
+
+    @property
+    def by_code(self):
+        return self.table.rows
+
+    @property
+    def search(self):
+        with self._lock:
+            if self._search is None:
+                self._search = SearchIndex(self.table.views())
+            return self._search
+
+    @property
+    def duplicates(self):
+        with self._lock:
+            if self._duplicates is None:
+                self._duplicates = DuplicateIndex.from_table(self.table)
+            return self._duplicates
+
+    def _reload(self):
+        table = None
+        if self.binary_snapshot:
+            # A current binary snapshot stands in for parsing the CSV, as
+            # long as it belongs to the CSV the journal was read against
+            table, source = snapshot.read(self.storage.data_file)
+            _, entries = self.storage.load(frame=False)
+            if not snapshot.matches(source, self.storage.signature):
+                table = None
+        if table is None:
+            df, entries = self.storage.load()
+            table = RecordTable.from_frame(df)
+            if self.binary_snapshot:
+                snapshot.write(table, self.storage.data_file, self.storage.signature)
+        # Tallies of the snapshot, then the journal applied on top of them
+        data_file = getattr(self.storage, "data_file", None)
+        counts = aggregates.read(data_file, self.storage.signature) if data_file else None
+        tallies = ScreeningAggregates.from_table(table, counts)
+        if counts is None and data_file:
+            aggregates.write(tallies, data_file, self.storage.signature)
+        self._apply(table, tallies, entries)
+        self.table = table
+        self.aggregates = tallies
+        self._search = None
+        self._duplicates = None
+        self._loaded = True
+        self.version += 1
+
+    def _apply(self, table, tallies, entries):
+        rows = table.apply(entries)
+        if rows:
+            tallies.apply(table, rows)
+        return rows
+
+    def rebuild_aggregates(self):
+        # Recounts from every record; returns the groups the running tallies
+        # had wrong (empty if they were right)
+        with self._lock:
+            rebuilt = ScreeningAggregates.from_table(self.table)
+            differences = self.aggregates.differences(rebuilt)
+            self.aggregates = rebuilt
+        return differences
+
+    def refresh(self):
+        with self._lock:
+            entries = self.storage.poll() if self._loaded else None
+            if entries is None:
+                self._reload()
+            elif entries:
+                rows = self._apply(self.table, self.aggregates, entries)
+                if self._search is not None:
+                    self._search.add_many(self.table.views(rows))
+                if self._duplicates is not None:
+                    self._duplicates.add_many(self.table.views(rows))
+                self.version += 1
+
+    def get(self, unique_code):
+        return self.table.get(unique_code)
+
+    def save(self, record, fields):
+        return self.update(record[KEY], {f: record.get(f) for f in fields})
+
+    def update(self, unique_code, change):
+        # change: {field: value} for one record. The in-memory records are
+        # only touched by the refresh after the write, so a failed write
+        # leaves them as they were.
+        with self._lock:
+            written = self.storage.write(unique_code, change)
+            if self.history is not None:
+                self.history.add_changes([(unique_code, change)])
+            if self.change_log is not None:
+                self.change_log.add_changes([(unique_code, change)])
+            # Picks up our own change along with anything written elsewhere
+            self.refresh()
+        return written
+
+    def save_many(self, changes):
+        # changes: (record, fields) pairs, written as one batch
+        return self.write_many([(record[KEY], {f: record.get(f) for f in fields})
+                                for record, fields in changes])
+
+    def write_many(self, changes, readings=None):
+        # changes: (unique_code, {field: value}) pairs, written as one batch;
+        # the in-memory records pick the values up on the following refresh.
+        # readings: journal-style entries for the history when it should not
+        # just be the changes stamped now (device readings taken earlier)
+        with self._lock:
+            written = self.storage.write_many(changes) if changes else 0
+            if self.history is not None:
+                if readings is None:
+                    self.history.add_changes(changes)
+                else:
+                    self.history.add_entries(readings)
+            if self.change_log is not None:
+                self.change_log.add_changes(changes)
+            self.refresh()
+        return written
+
+    def write_entries(self, entries):
+        # Journal-style entries from elsewhere (a station merge), written
+        # with their own timestamps and stations as one batch; the caller
+        # decides which of them are new readings for the history
+        with self._lock:
+            written = self.storage.write_entries(entries)
+            if self.change_log is not None:
+                self.change_log.add_entries(entries)
+            self.refresh()
+        return written
+
+    def compact(self):
+        with self._lock:
+            folded = self.storage.compact()
+            self._reload()
+        return folded
+
+
+def open_record_store(backend, data_file, db_file, station="", binary_snapshot=BINARY_SNAPSHOT):
+    path = db_file if backend == "sqlite" else data_file
+    return RecordStore(open_storage(backend, path, station), binary_snapshot and backend == "csv")